@@ -0,0 +1,156 @@
+"""
+HTTP レスポンスのローカルアーカイブ（ingest の record / replay 用）。
+
+レイアウト（archive_dir 配下）:
+  index.db             url → status / headers / body の sha256（SQLite）
+  blobs/ab/abcdef….gz  本文（gzip）。sha256 で content-addressed なので同じ本文は 1 つ
+
+ArchiveTransport を httpx.AsyncClient の transport に渡すと、ingest.fetch_text / fetch_page を含む
+全リクエストが record（実ネットワーク + 保存）/ replay（アーカイブだけ、ネットワークなし）になる。
+"""
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import httpx
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+  url TEXT PRIMARY KEY,
+  status INTEGER NOT NULL,
+  headers TEXT NOT NULL,
+  sha256 TEXT NOT NULL,
+  fetched_at INTEGER NOT NULL
+);
+"""
+
+# 本文は展開済みで保存するので、転送時のエンコーディング系ヘッダーは残さない
+_DROP_HEADERS = frozenset({"content-encoding", "content-length", "transfer-encoding", "connection"})
+
+# replay でアーカイブに無い URL のレスポンスに付けるヘッダー
+MISS_HEADER = "x-docbot-archive"
+
+
+def is_final_status(status: int) -> bool:
+    """
+    アーカイブに残す最終レスポンスか（2xx / 3xx / 404 / 410）。
+    304 は本文が無く、429 / 5xx などは一時的な失敗なので、保存済みの良いレスポンスを上書きしない
+    """
+    return (200 <= status < 400 and status != 304) or status in (404, 410)
+
+
+class ResponseArchive:
+    """url → (status, headers, body) の保存・参照。本文は gzip で content-addressed に置く"""
+
+    def __init__(self, path: str | os.PathLike, commit_every: int = 100):
+        self.root = Path(path)
+        (self.root / "blobs").mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.root / "index.db")
+        self.conn.executescript(ARCHIVE_SCHEMA)
+        self.commit_every = commit_every
+        self.recorded = 0
+        self.hits = 0
+        self.misses = 0
+        self._uncommitted = 0
+
+    def _blob_path(self, sha: str) -> Path:
+        return self.root / "blobs" / sha[:2] / f"{sha}.gz"
+
+    def put(self, url: str, status: int, headers: list[tuple[str, str]], body: bytes) -> str:
+        """保存して本文の sha256 を返す。同じ本文の blob は書き直さない"""
+        sha = hashlib.sha256(body).hexdigest()
+        blob = self._blob_path(sha)
+        if not blob.exists():
+            blob.parent.mkdir(exist_ok=True)
+            tmp = blob.with_suffix(f".tmp{os.getpid()}")
+            tmp.write_bytes(gzip.compress(body, compresslevel=6, mtime=0))
+            os.replace(tmp, blob)
+        kept = [(k, v) for k, v in headers if k.lower() not in _DROP_HEADERS]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses(url, status, headers, sha256, fetched_at) VALUES (?, ?, ?, ?, ?)",
+            (url, status, json.dumps(kept), sha, int(time.time())),
+        )
+        self.recorded += 1
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+        return sha
+
+    def get(self, url: str) -> tuple[int, list[tuple[str, str]], bytes] | None:
+        row = self.conn.execute(
+            "SELECT status, headers, sha256 FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        status, headers, sha = row
+        try:
+            body = gzip.decompress(self._blob_path(sha).read_bytes())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return status, [tuple(h) for h in json.loads(headers)], body
+
+    def urls(self) -> list[str]:
+        return [r[0] for r in self.conn.execute("SELECT url FROM responses ORDER BY url")]
+
+    def stats(self) -> dict:
+        n, blobs = self.conn.execute("SELECT COUNT(*), COUNT(DISTINCT sha256) FROM responses").fetchone()
+        size = sum(p.stat().st_size for p in (self.root / "blobs").glob("*/*.gz"))
+        return {"responses": n, "blobs": blobs, "blob_bytes": size}
+
+    def commit(self) -> None:
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.conn.close()
+
+
+class ArchiveTransport(httpx.AsyncBaseTransport):
+    """
+    mode="record": inner（未指定なら実ネットワーク）で取得し、最終レスポンス（is_final_status）を archive に保存して返す。
+    mode="replay": archive だけから返す。無い URL は 404（MISS_HEADER 付き）。
+    If-None-Match が保存済み ETag と一致すれば 304 を返す（--incremental の検証用）
+    """
+
+    def __init__(self, archive: ResponseArchive, mode: str, inner: httpx.AsyncBaseTransport | None = None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown archive mode: {mode}")
+        self.archive = archive
+        self.mode = mode
+        self.inner = inner if inner is not None or mode == "replay" else httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        if self.mode == "replay":
+            hit = self.archive.get(url)
+            if hit is None:
+                return httpx.Response(404, headers={MISS_HEADER: "miss"}, request=request)
+            status, headers, body = hit
+            etag = next((v for k, v in headers if k.lower() == "etag"), None)
+            if etag and request.headers.get("if-none-match") == etag:
+                return httpx.Response(304, headers=headers, request=request)
+            return httpx.Response(status, headers=headers, content=body, request=request)
+
+        response = await self.inner.handle_async_request(request)
+        # transport のレスポンスは未デコードのストリーム。展開済みの本文で保存・返却する
+        raw = httpx.Response(
+            response.status_code, headers=response.headers, stream=response.stream, request=request
+        )
+        body = await raw.aread()
+        await raw.aclose()
+        headers = [(k, v) for k, v in raw.headers.multi_items() if k.lower() not in _DROP_HEADERS]
+        if is_final_status(raw.status_code):
+            self.archive.put(url, raw.status_code, headers, body)
+        return httpx.Response(raw.status_code, headers=headers, content=body, request=request)
+
+    async def aclose(self) -> None:
+        if self.inner is not None:
+            await self.inner.aclose()
@@ -4,6 +4,7 @@ import argparse
 import json
 import os
 import shutil
+import sqlite3
 import subprocess
 import sys
 import tarfile
@@ -96,7 +97,7 @@ def _format_table(rows: list[dict]) -> str:
 def run_compose(base: str, query: str, lang: str | None, limit: int) -> int:
     """compose サブコマンド"""
     url = base.rstrip("/") + "/search"
-    payload = {"query": query, "lang": lang, "limit": limit}
+    payload = {"query": query, "lang": lang, "limit": limit, "fields": ["title"]}
     try:
         r = httpx.post(url, json=payload, timeout=10)
         r.raise_for_status()
@@ -463,7 +464,7 @@ def run_helm(
 
         if chart_dir is None:
             url = base.rstrip("/") + "/search"
-            payload = {"query": query, "lang": lang, "limit": limit}
+            payload = {"query": query, "lang": lang, "limit": limit, "fields": ["title"]}
             hits = []
             try:
                 r = httpx.post(url, json=payload, timeout=10)
@@ -530,9 +531,69 @@ def run_helm(
     return 0
 
 
-def run_stats(db_path: str | None = None) -> int:
-    """DB のサイズとページ数を表示"""
-    from docbot.storage import open_db
+# stats --compare-cjk の既定クエリ
+CJK_COMPARE_QUERIES = {
+    "ja-jp": ["パフォーマンス", "SSO 設定", "アップグレード手順", "プラグイン", "Docker Compose"],
+    "zh-cn": ["插件管理", "升级", "SSO 配置", "性能调优"],
+}
+
+
+def _format_bytes(total: int) -> str:
+    """1 以上になる最大の単位で表示（小さい単位から見ると 5 MB が 5120.0 KB になる）"""
+    size_str = f"{total:,} B"
+    for unit, div in [("GB", 1024**3), ("MB", 1024**2), ("KB", 1024)]:
+        val = total / div
+        if val >= 1:
+            size_str = f"{val:.1f} {unit}"
+            break
+    return size_str
+
+
+def _print_cjk_compare(conn, lang: str, queries: list[str]) -> None:
+    from docbot.storage import TRIGRAM_SUPPORTED, compare_cjk_index
+
+    if not TRIGRAM_SUPPORTED:
+        print()
+        print(f"## CJK index: SQLite {sqlite3.sqlite_version} は trigram トークナイザ（3.34 以降）に未対応のため比較をスキップ")
+        return
+    res = compare_cjk_index(conn, queries, lang)
+    sizes = res["sizes"]
+    print()
+    print(f"## CJK index: ngram vs trigram ({lang})")
+    print(f"pages_fts (unicode61 + ngrams): {_format_bytes(sizes['pages_fts_bytes'])}")
+    print(f"  ngrams 列テキスト: {_format_bytes(sizes['ngrams_column_bytes'])}")
+    print(f"pages_tri (trigram): {_format_bytes(sizes['pages_tri_bytes'])}")
+    print()
+    print("| query | ngram ms | ngram hits | trigram ms | trigram hits | top10 共通 |")
+    print("| --- | --- | --- | --- | --- | --- |")
+    for r in res["queries"]:
+        print(
+            f"| {r['query']} | {r['ngram_ms']:.2f} | {r['ngram_hits']} "
+            f"| {r['trigram_ms']:.2f} | {r['trigram_hits']} | {r['top10_overlap']} |"
+        )
+
+
+def _print_url_dups(conn) -> None:
+    from docbot.ingest import url_duplicate_report
+
+    rep = url_duplicate_report(r[0] for r in conn.execute("SELECT url FROM pages"))
+    print()
+    print("## URL 正規化（fragment / query / 末尾スラッシュ）")
+    print(f"rows: {rep['rows']} → canonical: {rep['canonical']}（取得・行 {rep['duplicates']} 件減）")
+    for canon, variants in rep["examples"]:
+        print(f"- {canon}（{len(variants)} 行）")
+        for v in variants:
+            print(f"    {v}")
+
+
+def run_stats(
+    db_path: str | None = None,
+    compare_cjk: str | None = None,
+    queries: list[str] | None = None,
+    url_dups: bool = False,
+) -> int:
+    """DB のサイズとページ数を表示。compare_cjk 指定時は ngram/trigram の比較、url_dups 指定時は URL 重複も"""
+    from docbot.storage import is_published, open_db, open_db_readonly
     from docbot.config import CFG
 
     path = db_path or CFG.db_path
@@ -544,27 +605,108 @@ def run_stats(db_path: str | None = None) -> int:
         print("python -m docbot.ingest を実行してインデックスを作成してください。")
         return 1
 
-    total = os.path.getsize(path)
-    size_str = f"{total:,} B"
-    for unit, div in [("KB", 1024), ("MB", 1024**2), ("GB", 1024**3)]:
-        val = total / div
-        if val >= 1:
-            size_str = f"{val:.1f} {unit}"
-            break
+    size_str = _format_bytes(os.path.getsize(path))
 
-    conn = open_db(db_path)
+    # 公開済みスナップショットは読むだけ（open_db は配信中のファイルを書き換えるので開けない）
+    conn = open_db_readonly(db_path) if is_published(db_path) else open_db(db_path)
     cnt = conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
     by_lang = dict(conn.execute("SELECT lang, COUNT(*) FROM pages GROUP BY lang").fetchall())
-    conn.close()
 
     print(f"DB: {path}")
     print(f"Size: {size_str}")
     print(f"Pages: {cnt}")
     for lang, n in sorted(by_lang.items()):
         print(f"  - {lang}: {n}")
+
+    if compare_cjk:
+        _print_cjk_compare(conn, compare_cjk, queries or CJK_COMPARE_QUERIES.get(compare_cjk, []))
+    if url_dups:
+        _print_url_dups(conn)
+    conn.close()
+    return 0
+
+
+def run_optimize(
+    db_path: str | None = None,
+    into: str | None = None,
+    merge: int | None = None,
+    vacuum: bool = True,
+) -> int:
+    """FTS optimize / ANALYZE / VACUUM / WAL checkpoint を実行し、前後のサイズと segment 数を表示"""
+    from docbot.config import CFG
+    from docbot.storage import index_stats, is_published, open_db, open_db_readonly, optimize_index, optimize_into
+
+    path = db_path or CFG.db_path
+    if not os.path.exists(path):
+        print(f"DB が存在しません: {path}")
+        return 1
+    if is_published(path):
+        if not into:
+            print(f"ERROR: {path} は公開済みのスナップショットです（ingest --publish が optimize 済み）。--into で別のファイルに作ってください", file=sys.stderr)
+            return 1
+        # VACUUM INTO は読み取り専用接続でもできる
+        conn = open_db_readonly(path)
+    else:
+        conn = open_db(db_path)
+    before = index_stats(conn)
+    try:
+        if into:
+            steps = optimize_into(conn, into, merge=merge)
+        else:
+            steps = optimize_index(conn, merge=merge, vacuum=vacuum)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        conn.close()
+        return 1
+    if into:
+        # 読むだけ。open_db は WAL 化・SCHEMA・移行で optimize 済みのコピーを書き換えてしまう
+        out = open_db_readonly(into)
+        after = index_stats(out)
+        out.close()
+    else:
+        after = index_stats(conn)
+    conn.close()
+
+    print(f"DB: {before['path']}" + (f" → {after['path']}" if into else ""))
+    print()
+    print("| step | 秒 |")
+    print("| --- | --- |")
+    for name, sec in steps:
+        print(f"| {name} | {sec:.2f} |")
+    print()
+    print(f"size: {_format_bytes(before['file_bytes'])} → {_format_bytes(after['file_bytes'])}")
+    print(f"freelist pages: {before['freelist_count']} → {after['freelist_count']}")
+    for name, n in before["segments"].items():
+        print(f"segments {name}: {n} → {after['segments'][name]}")
     return 0
 
 
+def run_gc(
+    db_path: str | None = None,
+    dry_run: bool = False,
+    force: bool = False,
+    max_fraction: float | None = None,
+) -> int:
+    """最後に完走したクロールで見えなかったページを削除（dry_run なら報告のみ）"""
+    from docbot.ingest import print_gc_report
+    from docbot.config import CFG
+    from docbot.storage import gc_stale_pages, is_published, open_db, open_db_readonly
+
+    if is_published(db_path) and not dry_run:
+        print(
+            f"ERROR: {db_path or CFG.db_path} は公開済みのスナップショットです。"
+            "python -m docbot.ingest --publish --gc で作業用 DB を掃除して公開してください",
+            file=sys.stderr,
+        )
+        return 1
+    # dry-run は読むだけなので公開済みのスナップショットも読み取り専用で見られる
+    conn = open_db_readonly(db_path) if is_published(db_path) else open_db(db_path)
+    report = gc_stale_pages(conn, dry_run=dry_run, max_fraction=max_fraction, force=force)
+    conn.close()
+    print_gc_report(report)
+    return 1 if report["status"] == "aborted" else 0
+
+
 def run_upgrade(
     from_ver: str, to_ver: str, lang: str = "en-us",
     mode: str | None = None, values_path: str | None = None,
@@ -580,6 +722,9 @@ def run_upgrade(
 def run_search(base: str, query: str, lang: str | None, limit: int, as_json: bool) -> int:
     url = base.rstrip("/") + "/search"
     payload = {"query": query, "lang": lang, "limit": limit}
+    if not as_json:
+        # 表示に使うのはタイトルと抜粋（空なら lead）だけ。body_prefix などの重い列は受け取らない
+        payload.update(fields=["title", "lead"], snippet=True)
     try:
         r = httpx.post(url, json=payload, timeout=10)
         r.raise_for_status()
@@ -601,7 +746,7 @@ def run_search(base: str, query: str, lang: str | None, limit: int, as_json: boo
         title = (h.get("title") or "").strip()
         url = h.get("url") or ""
         score = h.get("score")
-        snippet = (h.get("lead") or "").replace("\n", " ").strip()
+        snippet = (h.get("snippet") or h.get("lead") or "").replace("\n", " ").strip()
         snippet = snippet[:280] + ("…" if len(snippet) > 280 else "")
         print(f"Title: {title}")
         print(f"URL: {url}")
@@ -651,8 +796,35 @@ def main() -> int:
     if argv and argv[0] == "stats":
         p = argparse.ArgumentParser(prog="docbot stats", description="DB のサイズとページ数を表示")
         p.add_argument("--db", default=None, help="DB パス（未指定で data/index.db）")
+        p.add_argument("--compare-cjk", choices=["ja-jp", "zh-cn"], default=None,
+                       help="ngram 列と trigram インデックスのサイズ・レイテンシを比較")
+        p.add_argument("--query", dest="queries", action="append", default=[],
+                       help="--compare-cjk で使うクエリ（複数可。未指定で既定セット）")
+        p.add_argument("--url-dups", action="store_true",
+                       help="URL 正規化で 1 つにまとまる行（fragment / query / 末尾スラッシュ違い）を集計")
+        args = p.parse_args(argv[1:])
+        return run_stats(args.db, args.compare_cjk, args.queries or None, args.url_dups)
+
+    if argv and argv[0] == "optimize":
+        p = argparse.ArgumentParser(prog="docbot optimize", description="ingest 後の index を最適化・圧縮")
+        p.add_argument("--db", default=None, help="DB パス（未指定で data/index.db）")
+        p.add_argument("--into", default=None, metavar="PATH",
+                       help="元 DB は変えず、デフラグ・optimize 済みの配信用コピーを PATH に書く")
+        p.add_argument("--merge", type=int, default=None, metavar="N",
+                       help="FTS の全 optimize の代わりに 'merge' を N ページ分（軽い増分マージ）")
+        p.add_argument("--no-vacuum", dest="vacuum", action="store_false", help="VACUUM を省く")
+        args = p.parse_args(argv[1:])
+        return run_optimize(args.db, args.into, args.merge, args.vacuum)
+
+    if argv and argv[0] == "gc":
+        p = argparse.ArgumentParser(prog="docbot gc", description="削除・改名されたページ（stale）を index から削除")
+        p.add_argument("--db", default=None, help="DB パス（未指定で data/index.db）")
+        p.add_argument("--dry-run", action="store_true", help="削除対象を表示するだけ")
+        p.add_argument("--force", action="store_true", help="しきい値を超えても削除")
+        p.add_argument("--max-fraction", type=float, default=None,
+                       help="削除対象の割合の上限（未指定で Config.gc_max_fraction）")
         args = p.parse_args(argv[1:])
-        return run_stats(args.db)
+        return run_gc(args.db, args.dry_run, args.force, args.max_fraction)
 
     if argv and argv[0] == "upgrade":
         p = argparse.ArgumentParser(prog="docbot upgrade", description="Non-Skippable を考慮したアップグレード経路")
@@ -682,6 +854,8 @@ def main() -> int:
         print("       docbot helm [query] [--chart PATH] [--chart-version X.Y.Z] [--values PATH] [--set K=V] ...", file=sys.stderr)
         print("       docbot upgrade --from X.Y.Z --to X.Y.Z [--mode helm] [--values PATH]", file=sys.stderr)
         print("       docbot stats  # DB サイズ・ページ数確認", file=sys.stderr)
+        print("       docbot gc [--dry-run] [--force]  # 削除されたページを index から消す", file=sys.stderr)
+        print("       docbot optimize [--into PATH]  # FTS optimize / ANALYZE / VACUUM", file=sys.stderr)
         return 2
 
     return run_search(args.base, q, args.lang, args.limit, args.json)
@@ -11,6 +11,10 @@ class Config:
     host: str = "enterprise-docs.dify.ai"
     base_path: str = "/versions/"
     langs: tuple[str, ...] = ("ja-jp", "en-us", "zh-cn")
+
+    # CJK インデックス方式: ここに含む言語は FTS5 trigram（pages_tri）、
+    # 含まない ja-jp/zh-cn は従来の ngrams 列。ingest もこれを見て ngrams 生成を省く
+    trigram_langs: tuple[str, ...] = ("ja-jp", "zh-cn")
     db_path: str = DEFAULT_DB_PATH
 
     # 対象URL: /versions/ 配下の全バージョン・全言語
@@ -42,7 +46,59 @@ class Config:
     # BFS制限（versions 配下複数版を拾うため多めに）
     max_pages: int = 2500
     max_depth: int = 8
-    concurrency: int = 10
+    concurrency: int = 10  # 同時 fetch 数（adaptive_concurrency 時はホストごとの初期値）
+
+    # ingest: ホストごとの適応的な同時 fetch 数（AIMD）。応答が latency_target 秒以内なら加算、
+    # 429 / 5xx / タイムアウトで乗算的に減らす。失敗 URL は fetch_retries 回まで jitter 付きで再試行
+    adaptive_concurrency: bool = True
+    min_concurrency: int = 1
+    max_concurrency: int = 32
+    latency_target: float = 2.0
+    aimd_decrease: float = 0.5
+    fetch_retries: int = 3
+    retry_backoff: float = 1.0  # 再試行待ちの基準秒（attempt ごとに倍、full jitter）
+    max_retry_after: float = 120.0  # Retry-After の上限秒
+
+    # ingest: 抽出（readability/lxml）用プロセス数と fetch→抽出キューの上限。0 ならプロセスを使わない
+    extract_workers: int = max(1, (os.cpu_count() or 2) - 1)
+    extract_queue_size: int = 64
+
+    # ingest: BulkWriter の 1 トランザクションあたりの行数と bulk build プロファイル
+    write_batch_size: int = 200
+    ingest_bulk_build: bool = True
+    bulk_cache_kib: int = 65536
+    # ingest: 取得を終えた URL がこの件数増えるごとに crawl_state を保存（--resume 用）
+    checkpoint_every: int = 200
+    # ingest: BFS の fetch のうち失敗（通信エラー・429 / 5xx・404 / 410 以外の非 200）がこの割合を超えたら完走扱いにしない
+    crawl_max_error_fraction: float = 0.05
+    # stale GC: 削除対象が全ページのこの割合を超えたら --force なしでは消さない
+    gc_max_fraction: float = 0.2
+    # ingest --record / --replay のレスポンスアーカイブ
+    archive_dir: str = "data/archive"
+
+    # server: 読み取り専用接続プール
+    read_pool_size: int = 8
+    read_pool_timeout: float = 10.0
+    # server: ingest --publish で差し替わった DB（data/index.db のリンク先）を確認する間隔（秒）
+    index_check_interval: float = 2.0
+    # ingest --publish: 残す公開済み世代（data/index.g*.db）の数。切替前のサーバーが読む分を含む
+    publish_keep: int = 2
+
+    # server: search_index 結果キャッシュ（LRU + TTL 秒）
+    search_cache_size: int = 512
+    search_cache_ttl: float = 300.0
+    # server: /search/batch の 1 リクエストあたりのクエリ数の上限
+    search_batch_max: int = 100
+
+    # server: /ask の live_fallback（sections に無いページを公開サイトから取得）。
+    # 共有クライアントの最大接続数、1 リクエストで取得を待つ秒数、取得・切り出し済みページのキャッシュ（LRU + TTL 秒）
+    ask_max_connections: int = 20
+    ask_fetch_deadline: float = 5.0
+    page_cache_size: int = 256
+    page_cache_ttl: float = 600.0
+    # server: /ask の引用。quote の合計の上限（文字数。AskReq.budget_unit="tokens" なら推定トークン数）と 1 件の最大文字数
+    ask_budget: int = 6000
+    ask_quote_chars: int = 900
 
     # dify-helm release notes（追加 ingest 用）
     helm_release_base: str = "https://langgenius.github.io/dify-helm"
@@ -1,5 +1,10 @@
+import time
+from urllib.parse import urljoin
+
 from bs4 import BeautifulSoup
+from lxml.etree import ParserError
 from readability import Document
+from readability.htmls import build_doc, shorten_title
 
 def extract_index_fields(html: str) -> tuple[str, str, str]:
     """
@@ -107,6 +112,28 @@ def extract_headings_and_body_prefix_markdown(md: str, body_prefix_len: int = 40
     return headings, body_prefix
 
 
+def extract_sections_markdown(md: str) -> list[dict]:
+    """
+    Markdown を見出し（#〜###）単位でセクション化。extract_main_text_with_headings と同じ形
+    return: [{"heading": "...", "text": "..."}, ...]
+    """
+    sections = []
+    cur = {"heading": "INTRO", "text": []}
+    for line in md.split("\n"):
+        s = line.strip()
+        if not s:
+            continue
+        if s.startswith(("# ", "## ", "### ")):
+            if cur["text"]:
+                sections.append({"heading": cur["heading"], "text": "\n".join(cur["text"]).strip()})
+            cur = {"heading": s.lstrip("# ").strip()[:200], "text": []}
+        else:
+            cur["text"].append(s)
+    if cur["text"]:
+        sections.append({"heading": cur["heading"], "text": "\n".join(cur["text"]).strip()})
+    return [s for s in sections if s["text"]]
+
+
 def extract_main_text_with_headings(html: str) -> list[dict]:
     """
     QA用：見出し単位で本文をセクション化
@@ -134,3 +161,128 @@ def extract_main_text_with_headings(html: str) -> list[dict]:
         sections.append({"heading": cur["heading"], "text": "\n".join(cur["text"]).strip()})
 
     return [s for s in sections if s["text"]]
+
+
+# extract_page で 1 回だけ走査する要素（各フィールドは名前で振り分ける）
+_PAGE_TAGS = ["h1", "h2", "h3", "p", "li", "td", "th", "code", "pre"]
+
+# Mintlify（enterprise-docs.dify.ai）のレイアウト。ページ見出し + 本文の順に走査する
+_MINTLIFY_HEADER_XPATH = '//header[@id="header"]'
+_MINTLIFY_CONTENT_XPATH = (
+    '//div[@id="content" or contains(concat(" ", normalize-space(@class), " "), " mdx-content ")]'
+)
+# 本文から落とす要素（readability が除去するものに合わせる）
+_MINTLIFY_DROP_TAGS = ("script", "style", "noscript", "svg", "button", "form", "iframe")
+
+
+def _mintlify_roots(tree) -> list:
+    """Mintlify の本文コンテナ（header があれば先頭に）。見つからなければ空（readability にフォールバック）"""
+    content = tree.xpath(_MINTLIFY_CONTENT_XPATH)
+    if not content:
+        return []
+    roots = tree.xpath(_MINTLIFY_HEADER_XPATH)[:1] + content[:1]
+    for root in roots:
+        for el in root.iter(*_MINTLIFY_DROP_TAGS):
+            el.drop_tree()
+    return roots
+
+
+def _iter_blocks_lxml(roots: list):
+    """(タグ名, テキスト)。BeautifulSoup の get_text(" ", strip=True) と同じ結合"""
+    for root in roots:
+        for el in root.iter(*_PAGE_TAGS):
+            yield el.tag, " ".join(t.strip() for t in el.itertext() if t.strip())
+
+
+def _iter_blocks_soup(soup: BeautifulSoup):
+    for el in soup.find_all(_PAGE_TAGS):
+        yield el.name.lower(), el.get_text(" ", strip=True)
+
+
+def extract_page(html: str, base_url: str = "", body_prefix_len: int = 4000, fast: bool = True) -> dict:
+    """
+    HTML を 1 回だけパースして ingest / QA 用フィールドをまとめて抽出。
+    extract_index_fields / extract_headings_and_body_prefix /
+    extract_main_text_with_headings / ingest.extract_nav_links と同じ結果を返す。
+    return: {"title", "hpath", "lead", "headings", "body_prefix", "sections", "nav_links", "via", "extract_ms"}
+    nav_links は base_url で解決した全リンク（許可判定は呼び出し側）
+
+    fast=True なら Mintlify の本文コンテナを XPath で直接取り（via="mintlify"）、
+    見つからないページだけ readability の summary() を使う（via="readability"）。
+    extract_ms はパース込みの 1 ページあたりの時間
+    """
+    t0 = time.perf_counter()
+    empty = {
+        "title": "", "hpath": "", "lead": "", "headings": "", "body_prefix": "",
+        "sections": [], "nav_links": [], "via": "empty", "extract_ms": 0.0,
+    }
+    try:
+        tree, _ = build_doc(html)
+    except (ParserError, ValueError):
+        return empty
+
+    # readability は hidden 要素を入力ツリーから落とすので、リンクは先に拾う
+    nav_links = []
+    seen = set()
+    for a in tree.iter("a"):
+        href = a.get("href")
+        if href is None:
+            continue
+        full_url = urljoin(base_url, href.strip())
+        if full_url not in seen:
+            seen.add(full_url)
+            nav_links.append(full_url)
+
+    roots = _mintlify_roots(tree) if fast else []
+    if roots:
+        via = "mintlify"
+        title = (shorten_title(tree) or "").strip()
+        blocks = _iter_blocks_lxml(roots)
+    else:
+        via = "readability"
+        doc = Document(tree)
+        title = (doc.short_title() or "").strip()
+        blocks = _iter_blocks_soup(BeautifulSoup(doc.summary(html_partial=True), "lxml"))
+
+    hpath_parts = []
+    headings_parts = []
+    lead = ""
+    body_parts = []
+    body_len = 0
+    sections = []
+    cur = {"heading": "INTRO", "text": []}
+
+    for name, t in blocks:
+        if name in ("h1", "h2", "h3"):
+            if t:
+                hpath_parts.append(t)
+                if name != "h1":
+                    headings_parts.append(t)
+            if cur["text"]:
+                sections.append({"heading": cur["heading"], "text": "\n".join(cur["text"]).strip()})
+            cur = {"heading": t[:200], "text": []}
+            continue
+        if not t:
+            continue
+        if not lead and name in ("p", "li"):
+            lead = t
+        if name in ("p", "li", "td", "th") and body_len < body_prefix_len:
+            body_parts.append(t)
+            body_len += len(t)
+        if name in ("p", "li", "code", "pre"):
+            cur["text"].append(t)
+
+    if cur["text"]:
+        sections.append({"heading": cur["heading"], "text": "\n".join(cur["text"]).strip()})
+
+    return {
+        "title": title,
+        "hpath": " | ".join(hpath_parts[:60]),
+        "lead": lead[:600],
+        "headings": " | ".join(headings_parts[:60]),
+        "body_prefix": " ".join(body_parts)[:body_prefix_len],
+        "sections": [s for s in sections if s["text"]],
+        "nav_links": nav_links,
+        "via": via,
+        "extract_ms": (time.perf_counter() - t0) * 1000,
+    }
@@ -3,26 +3,64 @@ Dify Enterprise docs クロール＆インデックス作成。
 
 スキーマ変更後は DB 再生成が必要:
   rm -f data/index.db data/index.db-shm data/index.db-wal && python -m docbot.ingest
+
+差分更新（変更ページだけ）:
+  python -m docbot.ingest --incremental
+  python -m docbot.ingest --sitemap-delta   # sitemap の lastmod で対象を絞る
+  python -m docbot.ingest --helm-only       # dify-helm release notes だけ
+
+中断したクロールの再開:
+  python -m docbot.ingest --resume
+
+レスポンスの記録と、ネットワークなしの再インデックス:
+  python -m docbot.ingest --record            # data/archive に保存しながらクロール
+  python -m docbot.ingest --replay            # data/archive だけから再構築
 """
+import argparse
 import asyncio
+import hashlib
+import heapq
+import itertools
 import os
+import random
 import re
+import sys
 import time
-from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from urllib.parse import urljoin, urlparse
+from collections.abc import Iterable
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit
 
 import httpx
 from bs4 import BeautifulSoup
 from lxml import etree
 
+from docbot.archive import MISS_HEADER, ArchiveTransport, ResponseArchive
 from docbot.config import CFG
-from docbot.storage import open_db, upsert_page
+from docbot.storage import (
+    BulkWriter,
+    CrawlCheckpoint,
+    begin_crawl,
+    build_db_path,
+    cjk_index_mode,
+    complete_crawl,
+    gc_stale_pages,
+    is_published,
+    load_fetched_at,
+    load_validators,
+    make_ngrams,
+    open_db,
+    publish_index,
+    seed_build_db,
+    with_section_stats,
+)
 from docbot.extract import (
-    extract_index_fields,
-    extract_headings_and_body_prefix,
+    extract_page,
     extract_index_fields_markdown,
     extract_headings_and_body_prefix_markdown,
+    extract_sections_markdown,
 )
 
 UA = {"User-Agent": "docbot/0.1 (+local)"}
@@ -37,29 +75,306 @@ def is_allowed(url: str) -> bool:
     return True
 
 
+_DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    frontier / 取得済み判定 / pages.url 用の正規形。
+    fragment・query を落とし、scheme / host を小文字、デフォルトポート・重複スラッシュ・末尾スラッシュを除く。
+    page#a / page#b / page/ / page?x=1 は同じ page になる
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    port = _DEFAULT_PORTS.get(scheme)
+    if port and netloc.endswith(port):
+        netloc = netloc[: -len(port)]
+    path = re.sub(r"/{2,}", "/", parts.path)
+    if len(path) > 1:
+        path = path.rstrip("/")
+    return urlunsplit((scheme, netloc, path or "/", "", ""))
+
+
+def canonical_links(urls: Iterable[str]) -> list[str]:
+    """正規化して許可 URL だけを残し、順序を保って重複除去"""
+    out = []
+    seen = set()
+    for u in urls:
+        c = canonicalize_url(u)
+        if c not in seen and is_allowed(c):
+            seen.add(c)
+            out.append(c)
+    return out
+
+
+def url_duplicate_report(urls: Iterable[str], examples: int = 5) -> dict:
+    """
+    既存 URL 群のうち、正規化すると同じになる行の数（= 正規化で減る取得数・行数）。
+    return: {"rows", "canonical", "duplicates", "examples": [(正規形, [元 URL...]), ...]}
+    """
+    groups: dict[str, list[str]] = {}
+    rows = 0
+    for u in urls:
+        rows += 1
+        groups.setdefault(canonicalize_url(u), []).append(u)
+    dup_groups = sorted(
+        ((c, us) for c, us in groups.items() if len(us) > 1), key=lambda g: -len(g[1])
+    )
+    return {
+        "rows": rows,
+        "canonical": len(groups),
+        "duplicates": rows - len(groups),
+        "examples": dup_groups[:examples],
+    }
+
+
 def detect_lang(url: str) -> str:
     parts = urlparse(url).path.split("/")
     return parts[3] if len(parts) >= 4 else "unknown"
 
 
-async def fetch_text(client: httpx.AsyncClient, url: str, accept_any_text: bool = False) -> str | None:
+# 再試行・同時数の削減対象（0 は通信エラー・タイムアウト）
+RETRY_STATUS = frozenset({0, 429, 500, 502, 503, 504})
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After（秒 or HTTP-date）を待ち秒数に。CFG.max_retry_after で打ち切り"""
+    if not value:
+        return None
+    value = value.strip()
     try:
-        r = await client.get(url, headers=UA, timeout=20, follow_redirects=True)
-        if r.status_code != 200:
+        sec = float(value)
+    except ValueError:
+        try:
+            sec = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
             return None
+    return min(max(sec, 0.0), CFG.max_retry_after)
+
+
+def retry_delay(attempt: int, retry_after: float | None = None) -> float:
+    """再試行までの待ち秒。Retry-After があれば従い、なければ指数バックオフの full jitter"""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, CFG.retry_backoff)
+    return random.uniform(0, CFG.retry_backoff * (2 ** attempt))
+
+
+class HostLimiter:
+    """
+    1 ホスト分の AIMD 同時数制限。
+    成功かつ latency_target 以内なら limit += 1/limit（limit 件の成功でおよそ +1）、
+    429 / 5xx / タイムアウトなら limit *= aimd_decrease。同じ混雑で in-flight がまとめて失敗しても
+    下げるのは平滑化 RTT に 1 回まで。Retry-After の間は新規リクエストを出さない。
+    枠を持っている数（active）と枠の数（int(limit)）の時間積分を active_area / limit_area に取る
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.limit = float(min(max(CFG.concurrency, CFG.min_concurrency), CFG.max_concurrency))
+        self.active = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.peak = self.limit
+        self._srtt = 0.0
+        self._last_decrease = 0.0
+        self._blocked_until = 0.0
+        self._freed = asyncio.Event()
+        self.active_area = 0.0
+        self.limit_area = 0.0
+        self._since = time.monotonic()
+
+    def _tick(self) -> None:
+        """active / limit を変える前に、前回からの分を時間積分に足す"""
+        now = time.monotonic()
+        self.active_area += self.active * (now - self._since)
+        self.limit_area += int(self.limit) * (now - self._since)
+        self._since = now
+
+    async def acquire(self) -> None:
+        while True:
+            wait = self._blocked_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            if self.active < int(self.limit):
+                self._tick()
+                self.active += 1
+                self.requests += 1
+                return
+            self._freed.clear()
+            await self._freed.wait()
+
+    def abandon(self) -> None:
+        """結果を待たずに枠を返す（キャンセル時・使わなかった枠）。limit は変えない"""
+        self._tick()
+        self.active -= 1
+        self._freed.set()
+
+    def release(self, status: int, latency: float, retry_after: float | None = None) -> None:
+        self.abandon()
+        now = time.monotonic()
+        if status in RETRY_STATUS:
+            self.throttled += 1
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            if now - self._last_decrease >= max(self._srtt, latency):
+                old = self.limit
+                self.limit = max(float(CFG.min_concurrency), self.limit * CFG.aimd_decrease)
+                self._last_decrease = now
+                note = f", retry-after {retry_after:.0f}s" if retry_after else ""
+                print(f"limiter: {self.host} {status or 'error'} → limit {old:.1f} → {self.limit:.1f}{note}")
+            return
+        self._srtt = latency if not self._srtt else 0.8 * self._srtt + 0.2 * latency
+        if latency <= CFG.latency_target:
+            self.limit = min(float(CFG.max_concurrency), self.limit + 1 / self.limit)
+            self.peak = max(self.peak, self.limit)
+
+    def describe(self) -> str:
+        return (
+            f"{self.host} limit {self.limit:.1f} (peak {self.peak:.1f}), active {self.active}, "
+            f"srtt {self._srtt * 1000:.0f}ms, throttled {self.throttled}, retries {self.retries}"
+        )
+
+
+class AdaptiveLimiter:
+    """ホストごとの HostLimiter。fetch_page(limiter=...) に渡す"""
+
+    def __init__(self):
+        self.hosts: dict[str, HostLimiter] = {}
+
+    def for_url(self, url: str) -> HostLimiter:
+        host = urlparse(url).netloc
+        lim = self.hosts.get(host)
+        if lim is None:
+            lim = self.hosts[host] = HostLimiter(host)
+        return lim
+
+    def describe(self) -> str:
+        return "; ".join(lim.describe() for lim in self.hosts.values())
+
+    def areas(self) -> tuple[float, float]:
+        """全ホストの (active_area, limit_area)。平均 in-flight と枠の利用率に使う"""
+        for lim in self.hosts.values():
+            lim._tick()
+        return (
+            sum(lim.active_area for lim in self.hosts.values()),
+            sum(lim.limit_area for lim in self.hosts.values()),
+        )
+
+
+async def fetch_page(
+    client: httpx.AsyncClient,
+    url: str,
+    accept_any_text: bool = False,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    limiter: AdaptiveLimiter | None = None,
+    held: bool = False,
+) -> tuple[int, str | None, str | None, str | None]:
+    """
+    条件付き GET。etag / last_modified があれば If-None-Match / If-Modified-Since を付ける。
+    return: (status, text, etag, last_modified)。304 や非 200・対象外 content-type は text=None。
+    通信エラーと replay でアーカイブに無い URL（MISS_HEADER）は status=0
+    limiter を渡すとホストごとの同時数制限に従い、429 / 5xx / 通信エラーは CFG.fetch_retries 回まで再試行。
+    held=True は最初の試行の枠を呼び出し側が acquire 済み（crawl が枠を取ってから URL を取り出す）
+    """
+    headers = dict(UA)
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    host = limiter.for_url(url) if limiter is not None else None
+    attempts = CFG.fetch_retries + 1 if host is not None else 1
+    r = None
+    for attempt in range(attempts):
+        if host is not None and not (held and attempt == 0):
+            await host.acquire()
+        t0 = time.perf_counter()
+        retry_after = None
+        try:
+            r = await client.get(url, headers=headers, timeout=20, follow_redirects=True)
+            status = r.status_code
+            retry_after = parse_retry_after(r.headers.get("retry-after"))
+        except asyncio.CancelledError:
+            if host is not None:
+                host.abandon()
+            raise
+        except Exception:
+            r = None
+            status = 0
+        if host is not None:
+            host.release(status, time.perf_counter() - t0, retry_after)
+        if status not in RETRY_STATUS or attempt + 1 == attempts:
+            break
+        host.retries += 1
+        await asyncio.sleep(retry_delay(attempt, retry_after))
+    if r is None or MISS_HEADER in r.headers:
+        # アーカイブに無いのはページが消えたのではなく記録していないだけ（404 扱いにすると GC で消える）
+        return 0, None, None, None
+    try:
+        if r.status_code != 200:
+            return r.status_code, None, None, None
         ctype = (r.headers.get("content-type") or "").lower()
         allowed = (
             "text/html" in ctype or "application/xml" in ctype or "text/xml" in ctype or
             (accept_any_text and ("text/" in ctype or "application/" in ctype or not ctype))
         )
         if not allowed:
-            return None
-        return r.text
+            return r.status_code, None, None, None
+        return r.status_code, r.text, r.headers.get("etag"), r.headers.get("last-modified")
     except Exception:
+        return 0, None, None, None
+
+
+async def fetch_text(client: httpx.AsyncClient, url: str, accept_any_text: bool = False) -> str | None:
+    _, text, _, _ = await fetch_page(client, url, accept_any_text=accept_any_text)
+    return text
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+_SITEMAP_NS = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+
+
+def parse_lastmod(value: str | None) -> int | None:
+    """sitemap の <lastmod>（W3C Datetime）を epoch 秒に。日付のみ・タイムゾーンなしは UTC 扱い"""
+    if not value:
+        return None
+    v = value.strip()
+    if v.endswith("Z"):
+        v = v[:-1] + "+00:00"
+    try:
+        dt = datetime.fromisoformat(v)
+    except ValueError:
         return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
 
 
-async def try_sitemap(client: httpx.AsyncClient) -> list[str] | None:
+def _sitemap_url_entries(root) -> list[tuple[str, int | None]]:
+    out = []
+    for node in root.xpath("//sm:url", namespaces=_SITEMAP_NS):
+        loc = node.xpath("string(sm:loc)", namespaces=_SITEMAP_NS).strip()
+        if not loc:
+            continue
+        loc = canonicalize_url(loc)
+        if not is_allowed(loc):
+            continue
+        lastmod = node.xpath("string(sm:lastmod)", namespaces=_SITEMAP_NS)
+        out.append((loc, parse_lastmod(lastmod)))
+    return out
+
+
+async def fetch_sitemap_entries(client: httpx.AsyncClient) -> list[tuple[str, int | None]] | None:
+    """
+    sitemap.xml（sitemap index なら配下の sitemap を並行取得）から (url, lastmod epoch) を返す。
+    取得・パース失敗や対象 URL 0 件は None
+    """
     sitemap_url = f"https://{CFG.host}/sitemap.xml"
     xml = await fetch_text(client, sitemap_url)
     if not xml:
@@ -70,26 +385,45 @@ async def try_sitemap(client: httpx.AsyncClient) -> list[str] | None:
     except Exception:
         return None
 
-    ns = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+    locs = root.xpath("//sm:sitemap/sm:loc/text()", namespaces=_SITEMAP_NS)
+    if not locs:
+        return _sitemap_url_entries(root) or None
+
+    sem = asyncio.Semaphore(CFG.concurrency)
+
+    async def fetch_sub(loc: str) -> list[tuple[str, int | None]]:
+        async with sem:
+            sub_xml = await fetch_text(client, loc.strip())
+        if not sub_xml:
+            return []
+        try:
+            return _sitemap_url_entries(etree.fromstring(sub_xml.encode("utf-8")))
+        except Exception:
+            return []
+
+    entries: list[tuple[str, int | None]] = []
+    for sub in await asyncio.gather(*(fetch_sub(loc) for loc in locs)):
+        entries.extend(sub)
+    return entries or None
+
+
+async def try_sitemap(client: httpx.AsyncClient) -> list[str] | None:
+    entries = await fetch_sitemap_entries(client)
+    if not entries:
+        return None
+    return [u for u, _ in entries]
 
-    locs = root.xpath("//sm:sitemap/sm:loc/text()", namespaces=ns)
-    urls: list[str] = []
-    if locs:
-        for loc in locs:
-            sub_xml = await fetch_text(client, loc)
-            if not sub_xml:
-                continue
-            try:
-                sub_root = etree.fromstring(sub_xml.encode("utf-8"))
-            except Exception:
-                continue
-            sub_urls = sub_root.xpath("//sm:url/sm:loc/text()", namespaces=ns)
-            urls.extend([u for u in sub_urls if is_allowed(u)])
-        return urls or None
 
-    sub_urls = root.xpath("//sm:url/sm:loc/text()", namespaces=ns)
-    urls = [u for u in sub_urls if is_allowed(u)]
-    return urls or None
+def select_changed(
+    entries: list[tuple[str, int | None]], fetched_at: dict[str, int]
+) -> list[str]:
+    """lastmod が最後の確認時刻（load_fetched_at）より新しい・未取得・lastmod なしの URL（重複除去）"""
+    out = []
+    for url, lastmod in entries:
+        prev = fetched_at.get(url)
+        if prev is None or lastmod is None or lastmod > prev:
+            out.append(url)
+    return list(dict.fromkeys(out))
 
 
 # llms.txt 内の [text](url) から URL を抽出する正規表現
@@ -133,140 +467,599 @@ def extract_helm_page_links(sidebar_content: str) -> list[str]:
 
 def extract_nav_links(base_url: str, html: str) -> list[str]:
     soup = BeautifulSoup(html, "lxml")
-    out = []
-    seen = set()
-    for a in soup.find_all("a", href=True):
-        href = a["href"].strip()
-        full_url = urljoin(base_url, href)
-        if not is_allowed(full_url):
-            continue
-        if full_url in seen:
-            continue
-        seen.add(full_url)
-        out.append(full_url)
-    return out
+    return canonical_links(urljoin(base_url, a["href"].strip()) for a in soup.find_all("a", href=True))
 
 
-async def ingest_helm_release_notes(conn, client: httpx.AsyncClient) -> int:
-    """dify-helm release notes をインデックスに追加"""
+async def ingest_helm_release_notes(
+    client: httpx.AsyncClient,
+    writer: BulkWriter,
+    validators: dict[str, tuple[str | None, str | None, str | None]] | None = None,
+) -> int | None:
+    """
+    dify-helm release notes をインデックスに追加。書いたページ数を返す（_sidebar.md が取れなければ None）。
+    _sidebar.md の各ページを crawl と同じパイプライン（並行 fetch → 抽出 → バッチ書き込み）で取得する。
+    validators を渡すと本体クロールと同じく未変更ページをスキップ
+    """
     base = CFG.helm_release_base
     sidebar_url = f"{base}/_sidebar.md"
 
     sidebar = await fetch_text(client, sidebar_url, accept_any_text=True)
     if not sidebar:
         print("Note: dify-helm _sidebar.md fetch failed, skipping release notes.")
-        return 0
+        return None
 
     urls = extract_helm_page_links(sidebar)
     urls.append(f"{base}/README.md")
     urls = list(dict.fromkeys(urls))
 
-    count = 0
-    now = int(time.time())
-    lang = "en-us"
+    return await crawl(
+        client, writer, urls, validators,
+        max_depth=0, extract=extract_helm_record, log_prefix="helm+",
+    )
 
-    for url in urls:
-        md = await fetch_text(client, url, accept_any_text=True)
-        if not md:
-            continue
-        title, hpath, lead = extract_index_fields_markdown(md)
-        headings, body_prefix = extract_headings_and_body_prefix_markdown(md, body_prefix_len=4000)
-        ngrams_source = f"{title}\n{hpath}\n{lead}\n{headings}\n{body_prefix}"
-        ngrams = make_ngrams(ngrams_source)
-        upsert_page(conn, url, lang, title, hpath, lead, headings, body_prefix, ngrams, now)
-        count += 1
-        print(f"[helm+{count}] {url}")
 
-    return count
+def extract_helm_record(url: str, raw: str) -> tuple[tuple, list[str], list[dict], tuple[str, float]]:
+    """release note（Markdown）1 件分を抽出。extract_record と同じ形で返す（リンクは辿らない）"""
+    t0 = time.perf_counter()
+    title, hpath, lead = extract_index_fields_markdown(raw)
+    headings, body_prefix = extract_headings_and_body_prefix_markdown(raw, body_prefix_len=4000)
+    ngrams_source = f"{title}\n{hpath}\n{lead}\n{headings}\n{body_prefix}"
+    ngrams = make_ngrams(ngrams_source)
+    fields = (url, "en-us", title, hpath, lead, headings, body_prefix, ngrams)
+    # BM25 の統計は抽出プロセス側で計算しておく（書き込みタスクを詰まらせない）
+    sections = with_section_stats(extract_sections_markdown(raw))
+    return fields, [], sections, ("markdown", (time.perf_counter() - t0) * 1000)
 
 
-def make_ngrams(text: str, ns=(2, 3), limit=4000) -> str:
-    s = "".join(text.split())
-    toks = []
-    for n in ns:
-        if len(s) < n:
-            continue
-        for i in range(len(s) - n + 1):
-            toks.append(s[i:i+n])
-    if len(toks) > limit:
-        toks = toks[:limit]
-    return " ".join(toks)
+def extract_record(url: str, raw: str) -> tuple[tuple, list[str], list[dict], tuple[str, float]]:
+    """
+    取得した 1 ページ分（HTML or Markdown）を抽出。
+    return: (upsert 用の (url, lang, title, hpath, lead, headings, body_prefix, ngrams), ナビリンク,
+    /ask 用のセクション, (抽出経路 mintlify / readability / markdown, 抽出 ms))
+    HTML は extract_page で 1 回だけパースする
+    """
+    t0 = time.perf_counter()
+    lang = detect_lang(url)
+    is_md = not raw.lstrip().startswith("<")
+    if is_md:
+        via = "markdown"
+        title, hpath, lead = extract_index_fields_markdown(raw)
+        links = extract_nav_links(url, raw)
+        sections = extract_sections_markdown(raw)
+    else:
+        page = extract_page(raw, base_url=url, body_prefix_len=4000)
+        via = page["via"]
+        title, hpath, lead = page["title"], page["hpath"], page["lead"]
+        links = canonical_links(page["nav_links"])
+        sections = page["sections"]
+    headings = ""
+    body_prefix = ""
+    ngrams = ""
+    if lang in ("ja-jp", "zh-cn"):
+        if is_md:
+            headings, body_prefix = extract_headings_and_body_prefix_markdown(raw, body_prefix_len=4000)
+        else:
+            headings, body_prefix = page["headings"], page["body_prefix"]
+        # trigram モードの言語は pages_tri が索引するので ngrams 列は空
+        if cjk_index_mode(lang) == "ngram":
+            ngrams_source = f"{title}\n{hpath}\n{lead}\n{headings}\n{body_prefix}"
+            ngrams = make_ngrams(ngrams_source)
+    fields = (url, lang, title, hpath, lead, headings, body_prefix, ngrams)
+    return fields, links, with_section_stats(sections), (via, (time.perf_counter() - t0) * 1000)
 
 
-async def main() -> None:
-    db_path = CFG.db_path
-    parent = Path(db_path).parent
-    if parent:
-        parent.mkdir(parents=True, exist_ok=True)
+async def crawl(
+    client: httpx.AsyncClient,
+    writer: BulkWriter,
+    initial_urls: list[str],
+    validators: dict[str, tuple[str | None, str | None, str | None]] | None = None,
+    max_depth: int | None = None,
+    extract=extract_record,
+    log_prefix: str = "",
+    checkpoint: CrawlCheckpoint | None = None,
+    stats: dict | None = None,
+) -> int:
+    """
+    enterprise docs を BFS でクロールして writer に書く。書いたページ数を返す。
 
-    conn = open_db(db_path)
+    validators（url → (etag, last_modified, content_hash)）を渡すと差分モード:
+    条件付き GET で 304 はスキップ、200 でも content_hash が同じなら抽出・書き込みしない。
+    未変更ページのリンクは展開しないので、initial_urls に既知 URL を含めること。
+    max_depth 未指定は CFG.max_depth（0 ならリンクを辿らず initial_urls だけ取得）
+    extract はプロセスプールに渡すのでモジュールレベル関数にする（extract_record と同じ戻り値）。
+    抽出経路ごとのページ数・平均 ms を進捗行に出す
+    checkpoint を渡すと crawl_state に保存済みの状態から再開し、取得を終えた URL が
+    CFG.checkpoint_every 件増えるごとに writer を flush して状態を保存する
+    stats を渡すと fetches / errors（200・304・404・410 以外で終わった fetch）/ extract_errors を入れる（完走判定用）
+
+    fetch（async ワーカー CFG.concurrency 本。バッチ待ちなしで常に埋める。
+    CFG.adaptive_concurrency なら CFG.max_concurrency 本を AdaptiveLimiter がホストごとに絞る）→ raw_q（上限 CFG.extract_queue_size）→
+    抽出（ProcessPoolExecutor, CFG.extract_workers。0 ならイベントループ上で実行）→
+    out_q → 書き込み（単一タスク。frontier へのリンク追加もここ）
+    """
+    loop = asyncio.get_running_loop()
+    limiter = AdaptiveLimiter() if CFG.adaptive_concurrency else None
+    n_workers = CFG.max_concurrency if limiter is not None else CFG.concurrency
+    if max_depth is None:
+        max_depth = CFG.max_depth
+    # (depth, 追加順, url) の heap。並行取得でも浅いページから取り出す（BFS 順を保つ）
+    seq = itertools.count()
+    # 入口 URL も正規化（seed / llms.txt / sitemap / 既存 DB の URL に揺れがあっても 1 回だけ取得）
+    initial_urls = list(dict.fromkeys(canonicalize_url(u) for u in initial_urls))
+    frontier: list[tuple[int, int, str]] = [(0, next(seq), u) for u in initial_urls]
     done: set[str] = set()
+    # 各 URL の最小 depth と、書き込み済みページのリンク。
+    # 並行取得では深い経路で先に取得されることがあるので、後から浅い経路が見つかったら
+    # リンクを depth を詰め直して展開する（バッチ BFS と同じ到達範囲になる）
+    best_depth: dict[str, int] = {u: 0 for u in initial_urls}
+    links_of: dict[str, tuple[str, ...]] = {}
     count = 0
+    if checkpoint is not None:
+        saved_frontier, visited, count = checkpoint.load()
+        done.update(visited)
+        for u, d in saved_frontier.items():
+            if d < best_depth.get(u, d + 1):
+                best_depth[u] = d
+                frontier.append((d, next(seq), u))
+        heapq.heapify(frontier)
+        for u in initial_urls:
+            if u not in done:
+                checkpoint.mark(u, best_depth[u], CrawlCheckpoint.PENDING)
+        if visited or saved_frontier:
+            print(f"resume: 書き込み済み {count} / 取得済み {len(visited)} / frontier {len(saved_frontier)} 件")
+    raw_q: asyncio.Queue = asyncio.Queue(maxsize=CFG.extract_queue_size)
+    out_q: asyncio.Queue = asyncio.Queue()
+    wake = asyncio.Event()  # frontier にリンクが増えた / pipeline が空いた
+    stages: list[asyncio.Task] = []
+    pending = 0  # fetch 済みでまだ書き込みが終わっていないページ数
+    # 計測: fetch 数と in-flight 数の時間積分（平均 in-flight = area / 経過時間）
+    fetches = 0
+    not_modified = 0  # 差分モード: 304
+    unchanged = 0  # 差分モード: 200 だが content_hash 一致
+    errors = 0  # 通信エラー・再試行しきれなかった 429 / 5xx・その他の非 200
+    extract_errors = 0
+    inflight = 0
+    inflight_area = 0.0
+    finished = 0  # 取得を終えた URL 数（checkpoint の間隔用）
+    extract_stats: dict[str, list[float]] = {}  # 抽出経路 → [ページ数, 合計 ms]
+    started = inflight_since = time.perf_counter()
 
-    async with httpx.AsyncClient() as client:
-        # seed_urls で BFS + llms.txt の URL を追加（両方使って網羅性を確保）
-        initial_urls = list(CFG.seed_urls)
-        llms_urls = await fetch_doc_urls_from_llms(client)
-        if llms_urls:
-            initial_urls.extend(llms_urls)
-            print(f"seed_urls + llms.txt: {len(CFG.seed_urls)} + {len(llms_urls)} → {len(initial_urls)} 件")
-        else:
-            print("llms.txt 取得失敗、seed_urls のみでクロール開始")
-        initial_urls = list(dict.fromkeys(initial_urls))  # 重複除去
-        queue: deque[tuple[str, int]] = deque((u, 0) for u in initial_urls)
-
-        while queue and count < CFG.max_pages:
-            batch = []
-            while queue and len(batch) < CFG.concurrency:
-                item = queue.popleft()
-                if item[0] in done:
-                    continue
-                done.add(item[0])
-                batch.append(item)
+    async def wait_progress() -> None:
+        """write_stage の進捗を待つ。ステージが例外で落ちていたら再送出（待ち続けない）"""
+        wake.clear()
+        waiter = asyncio.ensure_future(wake.wait())
+        finished, _ = await asyncio.wait([waiter, *stages], return_when=asyncio.FIRST_COMPLETED)
+        if waiter not in finished:
+            waiter.cancel()
+        for t in stages:
+            if t.done():
+                t.result()
 
-            if not batch:
-                break
+    def track_inflight(delta: int) -> None:
+        nonlocal inflight, inflight_area, inflight_since
+        now = time.perf_counter()
+        inflight_area += inflight * (now - inflight_since)
+        inflight_since = now
+        inflight += delta
 
-            tasks = [fetch_text(client, url, accept_any_text=True) for url, depth in batch]
-            results = await asyncio.gather(*tasks)
-            now = int(time.time())
+    def finish(url: str, depth: int, status: int) -> None:
+        """URL の処理完了を checkpoint に記録。CFG.checkpoint_every 件ごとに保存"""
+        nonlocal finished
+        if checkpoint is None:
+            return
+        checkpoint.mark(url, depth, status)
+        finished += 1
+        if finished % CFG.checkpoint_every == 0:
+            # 書き込み済みと記録する前にページ本体を確定させる
+            writer.flush()
+            checkpoint.save()
 
-            for (url, depth), raw in zip(batch, results):
-                if not raw:
+    async def fetch_worker() -> None:
+        """
+        frontier から 1 件ずつ取り出して fetch。常に最大 n_workers 件（limiter があればその limit まで）が in-flight になる。
+        limiter があれば枠を取ってから frontier の先頭を取り出す（枠を待つ間に浅い URL が入っても先に取る）
+        """
+        nonlocal pending, fetches, not_modified, unchanged, errors
+        while True:
+            if count + pending + inflight >= CFG.max_pages:
+                if pending + inflight == 0:
+                    return
+                # in-flight / 書き込み待ちが失敗すると枠が空くので待つ
+                await wait_progress()
+                continue
+            host = None
+            if limiter is not None and frontier:
+                host = limiter.for_url(frontier[0][2])
+                await host.acquire()
+            item = None
+            # 枠を待つ間に他のワーカーが max_pages まで埋めていたら取り出さない
+            while frontier and count + pending + inflight < CFG.max_pages:
+                _, _, cand = heapq.heappop(frontier)
+                if cand not in done:
+                    item = (cand, best_depth[cand])
+                    break
+            if item is None:
+                if host is not None:
+                    host.abandon()
+                if frontier or count + pending + inflight >= CFG.max_pages:
                     continue
-                lang = detect_lang(url)
-                is_md = not raw.lstrip().startswith("<")
-                if is_md:
-                    title, hpath, lead = extract_index_fields_markdown(raw)
+                if pending + inflight == 0:
+                    return
+                # 抽出・書き込み待ちのページからリンクが増えるのを待つ
+                await wait_progress()
+                continue
+
+            url, depth = item
+            if host is not None and limiter.for_url(url) is not host:
+                # 先頭が別ホストに入れ替わった。枠は fetch_page が取り直す
+                host.abandon()
+                host = None
+            done.add(url)
+            fetches += 1
+            known = validators.get(url) if validators is not None else None
+            track_inflight(+1)
+            try:
+                status, raw, etag, last_modified = await fetch_page(
+                    client, url, accept_any_text=True,
+                    etag=known[0] if known else None,
+                    last_modified=known[1] if known else None,
+                    limiter=limiter,
+                    held=host is not None,
+                )
+            finally:
+                track_inflight(-1)
+            if status not in (200, 304, 404, 410):
+                errors += 1
+            chash = content_hash(raw) if raw else None
+            checked = False
+            if status == 304:
+                not_modified += 1
+                raw = None
+                checked = True
+            elif raw and known and known[2] == chash:
+                unchanged += 1
+                raw = None
+                checked = True
+            if raw:
+                pending += 1
+                await raw_q.put((url, depth, raw, (etag, last_modified, chash)))
+            else:
+                if status not in (404, 410):
+                    # 304・未変更・一時的な失敗はページが残っているので stale GC の対象にしない。
+                    # 304・未変更は確認時刻も残す（sitemap の lastmod だけ進んだページを毎回取り直さない）
+                    writer.touch(url, checked=checked)
+                finish(url, depth, CrawlCheckpoint.VISITED)
+                wake.set()
+
+    async def extract_stage(pool: ProcessPoolExecutor | None) -> None:
+        nonlocal extract_errors
+        while True:
+            url, depth, raw, validator = await raw_q.get()
+            try:
+                if pool is None:
+                    result = extract(url, raw)
                 else:
-                    title, hpath, lead = extract_index_fields(raw)
-                headings = ""
-                body_prefix = ""
-                ngrams = ""
-                if lang in ("ja-jp", "zh-cn"):
-                    if is_md:
-                        headings, body_prefix = extract_headings_and_body_prefix_markdown(
-                            raw, body_prefix_len=4000
-                        )
-                    else:
-                        headings, body_prefix = extract_headings_and_body_prefix(
-                            raw, body_prefix_len=4000
-                        )
-                    ngrams_source = f"{title}\n{hpath}\n{lead}\n{headings}\n{body_prefix}"
-                    ngrams = make_ngrams(ngrams_source)
-                upsert_page(conn, url, lang, title, hpath, lead, headings, body_prefix, ngrams, now)
+                    result = await loop.run_in_executor(pool, extract, url, raw)
+            except Exception as e:
+                print(f"extract failed: {url}: {e}")
+                extract_errors += 1
+                result = None
+            await out_q.put((url, result, validator))
+
+    def reach(url: str, depth: int) -> None:
+        """url に depth で到達。最小 depth を更新し、未取得なら frontier、書き込み済みならリンクを再展開"""
+        if best_depth.get(url, depth + 1) <= depth:
+            return
+        best_depth[url] = depth
+        if url in links_of:
+            if depth < max_depth:
+                for link in links_of[url]:
+                    reach(link, depth + 1)
+        elif url not in done:
+            heapq.heappush(frontier, (depth, next(seq), url))
+            if checkpoint is not None:
+                checkpoint.mark(url, depth, CrawlCheckpoint.PENDING)
+        # 取得中・抽出中のページは書き込み時に best_depth を使う
+
+    async def write_stage() -> None:
+        nonlocal count, pending
+        while True:
+            url, result, (etag, last_modified, chash) = await out_q.get()
+            if result is None:
+                writer.touch(url)
+                finish(url, best_depth[url], CrawlCheckpoint.VISITED)
+            else:
+                fields, links, sections, (via, ms) = result
+                writer.add(
+                    *fields, int(time.time()),
+                    etag=etag, last_modified=last_modified, content_hash=chash, sections=sections,
+                )
                 count += 1
-                print(f"[{count}] {url}")
+                st = extract_stats.setdefault(via, [0, 0.0])
+                st[0] += 1
+                st[1] += ms
+                print(f"[{log_prefix}{count}] {url} ({via} {ms:.1f}ms)")
+                if count % 100 == 0:
+                    print(crawl_progress())
+                links_of[url] = tuple(sys.intern(u) for u in links)
+                depth = best_depth[url]
+                if depth < max_depth:
+                    for link in links_of[url]:
+                        reach(link, depth + 1)
+                finish(url, depth, CrawlCheckpoint.WRITTEN)
+            pending -= 1
+            wake.set()
+
+    def crawl_progress() -> str:
+        track_inflight(0)
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        if limiter is not None and limiter.hosts:
+            # 枠を持っているリクエストだけを in-flight とし、そのときどきの limit に対する割合を出す
+            # （limit を待っているワーカーや再試行の待ちは数えない）
+            active_area, limit_area = limiter.areas()
+            avg = active_area / elapsed
+            slots = f"{limit_area / elapsed:.1f}"
+            ratio = active_area / max(limit_area, 1e-9)
+        else:
+            avg = inflight_area / elapsed
+            slots = str(n_workers)
+            ratio = avg / n_workers
+        line = (
+            f"crawl: {count} pages / {fetches} fetches in {elapsed:.1f}s "
+            f"({count / elapsed:.1f} pages/s), in-flight avg {avg:.1f}/{slots} ({ratio:.0%})"
+        )
+        if errors or extract_errors:
+            line += f", errors: {errors} fetch + {extract_errors} extract"
+        if extract_stats:
+            line += ", extract: " + ", ".join(
+                f"{via} {n} avg {total / n:.1f}ms" for via, (n, total) in extract_stats.items()
+            )
+        if limiter is not None and limiter.hosts:
+            line += f", limiter: {limiter.describe()}"
+        if validators is not None:
+            line += f", skipped: {not_modified} not-modified + {unchanged} unchanged"
+        if checkpoint is not None:
+            line += (
+                f", checkpoint: {checkpoint.saves} saves / {checkpoint.rows} rows "
+                f"in {checkpoint.seconds * 1000:.0f}ms"
+            )
+        return line
+
+    workers = CFG.extract_workers
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    stages.extend(asyncio.create_task(extract_stage(pool)) for _ in range(max(1, workers)))
+    stages.append(asyncio.create_task(write_stage()))
+    try:
+        await asyncio.gather(*(fetch_worker() for _ in range(n_workers)))
+        # fetch 済みのページがすべて書き込まれるまで待つ
+        while pending:
+            await wait_progress()
+    finally:
+        for t in stages:
+            t.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        writer.flush()
+        if checkpoint is not None:
+            checkpoint.save()
+    print(crawl_progress())
+    if stats is not None:
+        stats.update(fetches=fetches, errors=errors, extract_errors=extract_errors)
+    return count
 
-                if depth < CFG.max_depth:
-                    for link in extract_nav_links(url, raw):
-                        if link not in done:
-                            queue.append((link, depth + 1))
 
-        helm_count = await ingest_helm_release_notes(conn, client)
+def crawl_failure(stats: dict) -> str | None:
+    """
+    crawl の stats から、完走扱いにできない理由を返す（問題なければ None）。
+    失敗したページのリンク先は辿れていないので、見えなかったページを GC で消してしまう。
+    抽出の失敗は 1 件でも、取得の失敗は CFG.crawl_max_error_fraction を超えたら完走にしない
+    """
+    if stats["extract_errors"]:
+        return f"抽出失敗 {stats['extract_errors']} 件"
+    fraction = stats["errors"] / max(stats["fetches"], 1)
+    if fraction > CFG.crawl_max_error_fraction:
+        return (
+            f"取得失敗 {stats['errors']} / {stats['fetches']} 件（{fraction:.1%}）が "
+            f"crawl_max_error_fraction（{CFG.crawl_max_error_fraction:.0%}）を超えた"
+        )
+    return None
+
+
+def print_gc_report(report: dict) -> None:
+    """gc_stale_pages の結果を表示（ingest --gc / docbot gc 共通）"""
+    status = report["status"]
+    if status == "no_complete_crawl":
+        print("stale GC: 完走したクロールがまだないためスキップ")
+        return
+    by_lang = ", ".join(f"{k}: {v}" for k, v in sorted(report["by_lang"].items()))
+    print(
+        f"stale GC (crawl {report['crawl_id']}): {report['stale']} / {report['total']} 行 "
+        f"({report['fraction']:.1%})" + (f" [{by_lang}]" if by_lang else "")
+    )
+    for url in report["examples"]:
+        print(f"  - {url}")
+    if status == "dry_run":
+        print("dry-run: 削除していません")
+    elif status == "aborted":
+        print(
+            f"中止: 削除対象が gc_max_fraction（{CFG.gc_max_fraction:.0%}）を超えています。"
+            "確認のうえ --force で実行してください"
+        )
+    elif status == "deleted":
+        print(f"削除しました（{report['stale']} 行）。pages_fts / pages_tri を optimize 済み")
+
+
+async def _crawl_bfs(
+    client: httpx.AsyncClient,
+    writer: BulkWriter,
+    validators: dict[str, tuple[str | None, str | None, str | None]] | None,
+    checkpoint: CrawlCheckpoint | None = None,
+    stats: dict | None = None,
+) -> int:
+    # seed_urls で BFS + llms.txt の URL を追加（両方使って網羅性を確保）
+    initial_urls = list(CFG.seed_urls)
+    llms_urls = await fetch_doc_urls_from_llms(client)
+    if llms_urls:
+        initial_urls.extend(llms_urls)
+        print(f"seed_urls + llms.txt: {len(CFG.seed_urls)} + {len(llms_urls)} → {len(initial_urls)} 件")
+    else:
+        print("llms.txt 取得失敗、seed_urls のみでクロール開始")
+    if validators is not None:
+        # 未変更ページのリンクは展開しないので、既知 URL も入口にする
+        known_urls = [u for u in validators if is_allowed(u)]
+        initial_urls.extend(known_urls)
+        print(f"incremental: 既知 URL {len(known_urls)} 件を追加")
+    initial_urls = list(dict.fromkeys(initial_urls))  # 重複除去
+    return await crawl(client, writer, initial_urls, validators, checkpoint=checkpoint, stats=stats)
+
+
+async def main(
+    incremental: bool = False,
+    sitemap_delta: bool = False,
+    helm_only: bool = False,
+    resume: bool = False,
+    archive_mode: str | None = None,
+    archive_dir: str | None = None,
+    gc: bool = False,
+    gc_dry_run: bool = False,
+    publish: bool = False,
+) -> None:
+    """
+    incremental=True: 既存 DB の ETag / Last-Modified / content_hash を使った差分クロール。
+    変更ページだけ抽出・書き込みする（bulk build は使わない）
+    sitemap_delta=True: sitemap の lastmod が fetched_at より新しい URL だけを取得（リンクは辿らない）。
+    sitemap が取れなければ incremental の BFS にフォールバック
+    helm_only=True: enterprise docs はクロールせず dify-helm release notes だけ更新（bulk build なし）
+    resume=True: 前回中断した BFS クロールを crawl_state（frontier / 取得済み URL）から再開
+    archive_mode="record": 取得したレスポンスを archive_dir に保存 / "replay": archive_dir だけから取得（ネットワークなし）
+    gc=True: BFS クロールを完走したら、その世代で見えなかったページを削除（gc_dry_run=True なら報告のみ）
+    publish=True: 配信中の DB ではなく作業用 DB（data/index.build.db）に書き、終わったらスナップショットを
+    data/index.db のリンク差し替えで公開する（サーバーは止めずに切り替わる）
+    """
+    incremental = incremental or sitemap_delta
+    if not publish and is_published(CFG.db_path):
+        print(f"ERROR: {CFG.db_path} は --publish で公開したスナップショットです。--publish を付けて作業用 DB に書いてください", file=sys.stderr)
+        return
+    db_path = build_db_path(CFG.db_path) if publish else CFG.db_path
+    parent = Path(db_path).parent
+    if parent:
+        parent.mkdir(parents=True, exist_ok=True)
+    if publish and seed_build_db(db_path, CFG.db_path):
+        print(f"publish: 配信中の DB を作業用 DB {db_path} にコピー")
+
+    conn = open_db(db_path)
+    if not resume:
+        CrawlCheckpoint(conn).clear()
+    validators = load_validators(conn) if incremental else None
+    crawl_id = begin_crawl(conn, resume=resume)
+    checkpoint = CrawlCheckpoint(conn, crawl_id)
+    writer = BulkWriter(
+        conn,
+        batch_size=CFG.write_batch_size,
+        bulk_build=CFG.ingest_bulk_build and not incremental and not helm_only,
+        crawl_id=crawl_id,
+    )
+    count = 0
+    helm_count = 0
+    helm_ok = False
+    bfs_complete = False
+    archive = None
+    transport = None
+    if archive_mode:
+        archive = ResponseArchive(archive_dir or CFG.archive_dir)
+        transport = ArchiveTransport(archive, archive_mode)
+        print(f"archive: {archive_mode} {archive.root}")
+
+    try:
+        async with httpx.AsyncClient(transport=transport) as client:
+            if helm_only:
+                print("helm-only: enterprise docs のクロールをスキップ")
+            elif sitemap_delta and (entries := await fetch_sitemap_entries(client)):
+                changed = select_changed(entries, load_fetched_at(conn))
+                print(f"sitemap: {len(entries)} 件中 {len(changed)} 件が更新対象")
+                count = await crawl(client, writer, changed, validators, max_depth=0)
+            else:
+                if sitemap_delta:
+                    print("sitemap 取得失敗、BFS（incremental）にフォールバック")
+                stats: dict = {}
+                count = await _crawl_bfs(client, writer, validators, checkpoint, stats=stats)
+                # max_pages で打ち切った場合や、失敗したページが多い場合は未到達のページがありうるので完走扱いにしない
+                failure = crawl_failure(stats)
+                if failure:
+                    print(f"crawl {crawl_id}: 完走扱いにしない（{failure}）")
+                bfs_complete = count < CFG.max_pages and failure is None
+                # 最後まで終わったので再開用の状態は不要
+                checkpoint.clear()
+            helm_count = await ingest_helm_release_notes(client, writer, validators)
+            # --incremental では書き換えた release notes だけを数えるので 0 件でも取得はできている
+            helm_ok = helm_count is not None
+            helm_count = helm_count or 0
+    finally:
+        # 途中で落ちても書けた分は残し、FTS を整合させる
+        t0 = time.perf_counter()
+        writer.close()
+        if writer.bulk_build:
+            print(f"FTS rebuild: {time.perf_counter() - t0:.1f}s")
+        if archive is not None:
+            archive.close()
+            if archive_mode == "record":
+                print(f"archive: {archive.recorded} responses recorded")
+            else:
+                print(f"archive: {archive.hits} hits / {archive.misses} misses")
+    print(f"Written: {writer.written} rows in {writer.batches} batches")
+    # release notes の一覧（_sidebar.md）が取れなかった回も完走扱いにしない（全件が stale に見えるため）。
+    # replay でアーカイブに無い URL があった回は記録時のクロールを再現できていないので同じ扱い
+    replay_missed = archive_mode == "replay" and archive.misses > 0
+    if replay_missed:
+        print(f"archive: {archive.misses} 件がアーカイブに無いため完走扱いにしない")
+    if bfs_complete and helm_ok and not replay_missed:
+        complete_crawl(conn, crawl_id)
+        print(f"crawl {crawl_id}: 完走")
+        if gc or gc_dry_run:
+            print_gc_report(gc_stale_pages(conn, dry_run=gc_dry_run))
+    elif gc or gc_dry_run:
+        print(f"crawl {crawl_id}: 完走していないため stale GC をスキップ")
+    if publish:
+        t0 = time.perf_counter()
+        published = publish_index(conn, CFG.db_path, keep=CFG.publish_keep)
+        if published:
+            print(f"publish: {CFG.db_path} -> {os.path.basename(published)} ({time.perf_counter() - t0:.1f}s)")
+        else:
+            print("publish: 世代が変わっていないため公開をスキップ")
     conn.close()
     print(f"Done. {count} enterprise docs + {helm_count} helm release notes indexed.")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    p = argparse.ArgumentParser(prog="docbot.ingest", description="Dify Enterprise docs クロール＆インデックス作成")
+    p.add_argument("--incremental", action="store_true",
+                   help="ETag / Last-Modified / content_hash で変更ページだけ更新")
+    p.add_argument("--sitemap-delta", action="store_true",
+                   help="sitemap の lastmod が新しい URL だけ取得（失敗時は --incremental の BFS）")
+    p.add_argument("--helm-only", action="store_true",
+                   help="dify-helm release notes だけ更新（enterprise docs はクロールしない）")
+    p.add_argument("--resume", action="store_true",
+                   help="前回中断したクロールを保存済みの frontier から再開")
+    p.add_argument("--gc", action="store_true",
+                   help="完走後、今回のクロールで見えなかったページを削除（しきい値 gc_max_fraction）")
+    p.add_argument("--gc-dry-run", action="store_true", help="--gc の削除対象を表示するだけ")
+    p.add_argument("--publish", action="store_true",
+                   help="作業用 DB に書き、完了後に data/index.db を新しいスナップショットへ差し替える")
+    mode = p.add_mutually_exclusive_group()
+    mode.add_argument("--record", nargs="?", const=CFG.archive_dir, default=None, metavar="DIR",
+                      help=f"取得したレスポンスをアーカイブに保存（既定 {CFG.archive_dir}）")
+    mode.add_argument("--replay", nargs="?", const=CFG.archive_dir, default=None, metavar="DIR",
+                      help="アーカイブだけから再インデックス（ネットワークを使わない）")
+    args = p.parse_args()
+    asyncio.run(main(
+        incremental=args.incremental,
+        sitemap_delta=args.sitemap_delta,
+        helm_only=args.helm_only,
+        resume=args.resume,
+        archive_mode="record" if args.record else "replay" if args.replay else None,
+        archive_dir=args.record or args.replay,
+        gc=args.gc,
+        gc_dry_run=args.gc_dry_run,
+        publish=args.publish,
+    ))
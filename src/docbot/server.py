@@ -1,53 +1,254 @@
+import asyncio
+import json
 import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Literal
+
 import httpx
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
 from docbot.config import CFG
-from docbot.storage import open_db, search_index
-from docbot.extract import extract_main_text_with_headings
+from docbot.storage import (
+    ReloadingPool,
+    SearchCache,
+    budget_cost,
+    is_published,
+    load_sections,
+    min_quote_cost,
+    open_db,
+    rank_sections,
+    search_index,
+    search_many,
+    with_section_stats,
+)
+from docbot.extract import extract_page
 
 UA = {"User-Agent": "docbot/0.1 (+local)"}
 
-app = FastAPI()
-
 # DB パスは CFG.db_path（data/index.db）。cwd 基準の相対パス
 DB_PATH = CFG.db_path if os.path.isabs(CFG.db_path) else os.path.join(os.getcwd(), CFG.db_path)
 
+# 読み取り専用接続プール（startup で作成、shutdown で close）。
+# ingest --publish で data/index.db のリンク先が変わったら新しいファイルに切り替わる
+_pool: ReloadingPool | None = None
+
+# 検索結果キャッシュ。インデックス世代（meta.generation）が変わると自動で破棄
+_cache = SearchCache(maxsize=CFG.search_cache_size, ttl=CFG.search_cache_ttl)
+
+
+class PageCache:
+    """live_fallback で取得・切り出したページのセクション（url → sections）。LRU + TTL"""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+
+    def get(self, url: str) -> list[dict] | None:
+        item = self._data.get(url)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[url]
+            self.misses += 1
+            return None
+        self._data.move_to_end(url)
+        self.hits += 1
+        return item[1]
+
+    def put(self, url: str, sections: list[dict]) -> None:
+        self._data[url] = (time.monotonic() + self.ttl, sections)
+        self._data.move_to_end(url)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+
+_pages = PageCache(maxsize=CFG.page_cache_size, ttl=CFG.page_cache_ttl)
+
+# live_fallback 用の HTTP クライアント（startup で作成）。keep-alive で接続を使い回す
+_http: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _pool, _http
+    # スキーマ適用は起動時の 1 回だけ。以降は mode=ro 接続を使い回す。
+    # --publish のスナップショットは ingest 側で適用済みなので開かない（WAL 化などで配信中のファイルを書き換えない）
+    if not is_published(DB_PATH):
+        open_db(DB_PATH).close()
+    _pool = ReloadingPool(
+        DB_PATH,
+        size=CFG.read_pool_size,
+        timeout=CFG.read_pool_timeout,
+        check_interval=CFG.index_check_interval,
+    )
+    _http = httpx.AsyncClient(
+        headers=UA,
+        timeout=20,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=CFG.ask_max_connections),
+    )
+    try:
+        yield
+    finally:
+        await _http.aclose()
+        _http = None
+        _pool.close()
+        _pool = None
+
+
+app = FastAPI(lifespan=lifespan)
+
 
 def get_conn():
-    return open_db(DB_PATH)
+    """プールから読み取り接続を借りる（with で返却）"""
+    if _pool is None:
+        raise RuntimeError("read pool is not initialized (app startup not run)")
+    return _pool.connection()
 
 
 class AskReq(BaseModel):
     question: str
     lang: str | None = None
     topk_pages: int = 6
-    max_sections: int = 10
+    max_sections: int = 10  # 1 ページから採る引用の上限
+    # 引用（quote）の合計の上限。None は CFG.ask_budget。budget_unit="tokens" なら推定トークン数
+    budget: int | None = None
+    budget_unit: Literal["chars", "tokens"] = "chars"
+    # ingest で保存したセクションが無いページ（sections 追加前の DB など）だけ公開サイトから取得する
+    live_fallback: bool = False
+    # live_fallback の取得を待つ秒数（None は CFG.ask_fetch_deadline）。間に合ったページだけで引用を作る
+    deadline: float | None = None
 
 
 class SearchReq(BaseModel):
     query: str
     lang: str | None = None
     limit: int = 10
+    # 返すフィールド（None は全部）。url と score は常に返す
+    fields: list[Literal["url", "lang", "title", "hpath", "lead", "headings", "body_prefix"]] | None = None
+    # True なら body_prefix の一致箇所周辺の抜粋を snippet に入れる
+    snippet: bool = False
+
+
+class SearchBatchReq(BaseModel):
+    # 上限は CFG.search_batch_max 件。結果は queries と同じ順
+    queries: list[SearchReq]
 
 
 async def fetch_html(url: str) -> str | None:
+    if _http is None:
+        raise RuntimeError("HTTP client is not initialized (app startup not run)")
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, headers=UA, timeout=20, follow_redirects=True)
-            if r.status_code != 200:
-                return None
-            if "text/html" not in r.headers.get("content-type", ""):
-                return None
-            return r.text
+        r = await _http.get(url)
+        if r.status_code != 200:
+            return None
+        if "text/html" not in r.headers.get("content-type", ""):
+            return None
+        return r.text
     except Exception:
         return None
 
 
-def pick_sections(sections: list[dict], max_sections: int) -> list[dict]:
-    return sorted(sections, key=lambda s: len(s["text"]), reverse=True)[:max_sections]
+async def fetch_sections(url: str) -> list[dict] | None:
+    """
+    公開サイトから取得してセクション化（PageCache 経由）。抽出はスレッドで行いイベントループを止めない。
+    ingest と同じ extract_page で切り出す（Mintlify の高速経路を含め、保存済みのセクションと同じ引用になる）
+    """
+    sections = _pages.get(url)
+    if sections is not None:
+        return sections
+    html = await fetch_html(url)
+    if not html:
+        return None
+    sections = await asyncio.to_thread(lambda: with_section_stats(extract_page(html, url)["sections"]))
+    _pages.put(url, sections)
+    return sections
+
+
+async def iter_fetched_sections(urls: list[str], deadline: float):
+    """
+    urls を並行に取得し、取れたページから順に (url, sections) を yield する。
+    deadline 秒を過ぎたら（または呼び出し側が途中でやめたら）残りはキャンセル
+    """
+    loop = asyncio.get_running_loop()
+    tasks = {asyncio.create_task(fetch_sections(u)): u for u in urls}
+    pending = set(tasks)
+    until = loop.time() + deadline
+    try:
+        while pending:
+            remaining = until - loop.time()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if not t.exception() and t.result():
+                    yield tasks[t], t.result()
+    finally:
+        for t in pending:
+            t.cancel()
+
+
+async def fetch_sections_many(urls: list[str], deadline: float) -> dict[str, list[dict]]:
+    """urls を並行に取得し、deadline 秒以内に返ってきたページだけ返す（残りはキャンセル）"""
+    return {url: sections async for url, sections in iter_fetched_sections(urls, deadline)}
+
+
+# /ask の引用数の上限
+MAX_CITATIONS = 25
+
+ASK_ANSWER = "（LLM未接続）関連する引用候補です。LLMを繋ぐと、この引用だけを根拠に文章回答します。"
+
+
+def _ask_search(req: AskReq) -> tuple[list[dict], dict[str, list[dict]]]:
+    """検索して上位 topk_pages 件と、その保存済みセクション"""
+    with get_conn() as conn:
+        hits = search_index(
+            conn, req.question, lang=req.lang, limit=max(30, req.topk_pages * 5), cache=_cache
+        )
+        pages = hits[:req.topk_pages]
+        stored = load_sections(conn, [p["url"] for p in pages])
+    return pages, stored
+
+
+def _citations(req: AskReq, pages: list[tuple[str, list[dict]]], budget: int) -> list[dict]:
+    """質問に対する BM25 でページをまたいで順位付けし、budget に収まる引用を返す"""
+    return rank_sections(
+        req.question,
+        pages,
+        budget=budget,
+        unit=req.budget_unit,
+        max_per_page=req.max_sections,
+        quote_chars=CFG.ask_quote_chars,
+    )[:MAX_CITATIONS]
+
+
+def _budget(req: AskReq) -> int:
+    return CFG.ask_budget if req.budget is None else req.budget
+
+
+def _missing(pages: list[dict], stored: dict[str, list[dict]]) -> list[str]:
+    return [p["url"] for p in pages if p["url"] not in stored]
+
+
+def _deadline(req: AskReq) -> float:
+    return CFG.ask_fetch_deadline if req.deadline is None else req.deadline
 
 
 @app.get("/health")
@@ -55,12 +256,23 @@ def health():
     return {"ok": True}
 
 
+@app.get("/stats")
+def stats():
+    """検索・ページキャッシュのヒット/ミス数など（サイズ調整用）と配信中の DB ファイル"""
+    out = {"search_cache": _cache.stats(), "page_cache": _pages.stats()}
+    if _pool is not None:
+        out["index"] = _pool.describe()
+    return out
+
+
 @app.post("/search")
 def search(req: SearchReq):
     try:
-        conn = get_conn()
-        hits = search_index(conn, req.query, lang=req.lang, limit=req.limit)
-        conn.close()
+        with get_conn() as conn:
+            hits = search_index(
+                conn, req.query, lang=req.lang, limit=req.limit, cache=_cache,
+                fields=req.fields, snippet=req.snippet,
+            )
         return {"hits": hits}
     except Exception as e:
         return JSONResponse(
@@ -69,30 +281,81 @@ def search(req: SearchReq):
         )
 
 
+@app.post("/search/batch")
+def search_batch(req: SearchBatchReq):
+    if len(req.queries) > CFG.search_batch_max:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"too many queries (max {CFG.search_batch_max})", "type": "ValueError"},
+        )
+    try:
+        with get_conn() as conn:
+            results = search_many(conn, [q.model_dump() for q in req.queries], cache=_cache)
+        return {"results": [{"hits": hits} for hits in results]}
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"error": str(e), "type": type(e).__name__},
+        )
+
+
 @app.post("/ask")
 async def ask(req: AskReq):
-    conn = get_conn()
-    hits = search_index(conn, req.question, lang=req.lang, limit=max(30, req.topk_pages * 5))
-    pages = hits[:req.topk_pages]
-
-    contexts = []
-    for p in pages:
-        html = await fetch_html(p["url"])
-        if not html:
-            continue
-        sections = extract_main_text_with_headings(html)
-        for s in pick_sections(sections, req.max_sections):
-            contexts.append(
-                {
-                    "url": p["url"],
-                    "heading": s["heading"],
-                    "quote": s["text"][:900],
-                }
-            )
+    # 接続待ち（read_pool_timeout まで）と検索でイベントループを止めない
+    pages, stored = await asyncio.to_thread(_ask_search, req)
+    if req.live_fallback:
+        stored.update(await fetch_sections_many(_missing(pages, stored), _deadline(req)))
 
-    conn.close()
+    ranked = [(p["url"], stored[p["url"]]) for p in pages if stored.get(p["url"])]
     return {
-        "answer": "（LLM未接続）関連する引用候補です。LLMを繋ぐと、この引用だけを根拠に文章回答します。",
-        "citations": contexts[:25],
+        "answer": ASK_ANSWER,
+        "citations": _citations(req, ranked, _budget(req)),
         "hits": pages,
     }
+
+
+async def _ask_events(req: AskReq):
+    """
+    /ask/stream のイベント列。hits → citation → done。
+    保存済みセクションのあるページはまとめて順位付けして送り、live_fallback のページは取得できた順に
+    残りの budget の範囲で順位付けして送る
+    """
+    pages, stored = await asyncio.to_thread(_ask_search, req)
+    yield {"type": "hits", "hits": pages}
+
+    async def page_batches():
+        yield [(p["url"], stored[p["url"]]) for p in pages if stored.get(p["url"])]
+        if req.live_fallback:
+            async for item in iter_fetched_sections(_missing(pages, stored), _deadline(req)):
+                yield [item]
+
+    sent = 0
+    remaining = _budget(req)
+    batches = page_batches()
+    try:
+        async for batch in batches:
+            for c in _citations(req, batch, remaining)[:MAX_CITATIONS - sent]:
+                yield {"type": "citation", **c}
+                sent += 1
+                remaining -= budget_cost(c["quote"], req.budget_unit)
+            # 残りの budget で引用を作れなくなったら、live の取得を待たずに終える
+            if sent >= MAX_CITATIONS or remaining < min_quote_cost(req.budget_unit):
+                break
+    finally:
+        # 上限で打ち切ったとき・クライアントが切断したときに残りの取得をキャンセル
+        await batches.aclose()
+    yield {"type": "done", "answer": ASK_ANSWER, "citations": sent}
+
+
+@app.post("/ask/stream")
+async def ask_stream(req: AskReq):
+    """
+    /ask のストリーミング版（NDJSON、1 行 1 イベント）。
+    検索直後に hits を送り、引用はページを処理した順に 1 件ずつ送る
+    """
+
+    async def body():
+        async for event in _ask_events(req):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
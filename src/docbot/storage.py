@@ -1,38 +1,71 @@
+import json
+import math
 import os
+import queue
 import re
 import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from collections.abc import Iterable
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
 
 from docbot.config import CFG
 
 # ja-jp 2段ランキング：1段目の候補数
 CANDIDATE_LIMIT = 80
 MAX_NGRAM_TERMS = 180
+MAX_TRIGRAM_TERMS = 60
+
+
+# ひらがな・カタカナ・CJK 統合漢字（正規化・n-gram・BM25 の語で共通）
+_CJK_CHARS = "\u3040-\u309f\u30a0-\u30ff\u4e00-\u9fff"
+_CJK_RUN_RE = re.compile(f"[{_CJK_CHARS}]+")
 
 
 def _normalize_ja(text: str) -> str:
     """空白除去、記号削除"""
     s = "".join(text.split())
     # 記号・制御文字を除去（英数字・日本語・一部記号は残す）
-    s = re.sub(r"[^\w\u3040-\u309f\u30a0-\u30ff\u4e00-\u9fff]", "", s)
+    s = re.sub(f"[^\\w{_CJK_CHARS}]", "", s)
     return s
 
 
+def _ngrams(s: str, ns: tuple[int, ...] = (3, 2)) -> Iterable[str]:
+    """s の n-gram を ns の順に（重複あり）"""
+    for n in ns:
+        for i in range(len(s) - n + 1):
+            yield s[i : i + n]
+
+
 def _make_ngrams_q(text: str, ns: tuple[int, ...] = (3, 2), max_terms: int = MAX_NGRAM_TERMS) -> list[str]:
     """3-gram優先＋2-gram補助、重複除去、max_terms 上限"""
-    s = _normalize_ja(text)
     seen: set[str] = set()
     toks: list[str] = []
+    for t in _ngrams(_normalize_ja(text), ns):
+        if t not in seen:
+            seen.add(t)
+            toks.append(t)
+            if len(toks) >= max_terms:
+                break
+    return toks
+
+
+def make_ngrams(text: str, ns=(2, 3), limit=4000) -> str:
+    """ngrams 列（ngram モード）の中身: 空白除去した 2/3-gram を空白区切りで"""
+    s = "".join(text.split())
+    toks = []
     for n in ns:
-        if len(s) < n or len(toks) >= max_terms:
+        if len(s) < n:
             continue
         for i in range(len(s) - n + 1):
-            t = s[i : i + n]
-            if t not in seen:
-                seen.add(t)
-                toks.append(t)
-                if len(toks) >= max_terms:
-                    return toks
-    return toks
+            toks.append(s[i:i+n])
+    if len(toks) > limit:
+        toks = toks[:limit]
+    return " ".join(toks)
 
 
 def _query_to_ngrams_or(query: str, max_terms: int = MAX_NGRAM_TERMS) -> str:
@@ -47,7 +80,7 @@ def _query_to_ngrams_or(query: str, max_terms: int = MAX_NGRAM_TERMS) -> str:
 def _normalize_cjk(text: str) -> str:
     """CJK文字のみ抽出（ひらがな・カタカナ・中日韩統合漢字）"""
     s = "".join(text.split())
-    return re.sub(r"[^\u3040-\u309f\u30a0-\u30ff\u4e00-\u9fff]", "", s)
+    return re.sub(f"[^{_CJK_CHARS}]", "", s)
 
 
 def _query_to_ngrams_cjk(query: str, max_terms: int = 60) -> str | None:
@@ -62,6 +95,42 @@ def _query_to_ngrams_cjk(query: str, max_terms: int = 60) -> str | None:
     return " OR ".join(f'"{t}"' for t in escaped)
 
 
+def _trigram_segments(query: str) -> list[str]:
+    """記号・空白で区切った語（trigram / LIKE 用）"""
+    return re.findall(f"[\\w{_CJK_CHARS}]+", query)
+
+
+def _query_to_trigram_or(query: str, max_terms: int = MAX_TRIGRAM_TERMS) -> str | None:
+    """
+    trigram モード用: 各語の 3 文字窓を OR クエリに。
+    3 文字以上の語が無ければ None（LIKE フォールバック用）
+    """
+    seen: set[str] = set()
+    toks: list[str] = []
+    for seg in _trigram_segments(query):
+        for i in range(len(seg) - 2):
+            t = seg[i : i + 3].lower()
+            if t not in seen:
+                seen.add(t)
+                toks.append(t)
+                if len(toks) >= max_terms:
+                    break
+        if len(toks) >= max_terms:
+            break
+    if not toks:
+        return None
+    return " OR ".join('"' + t.replace('"', '""') + '"' for t in toks)
+
+
+# FTS5 の trigram トークナイザは SQLite 3.34 から。それより古い SQLite では全言語 ngram
+TRIGRAM_SUPPORTED = sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+def cjk_index_mode(lang: str | None) -> str:
+    """lang の CJK インデックス方式: "trigram"（pages_tri）or "ngram"（ngrams 列）"""
+    return "trigram" if lang in CFG.trigram_langs and TRIGRAM_SUPPORTED else "ngram"
+
+
 SCHEMA = """
 PRAGMA journal_mode=WAL;
 
@@ -74,7 +143,46 @@ CREATE TABLE IF NOT EXISTS pages (
   headings TEXT,
   body_prefix TEXT,
   ngrams TEXT,
-  fetched_at INTEGER NOT NULL
+  fetched_at INTEGER NOT NULL,
+  norm TEXT,
+  etag TEXT,
+  last_modified TEXT,
+  content_hash TEXT
+);
+
+-- trigram モードの LIKE フォールバック（_trigram_candidates）が lang の行だけを走査するため
+CREATE INDEX IF NOT EXISTS pages_lang ON pages(lang);
+
+-- インデックス世代など。generation は pages 更新のたびに +1（検索キャッシュの無効化用）
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta(key, value) VALUES ('generation', 0);
+
+-- クロール世代ごとに取得できた URL（stale GC 用）。pages の更新トリガー（FTS 再索引）を動かさないよう別テーブル。
+-- checked_at は 304・未変更で中身を確認した時刻（書き換えないので pages.fetched_at は古いまま。sitemap 差分用）
+CREATE TABLE IF NOT EXISTS page_seen (
+  url TEXT PRIMARY KEY,
+  crawl_id INTEGER NOT NULL,
+  checked_at INTEGER
+);
+
+-- /ask の引用用に ingest 時に切り出した見出し単位のセクション（encode_sections: zlib 圧縮 JSON）
+CREATE TABLE IF NOT EXISTS sections (
+  url TEXT PRIMARY KEY,
+  data BLOB NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS sections_ad AFTER DELETE ON pages BEGIN
+  DELETE FROM sections WHERE url = old.url;
+END;
+
+-- ingest --resume 用のクロール状態。status 0: frontier, 1: 書き込み済み, 2: 取得済み（スキップ・失敗）
+CREATE TABLE IF NOT EXISTS crawl_state (
+  url TEXT PRIMARY KEY,
+  depth INTEGER NOT NULL,
+  status INTEGER NOT NULL
 );
 
 CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts
@@ -98,18 +206,87 @@ CREATE TRIGGER IF NOT EXISTS pages_au AFTER UPDATE ON pages BEGIN
 END;
 """
 
+# CJK 用 trigram インデックス（ja-jp / zh-cn の行のみ）。ngrams 列の代替。
+# tokenize='trigram' は SQLite 3.34 以降なので、trigram モードの言語があるときだけ作る（apply_schema）
+TRI_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS pages_tri
+USING fts5(title, hpath, lead, headings, body_prefix, content='pages', content_rowid='rowid', tokenize='trigram');
+
+CREATE TRIGGER IF NOT EXISTS pages_tri_ai AFTER INSERT ON pages WHEN new.lang IN ('ja-jp', 'zh-cn') BEGIN
+  INSERT INTO pages_tri(rowid, title, hpath, lead, headings, body_prefix)
+  VALUES (new.rowid, new.title, new.hpath, new.lead, new.headings, new.body_prefix);
+END;
+
+CREATE TRIGGER IF NOT EXISTS pages_tri_ad AFTER DELETE ON pages WHEN old.lang IN ('ja-jp', 'zh-cn') BEGIN
+  INSERT INTO pages_tri(pages_tri, rowid, title, hpath, lead, headings, body_prefix)
+  VALUES ('delete', old.rowid, old.title, old.hpath, old.lead, old.headings, old.body_prefix);
+END;
+
+CREATE TRIGGER IF NOT EXISTS pages_tri_au_old AFTER UPDATE ON pages WHEN old.lang IN ('ja-jp', 'zh-cn') BEGIN
+  INSERT INTO pages_tri(pages_tri, rowid, title, hpath, lead, headings, body_prefix)
+  VALUES ('delete', old.rowid, old.title, old.hpath, old.lead, old.headings, old.body_prefix);
+END;
+
+CREATE TRIGGER IF NOT EXISTS pages_tri_au_new AFTER UPDATE ON pages WHEN new.lang IN ('ja-jp', 'zh-cn') BEGIN
+  INSERT INTO pages_tri(rowid, title, hpath, lead, headings, body_prefix)
+  VALUES (new.rowid, new.title, new.hpath, new.lead, new.headings, new.body_prefix);
+END;
+"""
+
+
+def has_pages_tri(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'pages_tri'").fetchone() is not None
 
-def _rescore_ja(row: tuple, query: str) -> float:
-    """ja-jp 用再スコア"""
-    url, lang, title, hpath, lead, headings, body_prefix = row[:7]
-    qn = _normalize_ja(query)
+
+def apply_schema(conn: sqlite3.Connection) -> None:
+    """
+    SCHEMA に加え、trigram モードの言語がある（CFG.trigram_langs）か既に pages_tri がある DB には TRI_SCHEMA も流す。
+    SQLite が trigram に対応しなければ pages_tri は作らない（ja-jp/zh-cn は ngrams 列で検索）
+    """
+    conn.executescript(SCHEMA)
+    if TRIGRAM_SUPPORTED and (CFG.trigram_langs or has_pages_tri(conn)):
+        conn.executescript(TRI_SCHEMA)
+
+
+# norm 列の区切り（_normalize_ja の出力には現れない）
+NORM_SEP = "\x1f"
+
+# norm 列を持つ言語（再スコア対象）
+RESCORE_LANGS = ("ja-jp", "zh-cn")
+
+
+def normalize_fields(title: str, headings: str, hpath: str, lead: str, body_prefix: str) -> str:
+    """再スコア用の正規化済みフィールドを NORM_SEP で連結（ingest 時に 1 回だけ計算）"""
+    return NORM_SEP.join(
+        _normalize_ja(x or "") for x in (title, headings, hpath, lead, body_prefix)
+    )
+
+
+@dataclass(frozen=True)
+class QueryPlan:
+    """クエリ単位で 1 回だけ作る再スコア用の前処理結果"""
+    qn: str
+    toks: tuple[str, ...]
+
+
+def compile_query(query: str) -> QueryPlan:
+    return QueryPlan(_normalize_ja(query), tuple(_make_ngrams_q(query, max_terms=60)))
+
+
+def _rescore_ja(row: tuple, query: "str | QueryPlan") -> float:
+    """
+    ja-jp 用再スコア。
+    row[7] に norm（正規化済みフィールド）があればそれを使い、無ければその場で正規化。
+    """
+    plan = query if isinstance(query, QueryPlan) else compile_query(query)
+    qn = plan.qn
     score = 0.0
 
-    title_n = _normalize_ja(title or "")
-    headings_n = _normalize_ja(headings or "")
-    hpath_n = _normalize_ja(hpath or "")
-    lead_n = _normalize_ja(lead or "")
-    body_n = _normalize_ja(body_prefix or "")
+    norm = row[7] if len(row) > 7 else None
+    if norm is None:
+        url, lang, title, hpath, lead, headings, body_prefix = row[:7]
+        norm = normalize_fields(title, headings, hpath, lead, body_prefix)
+    title_n, headings_n, hpath_n, lead_n, body_n = norm.split(NORM_SEP)
 
     if qn and qn in title_n:
         score += 80
@@ -123,11 +300,10 @@ def _rescore_ja(row: tuple, query: str) -> float:
         score += 10
 
     # ngramヒット数（簡易: 正規化テキストにクエリngramがいくつ含まれるか）
-    q_toks = _make_ngrams_q(query, max_terms=60)
     title_head = title_n + " " + headings_n
     lead_body = lead_n + " " + body_n
-    hit_th = sum(1 for t in q_toks if t in title_head)
-    hit_lb = sum(1 for t in q_toks if t in lead_body)
+    hit_th = sum(1 for t in plan.toks if t in title_head)
+    hit_lb = sum(1 for t in plan.toks if t in lead_body)
     score += 0.8 * hit_th + 0.2 * hit_lb
 
     # 連続一致ボーナス
@@ -148,13 +324,216 @@ def _resolve_db_path(path: str | None = None) -> str:
 
 
 def open_db(path: str | None = None) -> sqlite3.Connection:
+    """
+    書き込み用の接続。SCHEMA・移行を流し、WAL にする。
+    publish_index で公開したスナップショット（のリンク）には書かない（配信中のファイルを書き換えるため）
+    """
     resolved = _resolve_db_path(path)
+    if is_published(resolved):
+        raise ValueError(f"{resolved} is a published snapshot; write to the build DB (ingest --publish)")
     conn = sqlite3.connect(resolved)
     conn.execute("PRAGMA foreign_keys=ON;")
-    conn.executescript(SCHEMA)
+    if _bulk_build_owner(conn, alive=True) is not None:
+        # 別の接続が bulk build 中: SCHEMA でトリガーを戻したり FTS を rebuild したりしない（close() が戻す）
+        return conn
+    apply_schema(conn)
+    _migrate(conn)
     return conn
 
 
+def _bulk_build_owner(conn: sqlite3.Connection, alive: bool) -> int | None:
+    """
+    meta.fts_dirty（bulk build 中の pid）。alive=True なら生きているプロセスのとき、False なら落ちたときだけ返す。
+    pid 記録前の DB の値 1 は落ちた扱い
+    """
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'fts_dirty'").fetchone()
+    except sqlite3.OperationalError:
+        return None  # 新規 DB（meta がまだ無い）
+    if row is None:
+        return None
+    pid = row[0]
+    running = pid > 1 and _pid_alive(pid)
+    return pid if running == alive else None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# 既存 DB に後から追加した pages 列（CREATE TABLE IF NOT EXISTS では増えない）
+_PAGES_ADDED_COLUMNS = (
+    ("norm", "TEXT"),
+    ("etag", "TEXT"),
+    ("last_modified", "TEXT"),
+    ("content_hash", "TEXT"),
+)
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """
+    既存 DB の移行。
+    - pages / page_seen の不足列を追加。値は次回 ingest で埋まる（norm が NULL の行は検索時に正規化）
+    - pages_tri 追加前の DB は ja-jp/zh-cn の既存行を trigram インデックスへ投入（初回のみ）
+    """
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(pages)")}
+    for name, decl in _PAGES_ADDED_COLUMNS:
+        if name not in cols:
+            conn.execute(f"ALTER TABLE pages ADD COLUMN {name} {decl}")
+    if "checked_at" not in {r[1] for r in conn.execute("PRAGMA table_info(page_seen)")}:
+        conn.execute("ALTER TABLE page_seen ADD COLUMN checked_at INTEGER")
+    if has_pages_tri(conn) and conn.execute("SELECT 1 FROM meta WHERE key = 'tri_built'").fetchone() is None:
+        _fill_pages_tri(conn)
+        conn.execute("INSERT INTO meta(key, value) VALUES ('tri_built', 1)")
+    # bulk build が途中で落ちた DB は FTS が pages とずれているので作り直す（実行中の build には触らない）
+    if _bulk_build_owner(conn, alive=False) is not None:
+        rebuild_fts(conn)
+    conn.commit()
+
+
+def _fill_pages_tri(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """INSERT INTO pages_tri(rowid, title, hpath, lead, headings, body_prefix)
+           SELECT rowid, title, hpath, lead, headings, body_prefix FROM pages
+           WHERE lang IN ('ja-jp', 'zh-cn')"""
+    )
+
+
+def rebuild_fts(conn: sqlite3.Connection) -> None:
+    """pages_fts / pages_tri を pages から作り直す（commit は呼び出し側）"""
+    conn.execute("INSERT INTO pages_fts(pages_fts) VALUES('rebuild')")
+    if has_pages_tri(conn):
+        # pages_tri は CJK 行のみ索引するため 'rebuild'（全行）ではなく入れ直す
+        conn.execute("INSERT INTO pages_tri(pages_tri) VALUES('delete-all')")
+        _fill_pages_tri(conn)
+    conn.execute("DELETE FROM meta WHERE key = 'fts_dirty'")
+
+
+def open_db_readonly(path: str | None = None) -> sqlite3.Connection:
+    """
+    読み取り専用接続（URI mode=ro）。SCHEMA は流さない。
+    事前に open_db でスキーマ作成済みであること。
+    スレッドプールから使うため check_same_thread=False。
+    """
+    resolved = _resolve_db_path(path)
+    uri = Path(resolved).as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+class ReadPool:
+    """
+    読み取り専用接続のプール。
+    最大 size 本まで遅延生成し、空きが無ければ timeout 秒待つ。
+    """
+
+    def __init__(self, path: str | None = None, size: int | None = None, timeout: float | None = None):
+        self.path = _resolve_db_path(path)
+        self.size = size or CFG.read_pool_size
+        self.timeout = CFG.read_pool_timeout if timeout is None else timeout
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+    def acquire(self) -> sqlite3.Connection:
+        if self._closed:
+            raise RuntimeError("ReadPool is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return open_db_readonly(self.path)
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"ReadPool: no connection available within {self.timeout}s") from None
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """空き接続をすべて閉じる。貸出中の接続は返却時に閉じる"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_UPSERT_SQL = """INSERT INTO pages(
+     url, lang, title, hpath, lead, headings, body_prefix, ngrams, fetched_at, norm,
+     etag, last_modified, content_hash)
+   VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
+   ON CONFLICT(url) DO UPDATE SET
+     lang=excluded.lang,
+     title=excluded.title,
+     hpath=excluded.hpath,
+     lead=excluded.lead,
+     headings=excluded.headings,
+     body_prefix=excluded.body_prefix,
+     ngrams=excluded.ngrams,
+     fetched_at=excluded.fetched_at,
+     norm=excluded.norm,
+     etag=excluded.etag,
+     last_modified=excluded.last_modified,
+     content_hash=excluded.content_hash
+"""
+
+
+def _page_params(
+    url: str,
+    lang: str,
+    title: str,
+    hpath: str,
+    lead: str,
+    headings: str,
+    body_prefix: str,
+    ngrams: str,
+    fetched_at: int,
+    norm: str | None = None,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    content_hash: str | None = None,
+) -> tuple:
+    """_UPSERT_SQL のパラメータ。ja-jp/zh-cn は norm 未指定なら normalize_fields で計算"""
+    if norm is None and lang in RESCORE_LANGS:
+        norm = normalize_fields(title, headings, hpath, lead, body_prefix)
+    return (
+        url, lang, title, hpath, lead, headings, body_prefix, ngrams, fetched_at, norm,
+        etag, last_modified, content_hash,
+    )
+
+
 def upsert_page(
     conn: sqlite3.Connection,
     url: str,
@@ -166,25 +545,863 @@ def upsert_page(
     body_prefix: str,
     ngrams: str,
     fetched_at: int,
+    norm: str | None = None,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    content_hash: str | None = None,
 ) -> None:
+    """
+    1 ページを挿入/更新して commit。大量に書くときは BulkWriter / upsert_pages。
+    etag / last_modified / content_hash は次回の差分クロール用
+    """
     conn.execute(
-        """INSERT INTO pages(url, lang, title, hpath, lead, headings, body_prefix, ngrams, fetched_at)
-           VALUES(?,?,?,?,?,?,?,?,?)
-           ON CONFLICT(url) DO UPDATE SET
-             lang=excluded.lang,
-             title=excluded.title,
-             hpath=excluded.hpath,
-             lead=excluded.lead,
-             headings=excluded.headings,
-             body_prefix=excluded.body_prefix,
-             ngrams=excluded.ngrams,
-             fetched_at=excluded.fetched_at
-        """,
-        (url, lang, title, hpath, lead, headings, body_prefix, ngrams, fetched_at),
+        _UPSERT_SQL,
+        _page_params(
+            url, lang, title, hpath, lead, headings, body_prefix, ngrams, fetched_at, norm,
+            etag, last_modified, content_hash,
+        ),
     )
+    bump_generation(conn)
     conn.commit()
 
 
+# bulk build 中に止める FTS 同期トリガー（終了時に apply_schema で作り直す）
+_FTS_TRIGGERS = (
+    "pages_ai", "pages_ad", "pages_au",
+    "pages_tri_ai", "pages_tri_ad", "pages_tri_au_old", "pages_tri_au_new",
+)
+
+
+class BulkWriter:
+    """
+    ingest 用のまとめ書き。add() した行を batch_size 件ごとに 1 トランザクションで書く。
+    add(sections=...) を渡したページは sections テーブルにも書く（/ask 用）。
+    crawl_id を渡すと add() / touch() した URL を page_seen にその世代で記録する（stale GC 用）。
+    touch(checked=True) は確認時刻も記録し、sitemap 差分はこれを fetched_at と同じに扱う。
+
+    bulk_build=True のときは synchronous=OFF・cache 拡大・FTS トリガー停止で書き込み、
+    close() で pages_fts / pages_tri を一括 rebuild してトリガーを戻す。
+    """
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        batch_size: int | None = None,
+        bulk_build: bool = False,
+        crawl_id: int | None = None,
+    ):
+        self.conn = conn
+        self.batch_size = batch_size or CFG.write_batch_size
+        self.bulk_build = bulk_build
+        self.crawl_id = crawl_id
+        self.written = 0
+        self.batches = 0
+        self._buf: list[tuple] = []
+        self._seen: list[tuple[str, int | None]] = []
+        self._sections: list[tuple[str, bytes]] = []
+        self._saved_pragmas: dict[str, int] = {}
+        self._closed = False
+        if bulk_build:
+            self._begin_bulk_build()
+
+    def _begin_bulk_build(self) -> None:
+        conn = self.conn
+        conn.commit()
+        for name in ("synchronous", "cache_size"):
+            self._saved_pragmas[name] = conn.execute(f"PRAGMA {name}").fetchone()[0]
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(f"PRAGMA cache_size={-CFG.bulk_cache_kib}")
+        # 値は pid。open_db は持ち主が生きていれば実行中、死んでいれば途中で落ちた build と判断する
+        conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('fts_dirty', ?)", (os.getpid(),))
+        for name in _FTS_TRIGGERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.commit()
+
+    def add(
+        self,
+        url: str,
+        lang: str,
+        title: str,
+        hpath: str,
+        lead: str,
+        headings: str,
+        body_prefix: str,
+        ngrams: str,
+        fetched_at: int,
+        norm: str | None = None,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        content_hash: str | None = None,
+        sections: list[dict] | None = None,
+    ) -> None:
+        if sections is not None:
+            self._sections.append((url, encode_sections(sections)))
+        self._buf.append(
+            _page_params(
+                url, lang, title, hpath, lead, headings, body_prefix, ngrams, fetched_at, norm,
+                etag, last_modified, content_hash,
+            )
+        )
+        if self.crawl_id is not None:
+            self._seen.append((url, fetched_at))
+        if len(self._buf) >= self.batch_size:
+            self.flush()
+
+    def touch(self, url: str, checked: bool = False) -> None:
+        """
+        書き換えないが今回のクロールで存在を確認した URL を記録。
+        checked=True（304・content_hash が同じ）は中身が最新だと確認できたので確認時刻も残す。一時的な失敗は False
+        """
+        if self.crawl_id is None:
+            return
+        self._seen.append((url, int(time.time()) if checked else None))
+        if len(self._seen) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buf and not self._seen:
+            return
+        with self.conn:
+            if self._buf:
+                self.conn.executemany(_UPSERT_SQL, self._buf)
+                bump_generation(self.conn)
+            if self._sections:
+                self.conn.executemany(_UPSERT_SECTIONS_SQL, self._sections)
+            if self._seen:
+                self.conn.executemany(
+                    "INSERT INTO page_seen(url, crawl_id, checked_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(url) DO UPDATE SET crawl_id = excluded.crawl_id, "
+                    "checked_at = COALESCE(excluded.checked_at, page_seen.checked_at)",
+                    [(url, self.crawl_id, checked_at) for url, checked_at in self._seen],
+                )
+        if self._buf:
+            self.written += len(self._buf)
+            self.batches += 1
+        self._buf.clear()
+        self._seen.clear()
+        self._sections.clear()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        if self.bulk_build:
+            conn = self.conn
+            with conn:
+                rebuild_fts(conn)
+                bump_generation(conn)
+            # トリガーを戻す（IF NOT EXISTS なので他は変わらない）
+            apply_schema(conn)
+            for name, value in self._saved_pragmas.items():
+                conn.execute(f"PRAGMA {name}={value}")
+
+    def __enter__(self) -> "BulkWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # 例外時も書けた分は残し、FTS を整合させる
+        self.close()
+
+
+def upsert_pages(
+    conn: sqlite3.Connection,
+    rows: Iterable[tuple],
+    batch_size: int | None = None,
+    bulk_build: bool = False,
+) -> int:
+    """
+    rows（upsert_page と同じ並びのタプル）をバッチ書き込み。書いた件数を返す
+    """
+    with BulkWriter(conn, batch_size=batch_size, bulk_build=bulk_build) as writer:
+        for row in rows:
+            writer.add(*row)
+    return writer.written
+
+
+_UPSERT_SECTIONS_SQL = (
+    "INSERT INTO sections(url, data) VALUES (?, ?) ON CONFLICT(url) DO UPDATE SET data = excluded.data"
+)
+
+
+def encode_sections(sections: list[dict]) -> bytes:
+    """
+    [{"heading", "text"(, "dl", "tf")}, ...] → sections.data（zlib 圧縮 JSON）。
+    BM25 用の統計（dl / tf）が無ければここで計算し、SECTION_TERMS_VERSION と一緒に保存する
+    """
+    packed = []
+    for s in with_section_stats(sections):
+        packed.append([s["heading"], s["text"], s["dl"], s["tf"], SECTION_TERMS_VERSION])
+    return zlib.compress(json.dumps(packed, ensure_ascii=False, separators=(",", ":")).encode(), 6)
+
+
+def decode_sections(data: bytes) -> list[dict]:
+    # 統計なし（[heading, text]）や古い section_terms の統計（[heading, text, dl, tf]）の行は読み出し時に計算
+    return with_section_stats(
+        [{"heading": h, "text": t, "dl": rest[0], "tf": rest[1]}
+         if rest[2:] == [SECTION_TERMS_VERSION] else {"heading": h, "text": t}
+         for h, t, *rest in json.loads(zlib.decompress(data))]
+    )
+
+
+def load_sections(conn: sqlite3.Connection, urls: Iterable[str]) -> dict[str, list[dict]]:
+    """url → セクション。sections に無い URL（sections 追加前に取り込んだページ）はキーごと無い"""
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+    marks = ",".join("?" * len(urls))
+    rows = conn.execute(f"SELECT url, data FROM sections WHERE url IN ({marks})", urls)
+    return {url: decode_sections(data) for url, data in rows}
+
+
+# /ask のセクション順位付け（BM25）
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 見出しに出る語の重み（本文 1 回分に対して）
+HEADING_TF_WEIGHT = 2
+# budget に合わせて quote を切るとき、これより短くなるなら引用にしない
+MIN_QUOTE_CHARS = 120
+
+_WORD_RE = re.compile(r"[0-9A-Za-z][0-9A-Za-z_.\-]*")
+# section_terms の定義を変えたら上げる（古い版で保存した統計は decode_sections で計算し直す）
+SECTION_TERMS_VERSION = 2
+
+
+def section_terms(text: str) -> Counter:
+    """
+    BM25 の語。英数字は小文字の単語。CJK は ja-jp の再スコアと同じく _normalize_ja してから
+    _ngrams の 3-gram + 2-gram（1 文字だけの並びはそのまま）
+    """
+    terms: Counter = Counter()
+    for run in _CJK_RUN_RE.findall(_normalize_ja(text)):
+        if len(run) == 1:
+            terms[run] += 1
+        else:
+            terms.update(_ngrams(run))
+    terms.update(w.rstrip(".-").lower() for w in _WORD_RE.findall(text))
+    return terms
+
+
+def query_terms(query: str) -> list[str]:
+    """クエリの語（重複なし、出現順）"""
+    return list(section_terms(query))
+
+
+def with_section_stats(sections: list[dict]) -> list[dict]:
+    """各セクションに BM25 用の dl（語数）と tf（語 → 回数。見出しは HEADING_TF_WEIGHT 倍）を付ける"""
+    out = []
+    for s in sections:
+        if "tf" not in s:
+            tf = section_terms(s["text"])
+            for t, n in section_terms(s["heading"]).items():
+                tf[t] += n * HEADING_TF_WEIGHT
+            s = {**s, "dl": sum(tf.values()), "tf": dict(tf)}
+        out.append(s)
+    return out
+
+
+def estimate_tokens(text: str) -> int:
+    """LLM のトークン数の目安: CJK は 1 文字 1 トークン、それ以外は 4 文字 1 トークン"""
+    cjk = sum(len(r) for r in _CJK_RUN_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def budget_cost(text: str, unit: str = "chars") -> int:
+    """rank_sections の budget で数える量（"chars": 文字数 / "tokens": estimate_tokens）"""
+    return estimate_tokens(text) if unit == "tokens" else len(text)
+
+
+def min_quote_cost(unit: str = "chars", min_chars: int = MIN_QUOTE_CHARS) -> int:
+    """min_chars 文字の quote の最小コスト（tokens は全部英数字の場合）。残りの budget がこれ未満なら引用はもう作れない"""
+    return min_chars if unit == "chars" else math.ceil(min_chars / 4)
+
+
+def _fit_budget(text: str, remaining: int, unit: str, min_chars: int) -> str | None:
+    """コストが remaining 以下になる最長の先頭。min_chars 文字未満にしかならなければ None"""
+    if budget_cost(text, unit) <= remaining:
+        return text
+    # コストは先頭の長さについて単調なので二分探索（1 文字あたりの平均で切ると CJK が前に偏った quote で超える）
+    lo, hi = 0, len(text)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if budget_cost(text[:mid], unit) <= remaining:
+            lo = mid
+        else:
+            hi = mid
+    return text[:lo] if lo >= min_chars else None
+
+
+def rank_sections(
+    query: str,
+    pages: list[tuple[str, list[dict]]],
+    budget: int | None = None,
+    unit: str = "chars",
+    max_per_page: int | None = None,
+    quote_chars: int = 900,
+    min_quote_chars: int = MIN_QUOTE_CHARS,
+) -> list[dict]:
+    """
+    /ask の引用選び。pages（検索順の (url, セクション)）の全セクションを BM25 で順位付けし、
+    quote の合計が budget（unit="chars" なら文字数、"tokens" なら estimate_tokens）に収まるだけ返す。
+    IDF は候補セクションの中で数える。クエリ語を含むセクションが無ければ検索順・ページ内の順に返す。
+    return: [{"url", "heading", "quote", "score"}, ...]（score 降順）
+    """
+    if unit not in ("chars", "tokens"):
+        raise ValueError(f"unknown budget unit: {unit}")
+    cands = [
+        (rank, i, url, s)
+        for rank, (url, sections) in enumerate(pages)
+        for i, s in enumerate(with_section_stats(sections))
+    ]
+    if not cands:
+        return []
+    terms = query_terms(query)
+    n = len(cands)
+    avgdl = (sum(s["dl"] for *_, s in cands) / n) or 1.0
+    df = Counter(t for *_, s in cands for t in terms if t in s["tf"])
+    idf = {t: math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5)) for t in df}
+
+    scored = []
+    for rank, i, url, s in cands:
+        score = 0.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * s["dl"] / avgdl)
+        for t, w in idf.items():
+            tf = s["tf"].get(t, 0)
+            if tf:
+                score += w * tf * (BM25_K1 + 1) / (tf + norm)
+        scored.append((score, rank, i, url, s))
+    if any(x[0] > 0 for x in scored):
+        scored = [x for x in scored if x[0] > 0]
+        scored.sort(key=lambda x: (-x[0], x[1], x[2]))
+    else:
+        scored.sort(key=lambda x: (x[1], x[2]))
+
+    out = []
+    per_page: Counter = Counter()
+    remaining = budget
+    for score, _, _, url, s in scored:
+        if max_per_page is not None and per_page[url] >= max_per_page:
+            continue
+        quote = s["text"][:quote_chars]
+        if remaining is not None:
+            if remaining < min_quote_cost(unit, min_quote_chars):
+                break
+            quote = _fit_budget(quote, remaining, unit, min_quote_chars)
+            if quote is None:
+                # tokens では CJK の多い quote が入らなくても、後ろの英数字の多い quote は入りうる
+                continue
+            remaining -= budget_cost(quote, unit)
+        per_page[url] += 1
+        out.append({"url": url, "heading": s["heading"], "quote": quote, "score": round(score, 3)})
+    return out
+
+
+def load_validators(conn: sqlite3.Connection) -> dict[str, tuple[str | None, str | None, str | None]]:
+    """
+    差分クロール用: url → (etag, last_modified, content_hash)。
+    sections が無いページは検証子を返さない（次の差分クロールで取り直してセクションを埋める）
+    """
+    return {
+        r[0]: (r[1], r[2], r[3]) if r[4] else (None, None, None)
+        for r in conn.execute(
+            """SELECT p.url, p.etag, p.last_modified, p.content_hash, s.url IS NOT NULL
+               FROM pages p LEFT JOIN sections s ON s.url = p.url"""
+        )
+    }
+
+
+def load_fetched_at(conn: sqlite3.Connection) -> dict[str, int]:
+    """sitemap 差分用: url → 最後に中身を確認した時刻（epoch 秒。fetched_at と 304・未変更の checked_at の新しい方）"""
+    return dict(conn.execute(
+        """SELECT p.url, MAX(p.fetched_at, COALESCE(s.checked_at, 0))
+           FROM pages p LEFT JOIN page_seen s ON s.url = p.url"""
+    ))
+
+
+class CrawlCheckpoint:
+    """
+    クロールの frontier / 取得済み URL を crawl_state に保存する（ingest --resume 用）。
+    mark() はメモリに溜めるだけで、save() で前回からの差分を 1 トランザクションで書く。
+    crawl_id を渡すと、保存した状態がどの世代のものかを meta.checkpoint_crawl に記録する（begin_crawl の再開判定用）。
+    saves / rows / seconds は保存コストの計測用
+    """
+
+    PENDING = 0
+    WRITTEN = 1
+    VISITED = 2
+
+    def __init__(self, conn: sqlite3.Connection, crawl_id: int | None = None):
+        self.conn = conn
+        self.crawl_id = crawl_id
+        self.saves = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self._buf: dict[str, tuple[int, int]] = {}
+
+    def load(self) -> tuple[dict[str, int], set[str], int]:
+        """return: (frontier の url → depth, 取得済み URL, 書き込み済み件数)"""
+        frontier: dict[str, int] = {}
+        visited: set[str] = set()
+        written = 0
+        for url, depth, status in self.conn.execute("SELECT url, depth, status FROM crawl_state"):
+            if status == self.PENDING:
+                frontier[url] = depth
+            else:
+                visited.add(url)
+                written += status == self.WRITTEN
+        return frontier, visited, written
+
+    def mark(self, url: str, depth: int, status: int) -> None:
+        self._buf[url] = (depth, status)
+
+    def save(self) -> None:
+        if not self._buf:
+            return
+        t0 = time.perf_counter()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO crawl_state(url, depth, status) VALUES (?, ?, ?) "
+                "ON CONFLICT(url) DO UPDATE SET depth = excluded.depth, status = excluded.status",
+                [(url, depth, status) for url, (depth, status) in self._buf.items()],
+            )
+            if self.crawl_id is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta(key, value) VALUES ('checkpoint_crawl', ?)", (self.crawl_id,)
+                )
+        self.seconds += time.perf_counter() - t0
+        self.saves += 1
+        self.rows += len(self._buf)
+        self._buf.clear()
+
+    def clear(self) -> None:
+        self._buf.clear()
+        with self.conn:
+            self.conn.execute("DELETE FROM crawl_state")
+            self.conn.execute("DELETE FROM meta WHERE key = 'checkpoint_crawl'")
+
+
+def begin_crawl(conn: sqlite3.Connection, resume: bool = False) -> int:
+    """
+    新しいクロール世代を払い出す（meta.crawl_id を +1）。
+    resume=True なら中断した世代を引き継ぐ（再開前に書いたページも同じ世代として数える）。
+    引き継ぐのは crawl_state にその世代の checkpoint が残っているときだけ。完走した世代や
+    BFS 以外の実行の世代は引き継がず、別の世代の crawl_state は捨てて新しい世代を始める
+    """
+    row = conn.execute("SELECT value FROM meta WHERE key = 'crawl_id'").fetchone()
+    crawl_id = row[0] if row else 0
+    if resume and crawl_id and _checkpoint_crawl(conn) == crawl_id:
+        return crawl_id
+    crawl_id += 1
+    with conn:
+        if resume:
+            conn.execute("DELETE FROM crawl_state")
+            conn.execute("DELETE FROM meta WHERE key = 'checkpoint_crawl'")
+        conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('crawl_id', ?)", (crawl_id,))
+    return crawl_id
+
+
+def _checkpoint_crawl(conn: sqlite3.Connection) -> int | None:
+    """crawl_state に残っている checkpoint の世代（無ければ None）"""
+    if conn.execute("SELECT 1 FROM crawl_state LIMIT 1").fetchone() is None:
+        return None
+    row = conn.execute("SELECT value FROM meta WHERE key = 'checkpoint_crawl'").fetchone()
+    return row[0] if row else None
+
+
+def complete_crawl(conn: sqlite3.Connection, crawl_id: int) -> None:
+    """crawl_id の世代を「最後まで巡回した」と記録。gc_stale_pages はこの世代を基準にする"""
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('complete_crawl', ?)", (crawl_id,))
+
+
+def gc_stale_pages(
+    conn: sqlite3.Connection,
+    dry_run: bool = False,
+    max_fraction: float | None = None,
+    force: bool = False,
+    examples: int = 10,
+) -> dict:
+    """
+    最後に完走したクロール世代で見えなかった pages 行（削除・改名されたページ）を消し、FTS を optimize する。
+    削除対象が全体の max_fraction（既定 CFG.gc_max_fraction）を超えたら force なしでは消さない。
+    return: {"status", "crawl_id", "total", "stale", "fraction", "by_lang", "examples"}
+    status: "no_complete_crawl" / "clean" / "dry_run" / "aborted"（しきい値超え）/ "deleted"
+    """
+    if max_fraction is None:
+        max_fraction = CFG.gc_max_fraction
+    total = conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+    row = conn.execute("SELECT value FROM meta WHERE key = 'complete_crawl'").fetchone()
+    report = {
+        "status": "no_complete_crawl", "crawl_id": row[0] if row else None, "total": total,
+        "stale": 0, "fraction": 0.0, "by_lang": {}, "examples": [],
+    }
+    if row is None:
+        return report
+    stale = conn.execute(
+        """SELECT p.url, p.lang FROM pages p LEFT JOIN page_seen s ON s.url = p.url
+           WHERE s.crawl_id IS NULL OR s.crawl_id < ? ORDER BY p.url""",
+        (row[0],),
+    ).fetchall()
+    by_lang: dict[str, int] = {}
+    for _, lang in stale:
+        by_lang[lang] = by_lang.get(lang, 0) + 1
+    report.update(
+        stale=len(stale),
+        fraction=len(stale) / total if total else 0.0,
+        by_lang=by_lang,
+        examples=[u for u, _ in stale[:examples]],
+    )
+    if not stale:
+        report["status"] = "clean"
+    elif dry_run:
+        report["status"] = "dry_run"
+    elif report["fraction"] > max_fraction and not force:
+        report["status"] = "aborted"
+    else:
+        with conn:
+            conn.executemany("DELETE FROM pages WHERE url = ?", [(u,) for u, _ in stale])
+            conn.execute("DELETE FROM page_seen WHERE url NOT IN (SELECT url FROM pages)")
+            for t in _fts_tables(conn):
+                conn.execute(f"INSERT INTO {t}({t}) VALUES('optimize')")
+            bump_generation(conn)
+        report["status"] = "deleted"
+    return report
+
+
+def _fts_tables(conn: sqlite3.Connection) -> tuple[str, ...]:
+    """FTS5 の索引（optimize / segment 数の対象）。pages_tri は trigram モードの DB だけ"""
+    return ("pages_fts", "pages_tri") if has_pages_tri(conn) else ("pages_fts",)
+
+
+def index_stats(conn: sqlite3.Connection) -> dict:
+    """
+    メンテナンス前後の比較用。
+    return: {"path", "file_bytes"（本体 + WAL）, "wal_bytes", "page_count", "freelist_count", "segments": {FTS 表: 数}}
+    """
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    db_bytes = os.path.getsize(path) if path and os.path.exists(path) else 0
+    wal = f"{path}-wal"
+    wal_bytes = os.path.getsize(wal) if path and os.path.exists(wal) else 0
+    segments = {
+        name: conn.execute(f"SELECT COUNT(DISTINCT segid) FROM {name}_idx").fetchone()[0]
+        for name in _fts_tables(conn)
+    }
+    return {
+        "path": path,
+        "file_bytes": db_bytes + wal_bytes,
+        "wal_bytes": wal_bytes,
+        "page_count": conn.execute("PRAGMA page_count").fetchone()[0],
+        "freelist_count": conn.execute("PRAGMA freelist_count").fetchone()[0],
+        "segments": segments,
+    }
+
+
+def optimize_index(conn: sqlite3.Connection, merge: int | None = None, vacuum: bool = True) -> list[tuple[str, float]]:
+    """
+    ingest 後のメンテナンス。WAL checkpoint → FTS5 optimize（merge 指定時は 'merge' を N ページ分）→
+    ANALYZE → VACUUM → WAL checkpoint。return: [(手順, 秒), ...]
+    """
+    steps: list[tuple[str, float]] = []
+
+    def step(name: str, *sqls: str) -> None:
+        t0 = time.perf_counter()
+        for sql in sqls:
+            conn.execute(sql)
+        conn.commit()
+        steps.append((name, time.perf_counter() - t0))
+
+    conn.commit()
+    tables = _fts_tables(conn)
+    step("wal_checkpoint", "PRAGMA wal_checkpoint(TRUNCATE)")
+    if merge:
+        step(f"fts merge {merge}", *(f"INSERT INTO {t}({t}, rank) VALUES('merge', {int(merge)})" for t in tables))
+    else:
+        step("fts optimize", *(f"INSERT INTO {t}({t}) VALUES('optimize')" for t in tables))
+    step("analyze", "ANALYZE", "PRAGMA optimize")
+    if vacuum:
+        step("vacuum", "VACUUM")
+        step("wal_checkpoint", "PRAGMA wal_checkpoint(TRUNCATE)")
+    return steps
+
+
+def optimize_into(conn: sqlite3.Connection, dest: str, merge: int | None = None) -> list[tuple[str, float]]:
+    """
+    conn の DB を変更せず、デフラグ・optimize 済みの配信用コピーを dest に作る。
+    一時ファイルに VACUUM INTO してから optimize_index をかけ、最後に rename で置き換える
+    """
+    dest = _resolve_db_path(dest)
+    if os.path.exists(f"{dest}-wal"):
+        # 開かれている（or 異常終了した）WAL DB を置き換えると WAL が新しい本体に適用されうる
+        raise ValueError(f"{dest} is in use (WAL file exists)")
+    src = conn.execute("PRAGMA database_list").fetchone()[2]
+    if src and os.path.exists(dest) and os.path.samefile(src, dest):
+        raise ValueError("--into must differ from the source DB")
+    tmp = f"{dest}.tmp{os.getpid()}"
+    for p in (tmp, f"{tmp}-wal", f"{tmp}-shm"):
+        if os.path.exists(p):
+            os.remove(p)
+    t0 = time.perf_counter()
+    conn.commit()
+    conn.execute("VACUUM INTO ?", (tmp,))
+    steps = [("vacuum into", time.perf_counter() - t0)]
+    out = sqlite3.connect(tmp)
+    try:
+        # VACUUM INTO の出力は rollback journal（単一ファイル）。配信時に open_db が WAL に切り替える
+        steps += optimize_index(out, merge=merge)
+    finally:
+        out.close()
+    os.replace(tmp, dest)
+    return steps
+
+
+def build_db_path(live: str | None = None) -> str:
+    """ingest --publish の作業用 DB（data/index.db → data/index.build.db）"""
+    root, ext = os.path.splitext(_resolve_db_path(live))
+    return f"{root}.build{ext}"
+
+
+def _published_path(live: str, generation: int) -> str:
+    root, ext = os.path.splitext(live)
+    return f"{root}.g{generation:08d}{ext}"
+
+
+# publish_index のスナップショット（index.g00000012.db）
+_SNAPSHOT_RE = re.compile(r"\.g\d{8}(\.[^.]*)?$")
+
+
+def is_published(path: str | None = None) -> bool:
+    """path が公開済みのスナップショットか、それを指すリンク（--publish 後の data/index.db）か"""
+    return bool(_SNAPSHOT_RE.search(os.path.basename(os.path.realpath(_resolve_db_path(path)))))
+
+
+def seed_build_db(build: str, live: str | None = None) -> bool:
+    """
+    作業用 DB が無ければ配信中の DB をコピーして作る（--incremental の ETag 等を引き継ぐため）。
+    return: コピーしたら True
+    """
+    live = _resolve_db_path(live)
+    if os.path.exists(build) or not os.path.exists(live):
+        return False
+    src = sqlite3.connect(Path(live).as_uri() + "?mode=ro", uri=True)
+    try:
+        src.execute("VACUUM INTO ?", (build,))
+    finally:
+        src.close()
+    return True
+
+
+def publish_index(conn: sqlite3.Connection, live: str | None = None, keep: int = 2) -> str | None:
+    """
+    作業用 DB（conn）の optimize 済みスナップショットを data/index.g<generation>.db に作り、
+    live（data/index.db）のシンボリックリンクを rename で差し替えて公開する。
+    配信中のサーバーは古いファイルを読み続け、ReloadingPool がリンク先の変化を見て切り替える。
+    公開済みの世代は新しい順に keep 個だけ残す。return: 公開したパス（世代が変わっていなければ None）
+    """
+    live = _resolve_db_path(live)
+    dest = _published_path(live, get_generation(conn))
+    if os.path.realpath(live) == dest:
+        return None
+    optimize_into(conn, dest)
+    link = f"{live}.link{os.getpid()}"
+    if os.path.lexists(link):
+        os.remove(link)
+    # 相対リンクにしておけば data/ ごと移動できる
+    os.symlink(os.path.basename(dest), link)
+    os.replace(link, live)
+    # SQLite はリンクを解決した名前で WAL を開くので live-wal / live-shm は使われない。
+    # 初回公開で置き換えた通常ファイルや、切替前の接続が作ったものが残ると、同名で作り直した DB に適用されうる
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(live + suffix):
+            os.remove(live + suffix)
+    _prune_published(live, keep=max(1, keep))
+    return dest
+
+
+def _prune_published(live: str, keep: int) -> list[str]:
+    root, ext = os.path.splitext(live)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.g\d{8}" + re.escape(ext) + "$")
+    parent = os.path.dirname(live)
+    versions = sorted(name for name in os.listdir(parent) if pattern.match(name))
+    current = os.path.basename(os.path.realpath(live))
+    removed = []
+    for name in versions[:-keep]:
+        if name == current:
+            continue
+        for suffix in ("", "-wal", "-shm"):
+            p = os.path.join(parent, name + suffix)
+            if os.path.exists(p):
+                os.remove(p)
+        removed.append(name)
+    return removed
+
+
+class ReloadingPool:
+    """
+    publish_index で差し替わる DB 用の ReadPool。
+    最大 check_interval 秒ごとに path のリンク先（realpath）を確認し、変わっていたら新しいファイルの
+    ReadPool に切り替える。古いプールは close するが、貸出中の接続は返却時に閉じるので処理中のリクエストは落ちない
+    """
+
+    def __init__(
+        self,
+        path: str | None = None,
+        size: int | None = None,
+        timeout: float | None = None,
+        check_interval: float | None = None,
+    ):
+        self.path = _resolve_db_path(path)
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = CFG.index_check_interval if check_interval is None else check_interval
+        self.swaps = 0
+        self._lock = threading.Lock()
+        self._checked_at = time.monotonic()
+        self._pool = ReadPool(os.path.realpath(self.path), size=size, timeout=timeout)
+
+    @property
+    def current(self) -> str:
+        """接続中のファイル（リンク解決後）"""
+        return self._pool.path
+
+    def reload(self, force: bool = False) -> bool:
+        """リンク先が変わっていればプールを切り替える。return: 切り替えたら True"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return False
+        with self._lock:
+            if not force and now - self._checked_at < self.check_interval:
+                return False
+            self._checked_at = now
+            target = os.path.realpath(self.path)
+            if target == self._pool.path or not os.path.exists(target):
+                return False
+            old = self._pool
+            self._pool = ReadPool(target, size=self.size, timeout=self.timeout)
+            self.swaps += 1
+        old.close()
+        return True
+
+    def acquire(self) -> tuple[ReadPool, sqlite3.Connection]:
+        self.reload()
+        while True:
+            pool = self._pool
+            try:
+                return pool, pool.acquire()
+            except RuntimeError:
+                # 借りる直前に切り替わって close された。新しいプールで借り直す
+                if pool is self._pool:
+                    raise
+
+    @contextmanager
+    def connection(self):
+        pool, conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+    def describe(self) -> dict:
+        return {"path": self.path, "current": self.current, "swaps": self.swaps}
+
+    def close(self) -> None:
+        self._pool.close()
+
+
+def bump_generation(conn: sqlite3.Connection) -> None:
+    """インデックス世代を +1（commit は呼び出し側）"""
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+
+def get_generation(conn: sqlite3.Connection) -> int:
+    """現在のインデックス世代。meta が無い古い DB は 0"""
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+
+def index_version(conn: sqlite3.Connection) -> tuple[str, int]:
+    """
+    検索キャッシュの世代: (DB ファイルの実体パス, meta.generation)。
+    公開スナップショットや作業用 DB は別ファイルでも generation が一致しうるので、ファイルも含める
+    """
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    return (os.path.realpath(path) if path else "", get_generation(conn))
+
+
+# search_index が返せるフィールド（fields で絞る。url と score は常に返す）
+HIT_FIELDS = ("url", "lang", "title", "hpath", "lead", "headings", "body_prefix")
+# 候補取得では読まず、最終的な limit 件についてだけ読む重い列
+_HEAVY_FIELDS = ("headings", "body_prefix")
+
+
+class SearchCache:
+    """
+    search_index の結果キャッシュ（LRU + TTL）。
+    キーは (正規化クエリ, lang, limit, fields, snippet)。インデックス世代（index_version: DB ファイルと
+    meta.generation）が変わったら全破棄。
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[tuple, tuple[float, list[dict]]] = OrderedDict()
+        self._version: tuple[str, int] | None = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(
+        query: str, lang: str | None, limit: int, fields: tuple[str, ...] = HIT_FIELDS, snippet: bool = False
+    ) -> tuple:
+        return (" ".join(query.split()), lang, limit, fields, snippet)
+
+    def get(self, key: tuple, version: tuple[str, int]) -> list[dict] | None:
+        with self._lock:
+            if version != self._version:
+                self._data.clear()
+                self._version = version
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return [dict(h) for h in item[1]]
+
+    def put(self, key: tuple, version: tuple[str, int], hits: list[dict]) -> None:
+        with self._lock:
+            if version != self._version:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, [dict(h) for h in hits])
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._version = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "db": self._version[0] if self._version else None,
+                "generation": self._version[1] if self._version else None,
+            }
+
+
 def _is_anchor_noise_en(row: tuple, query: str) -> bool:
     """en-us: URLアンカー #<query> だけで一致、本文に無い → ノイズ"""
     url, title, lead = row[0], row[2], row[4]
@@ -201,16 +1418,127 @@ def _sanitize_fts_query(q: str) -> str:
     """FTS5 でエラーになる文字を置換"""
     return q.replace(".", " ").replace(":", " ").replace("-", " ")
 
-def search_index(conn: sqlite3.Connection, query: str, lang: str | None = None, limit: int = 20) -> list[dict]:
+# snippet=True の抜粋（body_prefix）。一致箇所を ** で囲む
+SNIPPET_OPEN = "**"
+SNIPPET_CLOSE = "**"
+SNIPPET_TOKENS = 24
+SNIPPET_CHARS = 160
+
+
+def search_index(
+    conn: sqlite3.Connection,
+    query: str,
+    lang: str | None = None,
+    limit: int = 20,
+    cache: SearchCache | None = None,
+    fields: Iterable[str] | None = None,
+    snippet: bool = False,
+) -> list[dict]:
+    """
+    検索。cache を渡すと (正規化クエリ, lang, limit, fields, snippet) で結果を再利用する。
+    fields: 返すフィールド（HIT_FIELDS の部分集合。None は全部）。headings / body_prefix は指定したときだけ読む
+    snippet=True: body_prefix の一致箇所周辺の抜粋を "snippet" に入れる（FTS5 snippet()）
+    """
+    fields = _hit_fields(fields)
+    if cache is None:
+        return _search_index(conn, query, lang, limit, fields=fields, snippet=snippet)
+    key = SearchCache.make_key(query, lang, limit, fields, snippet)
+    version = index_version(conn)
+    hits = cache.get(key, version)
+    if hits is None:
+        hits = _search_index(conn, query, lang, limit, fields=fields, snippet=snippet)
+        cache.put(key, version, hits)
+    return hits
+
+
+def _hit_fields(fields: Iterable[str] | None) -> tuple[str, ...]:
+    if fields is None:
+        return HIT_FIELDS
+    wanted = set(fields)
+    unknown = wanted - set(HIT_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown fields: {sorted(unknown)}")
+    return tuple(f for f in HIT_FIELDS if f in wanted or f == "url")
+
+
+# 検索候補として取得する列（norm は再スコア用、rowid は重い列・snippet の取得用）。
+# headings / body_prefix は norm が無い（再スコアでその場で正規化する）CJK の行だけ読む
+_HIT_COLUMNS = (
+    "p.url, p.lang, p.title, p.hpath, p.lead, "
+    "CASE WHEN p.norm IS NULL AND p.lang IN ('ja-jp', 'zh-cn') THEN p.headings END, "
+    "CASE WHEN p.norm IS NULL AND p.lang IN ('ja-jp', 'zh-cn') THEN p.body_prefix END, "
+    "p.norm, p.rowid"
+)
+
+
+# LIKE フォールバックの並べ替えの重み（_rescore_ja の列ごとの完全一致と同じ）
+_LIKE_WEIGHTS = (("title", 80), ("headings", 50), ("hpath", 25), ("lead", 18), ("body_prefix", 10))
+
+
+def _trigram_candidates(
+    conn: sqlite3.Connection, query: str, lang: str | tuple[str, ...]
+) -> tuple[list[tuple], tuple | None]:
+    """
+    trigram モードの 1 段目候補（lang は複数可）。語ごとに振り分ける:
+    3 文字以上の語は pages_tri の MATCH（bm25 順）、3 文字未満の語（「設定」など trigram に乗らない）は
+    LIKE の部分一致を _LIKE_WEIGHTS の重みで並べて、それぞれ CANDIDATE_LIMIT 件。両方あれば和集合（再スコアで並べ直す）。
+    LIKE は pages_lang で langs の行に絞ったうえで全件を走査する（コストは langs の行数に比例）
+    return: (候補行, snippet 用の (FTS 表, MATCH クエリ, body_prefix の列番号)。snippet() を使わないなら None)
+    """
+    langs = (lang,) if isinstance(lang, str) else tuple(lang)
+    lang_marks = ",".join("?" * len(langs))
+    rows: list[tuple] = []
+    tri_query = _query_to_trigram_or(query)
+    if tri_query is not None:
+        rows = conn.execute(
+            f"""SELECT {_HIT_COLUMNS}
+               FROM pages_tri JOIN pages p ON p.rowid = pages_tri.rowid
+               WHERE pages_tri MATCH ? AND p.lang IN ({lang_marks})
+               ORDER BY bm25(pages_tri)
+               LIMIT ?""",
+            (tri_query, *langs, CANDIDATE_LIMIT),
+        ).fetchall()
+
+    short = [seg for seg in _trigram_segments(query) if len(seg) < 3]
+    if short:
+        terms = []
+        params: list = []
+        for seg in short:
+            pat = "%" + seg.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            for col, weight in _LIKE_WEIGHTS:
+                terms.append(f"(p.{col} LIKE ? ESCAPE '\\') * {weight}")
+                params.append(pat)
+        # 一致した行を全部並べてから切る（LIMIT だけだと rowid 順の先頭 80 件になる）
+        liked = conn.execute(
+            f"""SELECT * FROM (
+                 SELECT {_HIT_COLUMNS}, {" + ".join(terms)} AS w FROM pages p WHERE p.lang IN ({lang_marks})
+               ) WHERE w > 0
+               ORDER BY w DESC, rowid
+               LIMIT ?""",
+            (*params, *langs, CANDIDATE_LIMIT),
+        ).fetchall()
+        seen = {r[8] for r in rows}
+        rows += [r[:-1] for r in liked if r[8] not in seen]
+    # trigram の OR クエリ（語の 3 文字窓すべて）は一致箇所が多く、snippet() が 1 行 10ms 近くかかるので使わない
+    return rows, None
+
+
+def _fts_candidates(
+    conn: sqlite3.Connection, query: str, lang: str | None, limit: int
+) -> tuple[list[tuple], tuple | None]:
+    """pages_fts（unicode61 + ngrams 列）での 1 段目候補。戻り値は _trigram_candidates と同じ形"""
     fts_query = _sanitize_fts_query(query)
+    ngram = False
     if lang == "ja-jp":
         fts_query = _query_to_ngrams_or(query)
         fetch_limit = CANDIDATE_LIMIT
+        ngram = True
     elif lang == "zh-cn":
         ngram_qt = _query_to_ngrams_cjk(query)
         if ngram_qt is not None:
             fts_query = ngram_qt
             fetch_limit = CANDIDATE_LIMIT
+            ngram = True
         else:
             fetch_limit = max(limit, 80)
     else:
@@ -218,45 +1546,309 @@ def search_index(conn: sqlite3.Connection, query: str, lang: str | None = None,
 
     if lang:
         rows = conn.execute(
-            """SELECT url, lang, title, hpath, lead, headings, body_prefix
-               FROM pages_fts
-               WHERE pages_fts MATCH ? AND lang = ?
+            f"""SELECT {_HIT_COLUMNS}
+               FROM pages_fts JOIN pages p ON p.rowid = pages_fts.rowid
+               WHERE pages_fts MATCH ? AND p.lang = ?
                ORDER BY bm25(pages_fts)
                LIMIT ?""",
             (fts_query, lang, fetch_limit),
         ).fetchall()
     else:
         rows = conn.execute(
-            """SELECT url, lang, title, hpath, lead, headings, body_prefix
-               FROM pages_fts
+            f"""SELECT {_HIT_COLUMNS}
+               FROM pages_fts JOIN pages p ON p.rowid = pages_fts.rowid
                WHERE pages_fts MATCH ?
                ORDER BY bm25(pages_fts)
                LIMIT ?""",
             (fts_query, fetch_limit),
         ).fetchall()
+    # n-gram クエリは ngrams 列に一致するので、body_prefix の snippet では一致箇所が出ない
+    return rows, (None if ngram else ("pages_fts", fts_query, 6))
 
-    def _row_to_hit(r):
-        return {
-            "url": r[0], "lang": r[1], "title": r[2], "hpath": r[3], "lead": r[4],
-            "headings": r[5] if len(r) > 5 else "",
-            "body_prefix": r[6] if len(r) > 6 else "",
-            "score": None,
-        }
 
-    if lang == "ja-jp" and rows:
-        scored = [(r, _rescore_ja(r, query)) for r in rows]
-        scored.sort(key=lambda x: x[1], reverse=True)
-        cut = scored[:limit]
-        return [{**_row_to_hit(r), "score": s} for r, s in cut]
-    if lang == "zh-cn" and rows:
-        scored = [(r, _rescore_ja(r, query)) for r in rows]
+def _search_index(
+    conn: sqlite3.Connection,
+    query: str,
+    lang: str | None,
+    limit: int,
+    cjk_mode: str | None = None,
+    fields: tuple[str, ...] = HIT_FIELDS,
+    snippet: bool = False,
+) -> list[dict]:
+    """cjk_mode で ja-jp/zh-cn のインデックス方式を上書き（比較用）。None なら CFG.trigram_langs に従う"""
+    rows, scores, match = _ranked_rows(conn, query, lang, limit, cjk_mode)
+    heavy = [f for f in _HEAVY_FIELDS if f in fields]
+    heavy_of = _fetch_columns(conn, [r[8] for r in rows], heavy) if heavy and rows else {}
+    return _build_hits(conn, query, rows, scores, match, fields, snippet, heavy_of, heavy)
+
+
+def _ranked_rows(
+    conn: sqlite3.Connection,
+    query: str,
+    lang: str | None,
+    limit: int,
+    cjk_mode: str | None = None,
+    plan: QueryPlan | None = None,
+) -> tuple[list[tuple], list[float | None], tuple | None]:
+    """候補取得 → 再スコア・並べ替え → limit 件。return: (行, スコア, snippet 用の match)"""
+    if lang in RESCORE_LANGS and (cjk_mode or cjk_index_mode(lang)) == "trigram":
+        rows, match = _trigram_candidates(conn, query, lang)
+    else:
+        rows, match = _fts_candidates(conn, query, lang, limit)
+
+    # lang 指定なし: trigram モードの言語は ngrams 列が空で pages_fts では CJK の語に当たらないので、
+    # pages_tri からも候補を取り、再スコア順で pages_fts の候補の前に置く
+    tri_rows: list[tuple] = []
+    if lang is None and _normalize_cjk(query):
+        tri_langs = tuple(l for l in RESCORE_LANGS if (cjk_mode or cjk_index_mode(l)) == "trigram")
+        if tri_langs:
+            tri_rows, _ = _trigram_candidates(conn, query, tri_langs)
+
+    scores: list[float | None]
+    if lang in RESCORE_LANGS and rows:
+        plan = plan or compile_query(query)
+        scored = [(r, _rescore_ja(r, plan)) for r in rows]
         scored.sort(key=lambda x: x[1], reverse=True)
         cut = scored[:limit]
-        return [{**_row_to_hit(r), "score": s} for r, s in cut]
-    if lang == "en-us" and rows:
-        # アンカーのみノイズを後ろに寄せる、他は bm25 順維持
-        rows = sorted(rows, key=lambda r: (_is_anchor_noise_en(r, query), 0))[:limit]
-    elif lang and len(rows) > limit:
-        rows = rows[:limit]
-
-    return [_row_to_hit(r) for r in rows]
+        rows = [r for r, _ in cut]
+        scores = [sc for _, sc in cut]
+    elif tri_rows:
+        plan = plan or compile_query(query)
+        tri_rows.sort(key=lambda r: _rescore_ja(r, plan), reverse=True)
+        seen = {r[8] for r in tri_rows}
+        rows = (tri_rows + [r for r in rows if r[8] not in seen])[:limit]
+        scores = [None] * len(rows)
+    else:
+        if lang == "en-us" and rows:
+            # アンカーのみノイズを後ろに寄せる、他は bm25 順維持
+            rows = sorted(rows, key=lambda r: (_is_anchor_noise_en(r, query), 0))[:limit]
+        elif lang and len(rows) > limit:
+            rows = rows[:limit]
+        scores = [None] * len(rows)
+    return rows, scores, match
+
+
+def _build_hits(
+    conn: sqlite3.Connection,
+    query: str,
+    rows: list[tuple],
+    scores: list[float | None],
+    match: tuple | None,
+    fields: tuple[str, ...],
+    snippet: bool,
+    heavy_of: dict[int, tuple],
+    heavy_cols: list[str],
+) -> list[dict]:
+    """_ranked_rows の結果を fields の射影で hit に。heavy_of は rowid → heavy_cols の値"""
+    heavy = [(f, heavy_cols.index(f)) for f in _HEAVY_FIELDS if f in fields]
+    snippet_of = _snippets(conn, query, [r[8] for r in rows], match) if snippet and rows else {}
+
+    row_fields = ("url", "lang", "title", "hpath", "lead")
+    hits = []
+    for r, sc in zip(rows, scores):
+        hit = {f: r[i] for i, f in enumerate(row_fields) if f in fields}
+        values = heavy_of.get(r[8])
+        for f, i in heavy:
+            hit[f] = values[i] if values else ""
+        if snippet:
+            hit["snippet"] = snippet_of.get(r[8], "")
+        hit["score"] = sc
+        hits.append(hit)
+    return hits
+
+
+def search_many(
+    conn: sqlite3.Connection,
+    queries: Iterable[dict],
+    cache: SearchCache | None = None,
+) -> list[list[dict]]:
+    """
+    複数の検索を 1 接続・1 読み取りトランザクションでまとめて実行し、入力順に結果を返す。
+    各要素は search_index と同じキー（query 必須、lang / limit / fields / snippet は省略可）の dict。
+    - (query, lang, limit) が同じものは候補取得・再スコアを 1 回だけ行う（fields / snippet 違いも共有）
+    - 同じクエリ文字列の compile_query は言語をまたいで 1 回
+    - headings / body_prefix はバッチ全体のヒットの rowid でまとめて読む
+    cache を渡すと search_index と同じキーで参照・保存する（世代の確認はバッチで 1 回）
+    """
+    specs = []
+    for q in queries:
+        specs.append((
+            q["query"], q.get("lang"), q.get("limit", 20), _hit_fields(q.get("fields")), bool(q.get("snippet", False)),
+        ))
+    if not specs:
+        return []
+
+    own_txn = not conn.in_transaction
+    if own_txn:
+        # 途中で ingest が書いても、バッチ内の結果と世代が同じスナップショットになるように
+        conn.execute("BEGIN")
+    try:
+        results: list[list[dict] | None] = [None] * len(specs)
+        keys = [SearchCache.make_key(*spec) for spec in specs]
+        version = index_version(conn) if cache is not None else None
+        todo: dict[tuple, list[int]] = {}
+        for i, key in enumerate(keys):
+            hits = cache.get(key, version) if cache is not None else None
+            if hits is not None:
+                results[i] = hits
+            else:
+                todo.setdefault(key, []).append(i)
+
+        plans: dict[str, QueryPlan] = {}
+        ranked: dict[tuple, tuple] = {}
+        for key, idx in todo.items():
+            query, lang, limit = specs[idx[0]][:3]
+            rkey = (query, lang, limit)
+            if rkey not in ranked:
+                plan = None
+                if lang in RESCORE_LANGS or (lang is None and _normalize_cjk(query)):
+                    plan = plans.get(query) or plans.setdefault(query, compile_query(query))
+                ranked[rkey] = _ranked_rows(conn, query, lang, limit, plan=plan)
+
+        heavy_cols: list[str] = []
+        rowids: set[int] = set()
+        for idx in todo.values():
+            query, lang, limit, fields, _ = specs[idx[0]]
+            wanted = [f for f in _HEAVY_FIELDS if f in fields]
+            if wanted:
+                heavy_cols += [f for f in wanted if f not in heavy_cols]
+                rowids.update(r[8] for r in ranked[(query, lang, limit)][0])
+        heavy_cols.sort(key=_HEAVY_FIELDS.index)
+        heavy_of = _fetch_columns(conn, sorted(rowids), heavy_cols) if rowids else {}
+
+        for key, idx in todo.items():
+            query, lang, limit, fields, snippet = specs[idx[0]]
+            rows, scores, match = ranked[(query, lang, limit)]
+            hits = _build_hits(conn, query, rows, scores, match, fields, snippet, heavy_of, heavy_cols)
+            if cache is not None:
+                cache.put(key, version, hits)
+            for n, i in enumerate(idx):
+                results[i] = hits if n == 0 else [dict(h) for h in hits]
+        return results
+    finally:
+        if own_txn:
+            conn.rollback()
+
+
+def _rowid_chunks(rowids: list[int], size: int = 500):
+    for i in range(0, len(rowids), size):
+        yield rowids[i : i + size]
+
+
+def _fetch_columns(conn: sqlite3.Connection, rowids: list[int], columns: list[str]) -> dict[int, tuple]:
+    """rowid → columns の値（最終的なヒットの重い列だけ後から読む）"""
+    out = {}
+    for chunk in _rowid_chunks(rowids):
+        marks = ",".join("?" * len(chunk))
+        for row in conn.execute(
+            f"SELECT rowid, {', '.join(columns)} FROM pages WHERE rowid IN ({marks})", chunk
+        ):
+            out[row[0]] = row[1:]
+    return out
+
+
+def _snippets(conn: sqlite3.Connection, query: str, rowids: list[int], match: tuple | None) -> dict[int, str]:
+    """
+    rowid → body_prefix の抜粋。pages_fts で検索した行は FTS5 の snippet()、
+    CJK（trigram / n-gram / LIKE）で検索した行と body_prefix が空の行は _text_snippet（空なら lead → hpath）
+    """
+    out: dict[int, str] = {}
+    if match is not None:
+        table, fts_query, col = match
+        for chunk in _rowid_chunks(rowids):
+            marks = ",".join("?" * len(chunk))
+            out.update(conn.execute(
+                f"""SELECT rowid, snippet({table}, {col}, ?, ?, '…', ?) FROM {table}
+                   WHERE {table} MATCH ? AND rowid IN ({marks})""",
+                (SNIPPET_OPEN, SNIPPET_CLOSE, SNIPPET_TOKENS, fts_query, *chunk),
+            ))
+    rest = [r for r in rowids if not out.get(r)]
+    if rest:
+        # enterprise の en-us 行は body_prefix が空なので lead / hpath から切り出す
+        for rowid, texts in _fetch_columns(conn, rest, ["body_prefix", "lead", "hpath"]).items():
+            out[rowid] = _text_snippet(next((t for t in texts if t), ""), query)
+    return out
+
+
+def _text_snippet(text: str, query: str, width: int = SNIPPET_CHARS) -> str:
+    """最初に一致した語（大文字小文字を区別しない）の周辺 width 文字。一致が無ければ先頭"""
+    low = text.lower()
+    best = None
+    for seg in sorted(_trigram_segments(query), key=len, reverse=True):
+        i = low.find(seg.lower())
+        if i >= 0:
+            best = (i, len(seg))
+            break
+    if best is None:
+        return text[:width] + ("…" if len(text) > width else "")
+    i, n = best
+    start = max(0, i - (width - n) // 2)
+    end = min(len(text), start + width)
+    return (
+        ("…" if start > 0 else "")
+        + text[start:i] + SNIPPET_OPEN + text[i : i + n] + SNIPPET_CLOSE + text[i + n : end]
+        + ("…" if end < len(text) else "")
+    )
+
+
+def _table_bytes(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> int:
+    try:
+        return conn.execute(sql, params).fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        return 0
+
+
+def compare_cjk_index(conn: sqlite3.Connection, queries: list[str], lang: str, repeat: int = 5) -> dict:
+    """
+    ngram（pages_fts + ngrams 列）と trigram（pages_tri）のサイズ・レイテンシ比較（TRIGRAM_SUPPORTED のときだけ）。
+    trigram モードで ingest した DB は ngrams 列が空なので、lang の行だけをメモリ DB に複製し、
+    空の ngrams 列を ingest と同じ make_ngrams で埋めて両方の索引を同じ行で作ってから比べる
+    """
+    mem = _cjk_compare_db(conn, lang)
+    sizes = {
+        "pages_fts_bytes": _table_bytes(mem, "SELECT SUM(LENGTH(block)) FROM pages_fts_data"),
+        "ngrams_column_bytes": _table_bytes(mem, "SELECT SUM(LENGTH(ngrams)) FROM pages"),
+        "pages_tri_bytes": _table_bytes(mem, "SELECT SUM(LENGTH(block)) FROM pages_tri_data"),
+    }
+    rows = []
+    for q in queries:
+        entry: dict = {"query": q}
+        tops: dict[str, list[str]] = {}
+        for mode in ("ngram", "trigram"):
+            times = []
+            hits: list[dict] = []
+            for _ in range(max(1, repeat)):
+                t0 = time.perf_counter()
+                hits = _search_index(mem, q, lang, 10, cjk_mode=mode)
+                times.append(time.perf_counter() - t0)
+            times.sort()
+            entry[f"{mode}_ms"] = times[len(times) // 2] * 1000
+            entry[f"{mode}_hits"] = len(hits)
+            tops[mode] = [h["url"] for h in hits]
+        common = set(tops["ngram"]) & set(tops["trigram"])
+        entry["top10_overlap"] = len(common)
+        rows.append(entry)
+    mem.close()
+    return {"lang": lang, "sizes": sizes, "queries": rows}
+
+
+def _cjk_compare_db(conn: sqlite3.Connection, lang: str) -> sqlite3.Connection:
+    """compare_cjk_index 用: lang の行を ngrams 列込みで複製したメモリ DB（トリガーで pages_fts / pages_tri を作る）"""
+    mem = sqlite3.connect(":memory:")
+    mem.executescript(SCHEMA)
+    mem.executescript(TRI_SCHEMA)
+    rows = conn.execute(
+        """SELECT url, lang, title, hpath, lead, headings, body_prefix, ngrams, fetched_at, norm
+           FROM pages WHERE lang = ?""",
+        (lang,),
+    )
+    mem.executemany(
+        """INSERT INTO pages(url, lang, title, hpath, lead, headings, body_prefix, ngrams, fetched_at, norm)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            r[:7] + (r[7] or make_ngrams("\n".join(x or "" for x in r[2:7])),) + r[8:]
+            for r in rows
+        ),
+    )
+    mem.commit()
+    return mem
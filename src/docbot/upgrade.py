@@ -4,7 +4,7 @@ appVersion 基準。storage/search で release notes を検索。
 """
 import re
 
-from docbot.storage import open_db, search_index
+from docbot.storage import is_published, open_db, open_db_readonly, search_index, search_many
 
 # Non-skippable 検索キーワード（FTS5 で column: と解釈されないよう注意）
 # 厳しめに限定して過剰マッチを防ぐ
@@ -58,8 +58,8 @@ def collect_non_skippable(conn) -> list[dict]:
     seen_urls = set()
     results = []
 
-    for kw in NON_SKIP_KEYWORDS:
-        hits = search_index(conn, kw, lang="en-us", limit=50)
+    queries = [{"query": kw, "lang": "en-us", "limit": 50} for kw in NON_SKIP_KEYWORDS]
+    for hits in search_many(conn, queries):
         for h in hits:
             url = h.get("url") or ""
             if "dify-helm" not in url or "/pages/" not in url:
@@ -171,8 +171,8 @@ def extract_hop_steps(conn, from_ver: str, to_ver: str, lang: str) -> tuple[list
     bullets = []
     seen_bullets = set()
 
-    for q in [f"{to_ver} upgrade", to_ver]:
-        hits = search_index(conn, q, lang=lang or "en-us", limit=20)
+    queries = [{"query": q, "lang": lang or "en-us", "limit": 20} for q in (f"{to_ver} upgrade", to_ver)]
+    for hits in search_many(conn, queries):
         for h in hits:
             url = h.get("url") or ""
             if "dify-helm" not in url or "/pages/" not in url:
@@ -323,7 +323,8 @@ def run_upgrade(
     upgrade 処理のメイン。storage を直接利用。
     mode=helm のときは各 hop で values-diff を実行し、values.yaml 修正を出力に含める。
     """
-    conn = open_db()
+    # --publish 運用の data/index.db（公開済みスナップショット）は読むだけ
+    conn = open_db_readonly() if is_published() else open_db()
 
     non_skippable = collect_non_skippable(conn)
     if not non_skippable:
@@ -0,0 +1,136 @@
+"""archive モジュールのユニットテスト（record / replay）"""
+import asyncio
+import dataclasses
+import gzip
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+
+from docbot import ingest
+from docbot.archive import MISS_HEADER, ArchiveTransport, ResponseArchive
+from docbot.config import CFG
+from docbot.storage import BulkWriter, apply_schema
+
+BASE = "https://enterprise-docs.dify.ai/versions/3-0-x/en-us"
+
+PAGES = {
+    f"{BASE}/introduction": f'<html><head><title>Intro</title></head><body><a href="{BASE}/install">i</a>'
+    "<main><h1>Intro</h1><p>Welcome to Dify Enterprise.</p></main></body></html>",
+    f"{BASE}/install": "<html><head><title>Install</title></head><body>"
+    "<main><h1>Install</h1><p>Install with Helm.</p></main></body></html>",
+}
+
+
+def _origin(request: httpx.Request) -> httpx.Response:
+    body = PAGES.get(str(request.url))
+    if body is None:
+        return httpx.Response(404)
+    etag = f'"{len(body)}"'
+    if request.headers.get("if-none-match") == etag:
+        return httpx.Response(304, headers={"etag": etag})
+    # 転送時は gzip。アーカイブには展開済みで入る
+    return httpx.Response(
+        200,
+        content=gzip.compress(body.encode()),
+        headers={"content-type": "text/html", "content-encoding": "gzip", "etag": etag},
+    )
+
+
+class TestResponseArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def _fetch_all(self, transport: ArchiveTransport, urls: list[str], headers=None) -> list[httpx.Response]:
+        async def run():
+            async with httpx.AsyncClient(transport=transport) as client:
+                return [await client.get(u, headers=headers) for u in urls]
+
+        return asyncio.run(run())
+
+    def test_record_then_replay(self):
+        urls = [f"{BASE}/introduction", f"{BASE}/missing"]
+        archive = ResponseArchive(self.tmp.name)
+        recorded = self._fetch_all(ArchiveTransport(archive, "record", httpx.MockTransport(_origin)), urls)
+        archive.close()
+        self.assertEqual(recorded[0].text, PAGES[urls[0]])
+
+        archive = ResponseArchive(self.tmp.name)
+        replayed = self._fetch_all(ArchiveTransport(archive, "replay"), urls + [f"{BASE}/never"])
+        self.assertEqual(replayed[0].status_code, 200)
+        self.assertEqual(replayed[0].text, PAGES[urls[0]])
+        self.assertEqual(replayed[0].headers["content-type"], "text/html")
+        self.assertNotIn("content-encoding", replayed[0].headers)
+        self.assertEqual(replayed[1].status_code, 404)
+        self.assertNotIn(MISS_HEADER, replayed[1].headers)
+        self.assertEqual(replayed[2].headers[MISS_HEADER], "miss")
+        self.assertEqual((archive.hits, archive.misses), (2, 1))
+        archive.close()
+
+    def test_replay_conditional_get(self):
+        url = f"{BASE}/install"
+        archive = ResponseArchive(self.tmp.name)
+        self._fetch_all(ArchiveTransport(archive, "record", httpx.MockTransport(_origin)), [url])
+        etag = f'"{len(PAGES[url])}"'
+        (r,) = self._fetch_all(ArchiveTransport(archive, "replay"), [url], headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 304)
+        archive.close()
+
+    def test_record_keeps_final_response_on_transient_error(self):
+        url = f"{BASE}/introduction"
+        statuses = iter([200, 503, 429])
+
+        def flaky(request: httpx.Request) -> httpx.Response:
+            status = next(statuses)
+            if status != 200:
+                return httpx.Response(status, headers={"retry-after": "1"})
+            return _origin(request)
+
+        archive = ResponseArchive(self.tmp.name)
+        recorded = self._fetch_all(ArchiveTransport(archive, "record", httpx.MockTransport(flaky)), [url] * 3)
+        self.assertEqual([r.status_code for r in recorded], [200, 503, 429])
+        self.assertEqual(archive.recorded, 1)
+        (r,) = self._fetch_all(ArchiveTransport(archive, "replay"), [url])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, PAGES[url])
+        archive.close()
+
+    def test_content_addressed(self):
+        archive = ResponseArchive(self.tmp.name)
+        a = archive.put("https://example.com/a", 200, [("content-type", "text/html")], b"same body")
+        b = archive.put("https://example.com/b", 200, [("content-type", "text/html")], b"same body")
+        self.assertEqual(a, b)
+        stats = archive.stats()
+        self.assertEqual((stats["responses"], stats["blobs"]), (2, 1))
+        self.assertEqual(archive.get("https://example.com/b")[2], b"same body")
+        archive.close()
+
+    def test_crawl_replay_without_network(self):
+        def crawl(transport: ArchiveTransport) -> list[tuple]:
+            conn = sqlite3.connect(":memory:")
+            apply_schema(conn)
+
+            async def run():
+                writer = BulkWriter(conn)
+                async with httpx.AsyncClient(transport=transport) as client:
+                    await ingest.crawl(client, writer, [f"{BASE}/introduction"])
+                writer.close()
+
+            asyncio.run(run())
+            rows = conn.execute("SELECT url, title, lead FROM pages ORDER BY url").fetchall()
+            conn.close()
+            return rows
+
+        cfg = dataclasses.replace(CFG, extract_workers=0)
+        with mock.patch.object(ingest, "CFG", cfg):
+            archive = ResponseArchive(self.tmp.name)
+            recorded = crawl(ArchiveTransport(archive, "record", httpx.MockTransport(_origin)))
+            archive.close()
+            archive = ResponseArchive(self.tmp.name)
+            replayed = crawl(ArchiveTransport(archive, "replay"))
+            archive.close()
+        self.assertEqual(len(recorded), 2)
+        self.assertEqual(replayed, recorded)
@@ -0,0 +1,34 @@
+"""cli モジュールのユニットテスト"""
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from docbot.cli import _format_bytes, run_optimize
+from docbot.storage import open_db, upsert_page
+
+
+class TestFormatBytes(unittest.TestCase):
+    def test_largest_unit(self):
+        self.assertEqual(_format_bytes(512), "512 B")
+        self.assertEqual(_format_bytes(2048), "2.0 KB")
+        self.assertEqual(_format_bytes(5 * 1024**2), "5.0 MB")
+        self.assertEqual(_format_bytes(3 * 1024**3 // 2), "1.5 GB")
+
+
+class TestRunOptimize(unittest.TestCase):
+    def test_into_copy_is_not_modified(self):
+        with tempfile.TemporaryDirectory() as d:
+            src, dest = os.path.join(d, "index.db"), os.path.join(d, "serve.db")
+            conn = open_db(src)
+            upsert_page(conn, "https://example.com/en-us/a", "en-us", "Helm upgrade", "", "", "", "", "", 0)
+            conn.close()
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(run_optimize(src, into=dest), 0)
+            self.assertFalse(os.path.exists(f"{dest}-wal"))
+            out = sqlite3.connect(dest)
+            mode = out.execute("PRAGMA journal_mode").fetchone()[0]
+            out.close()
+            self.assertEqual(mode, "delete")
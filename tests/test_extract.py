@@ -0,0 +1,115 @@
+"""extract モジュールのユニットテスト"""
+import unittest
+
+from docbot.extract import (
+    extract_page,
+    extract_index_fields,
+    extract_headings_and_body_prefix,
+    extract_main_text_with_headings,
+    extract_sections_markdown,
+)
+
+BASE = "https://enterprise-docs.dify.ai/versions/3-0-x/ja-jp/deployment/intro"
+
+HTML = """<html><head><title>インストール - Dify Enterprise Docs</title></head>
+<body>
+<nav><a href="/versions/3-0-x/ja-jp/a">A</a><a href=" b#sec ">B</a><a href="/versions/3-0-x/ja-jp/a">A2</a></nav>
+<main><article>
+<h1>インストール</h1>
+<p>Dify Enterprise を Helm でインストールする手順を説明します。前提条件と構成を確認してください。</p>
+<h2>前提条件</h2>
+<ul><li>Kubernetes 1.24 以上のクラスタが必要です</li><li>Helm 3 がインストールされていること</li></ul>
+<h3>リソース</h3>
+<table><tr><th>項目</th><td>値</td></tr></table>
+<pre><code>helm install dify dify/dify</code></pre>
+<p>インストール後は管理画面からライセンスを有効化してください。詳細は次のページを参照します。</p>
+</article></main>
+</body></html>"""
+
+
+MINTLIFY_HTML = """<html><head><title>インストール - Dify Enterprise Docs</title><script>var x = 1;</script></head>
+<body>
+<div id="sidebar"><ul><li><a href="/versions/3-0-x/ja-jp/a">サイドバーの項目</a></li></ul></div>
+<div id="content-area">
+<header id="header"><div class="eyebrow">デプロイ</div><h1 id="page-title">インストール</h1></header>
+<div class="mdx-content prose" id="content">
+<p>Dify Enterprise を Helm でインストールする手順を説明します。</p>
+<h2>前提条件</h2>
+<ul><li>Kubernetes 1.24 以上</li></ul>
+<pre><code>helm install dify dify/dify</code><button>Copy</button></pre>
+</div>
+<div class="feedback"><p>Was this page helpful?</p></div>
+<footer id="footer"><p>Powered by Mintlify</p></footer>
+</div>
+</body></html>"""
+
+
+class TestExtractPage(unittest.TestCase):
+    """1 回のパースで既存の抽出関数と同じ結果になる"""
+
+    def test_same_as_separate_extractors(self):
+        page = extract_page(HTML, base_url=BASE, body_prefix_len=4000)
+        self.assertEqual((page["title"], page["hpath"], page["lead"]), extract_index_fields(HTML))
+        self.assertEqual(
+            (page["headings"], page["body_prefix"]),
+            extract_headings_and_body_prefix(HTML, body_prefix_len=4000),
+        )
+        self.assertEqual(page["sections"], extract_main_text_with_headings(HTML))
+
+    def test_nav_links_resolved_and_deduped(self):
+        page = extract_page(HTML, base_url=BASE)
+        self.assertEqual(
+            page["nav_links"],
+            [
+                "https://enterprise-docs.dify.ai/versions/3-0-x/ja-jp/a",
+                "https://enterprise-docs.dify.ai/versions/3-0-x/ja-jp/deployment/b#sec",
+            ],
+        )
+
+    def test_body_prefix_len(self):
+        page = extract_page(HTML, body_prefix_len=20)
+        self.assertEqual(len(page["body_prefix"]), 20)
+
+    def test_empty_html(self):
+        page = extract_page("")
+        self.assertEqual(page["title"], "")
+        self.assertEqual(page["sections"], [])
+
+
+class TestMintlifyFastPath(unittest.TestCase):
+    """Mintlify の本文コンテナは XPath で直接取り、無ければ readability"""
+
+    def test_fast_path(self):
+        page = extract_page(MINTLIFY_HTML, base_url=BASE)
+        self.assertEqual(page["via"], "mintlify")
+        self.assertEqual(page["title"], extract_page(MINTLIFY_HTML, fast=False)["title"])
+        self.assertEqual(page["hpath"], "インストール | 前提条件")
+        self.assertEqual(page["headings"], "前提条件")
+        self.assertEqual(page["lead"], "Dify Enterprise を Helm でインストールする手順を説明します。")
+        # サイドバー・フッター・ボタンは本文に入らない
+        for noise in ("サイドバー", "helpful", "Mintlify", "Copy"):
+            self.assertNotIn(noise, page["body_prefix"] + str(page["sections"]))
+        self.assertEqual(
+            page["sections"][-1],
+            {"heading": "前提条件", "text": "Kubernetes 1.24 以上\nhelm install dify dify/dify\nhelm install dify dify/dify"},
+        )
+        self.assertIn("https://enterprise-docs.dify.ai/versions/3-0-x/ja-jp/a", page["nav_links"])
+        self.assertGreater(page["extract_ms"], 0)
+
+    def test_fallback_to_readability(self):
+        self.assertEqual(extract_page(HTML)["via"], "readability")
+        self.assertEqual(extract_page(MINTLIFY_HTML, fast=False)["via"], "readability")
+
+
+class TestSectionsMarkdown(unittest.TestCase):
+    """release notes（Markdown）のセクション化"""
+
+    def test_split_by_headings(self):
+        md = "# v3.0.0\n\nRelease summary.\n\n## Breaking changes\n\n- Removed `api.foo`\n- Renamed bar\n\n### Empty\n"
+        self.assertEqual(
+            extract_sections_markdown(md),
+            [
+                {"heading": "v3.0.0", "text": "Release summary."},
+                {"heading": "Breaking changes", "text": "- Removed `api.foo`\n- Renamed bar"},
+            ],
+        )
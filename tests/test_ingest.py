@@ -0,0 +1,646 @@
+"""ingest モジュールのユニットテスト（HTTP は httpx.MockTransport）"""
+import asyncio
+import contextlib
+import dataclasses
+import io
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+
+from docbot import ingest
+from docbot.archive import ResponseArchive
+from docbot.config import CFG
+from docbot.storage import (
+    BulkWriter,
+    CrawlCheckpoint,
+    apply_schema,
+    load_fetched_at,
+    load_sections,
+    load_validators,
+)
+
+BASE = "https://enterprise-docs.dify.ai/versions/3-0-x/ja-jp"
+
+
+def _page(title: str, links: list[str]) -> str:
+    anchors = "".join(f'<a href="{u}">{u}</a>' for u in links)
+    return (
+        f"<html><head><title>{title}</title></head><body><nav>{anchors}</nav>"
+        f"<main><h1>{title}</h1><p>{title} の説明です。インストールと設定の手順をまとめています。</p></main>"
+        "</body></html>"
+    )
+
+
+SITE = {
+    # fragment / 末尾スラッシュ違いのリンクは正規化で同じページになる
+    f"{BASE}/introduction": _page(
+        "はじめに", [f"{BASE}/install", f"{BASE}/install#step-1", f"{BASE}/config", f"{BASE}/config/"]
+    ),
+    f"{BASE}/install": _page("インストール", [f"{BASE}/introduction", f"{BASE}/config"]),
+    f"{BASE}/config": _page("設定", [f"{BASE}/missing"]),
+}
+
+REQUESTED: list[str] = []
+
+
+def _handler(request: httpx.Request) -> httpx.Response:
+    url = str(request.url)
+    REQUESTED.append(url)
+    body = SITE.get(url)
+    if body is None:
+        return httpx.Response(404)
+    etag = f'"{hash(body)}"'
+    if request.headers.get("if-none-match") == etag:
+        return httpx.Response(304)
+    # /install は ETag を返さない（content_hash で判定される）
+    headers = {"content-type": "text/html"}
+    if not url.endswith("/install"):
+        headers["etag"] = etag
+    return httpx.Response(200, text=body, headers=headers)
+
+
+class TestCanonicalizeUrl(unittest.TestCase):
+    def test_canonicalize(self):
+        canon = f"{BASE}/install"
+        for u in (
+            canon,
+            f"{BASE}/install#step-1",
+            f"{BASE}/install/",
+            f"{BASE}/install?utm_source=x#a",
+            f"HTTPS://Enterprise-Docs.dify.ai:443/versions/3-0-x/ja-jp//install",
+        ):
+            self.assertEqual(ingest.canonicalize_url(u), canon, u)
+        self.assertEqual(ingest.canonicalize_url("https://example.com"), "https://example.com/")
+
+    def test_extract_nav_links(self):
+        html = (
+            f'<a href="{BASE}/a#x">1</a><a href="a/">2</a><a href="b?y=1">3</a>'
+            '<a href="https://example.com/z">4</a>'
+        )
+        links = ingest.extract_nav_links(f"{BASE}/", html)
+        self.assertEqual(links, [f"{BASE}/a", f"{BASE}/b"])
+
+    def test_url_duplicate_report(self):
+        rep = ingest.url_duplicate_report(
+            [f"{BASE}/a", f"{BASE}/a#x", f"{BASE}/a/", f"{BASE}/b", f"{BASE}/b#y"]
+        )
+        self.assertEqual((rep["rows"], rep["canonical"], rep["duplicates"]), (5, 2, 3))
+        self.assertEqual(rep["examples"][0][0], f"{BASE}/a")
+
+
+class TestCrawl(unittest.TestCase):
+    """fetch → 抽出 → 書き込みのパイプライン"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+        REQUESTED.clear()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _crawl(
+        self, validators=None, initial=None, checkpoint=None, crawl_id=None, stats=None,
+        extract=ingest.extract_record, **overrides,
+    ) -> int:
+        cfg = dataclasses.replace(CFG, **overrides)
+
+        async def run():
+            writer = BulkWriter(self.conn, batch_size=2, crawl_id=crawl_id)
+            async with httpx.AsyncClient(transport=httpx.MockTransport(_handler)) as client:
+                n = await ingest.crawl(
+                    client, writer, initial or [f"{BASE}/introduction"], validators,
+                    extract=extract, checkpoint=checkpoint, stats=stats,
+                )
+            writer.close()
+            return n
+
+        with mock.patch.object(ingest, "CFG", cfg):
+            return asyncio.run(run())
+
+    def test_crawl_inline_extract(self):
+        self.assertEqual(self._crawl(extract_workers=0, concurrency=2), 3)
+        self.assertEqual(len(REQUESTED), len(set(REQUESTED)))
+        self.assertFalse([u for u in REQUESTED if "#" in u or u.endswith("/")])
+        titles = {r[0] for r in self.conn.execute("SELECT title FROM pages")}
+        self.assertEqual(titles, {"はじめに", "インストール", "設定"})
+        sections = load_sections(self.conn, [f"{BASE}/introduction"])[f"{BASE}/introduction"]
+        self.assertEqual(sections[0]["heading"], "はじめに")
+
+    def test_crawl_process_pool(self):
+        self.assertEqual(self._crawl(extract_workers=1, concurrency=1), 3)
+
+    def test_max_pages(self):
+        self.assertEqual(self._crawl(extract_workers=0, max_pages=2), 2)
+
+    def test_max_depth(self):
+        self.assertEqual(self._crawl(extract_workers=0, max_depth=0), 1)
+
+    def test_incremental_skips_unchanged(self):
+        self._crawl(extract_workers=0)
+        validators = load_validators(self.conn)
+        self.assertTrue(all(v[2] for v in validators.values()))
+        self.assertIsNone(validators[f"{BASE}/install"][0])
+        self.conn.execute("UPDATE pages SET title = 'old'")
+        self.conn.commit()
+        n = self._crawl(validators=validators, initial=list(validators), extract_workers=0)
+        self.assertEqual(n, 0)
+        # 304 / hash 一致のページは書き換えない
+        titles = {r[0] for r in self.conn.execute("SELECT title FROM pages")}
+        self.assertEqual(titles, {"old"})
+
+    def test_incremental_updates_changed(self):
+        self._crawl(extract_workers=0)
+        validators = load_validators(self.conn)
+        url = f"{BASE}/config"
+        with mock.patch.dict(SITE, {url: _page("設定（改訂）", [])}):
+            n = self._crawl(validators=validators, initial=list(validators), extract_workers=0)
+        self.assertEqual(n, 1)
+        title = self.conn.execute("SELECT title FROM pages WHERE url = ?", (url,)).fetchone()[0]
+        self.assertEqual(title, "設定（改訂）")
+
+
+    def test_crawl_marks_seen_pages(self):
+        self._crawl(extract_workers=0, crawl_id=1)
+        validators = load_validators(self.conn)
+        url = f"{BASE}/config"
+        # 2 回目: 304 / 未変更のページも見えた扱い、404 になったページは前の世代のまま
+        with mock.patch.dict(SITE):
+            del SITE[url]
+            self._crawl(validators=validators, initial=list(validators), extract_workers=0, crawl_id=2)
+        seen = dict(self.conn.execute("SELECT url, crawl_id FROM page_seen"))
+        self.assertEqual(seen, {f"{BASE}/introduction": 2, f"{BASE}/install": 2, url: 1})
+
+    def test_unchanged_pages_not_reselected_by_sitemap(self):
+        self._crawl(extract_workers=0, crawl_id=1)
+        self.conn.execute("UPDATE pages SET fetched_at = 100")
+        self.conn.execute("UPDATE page_seen SET checked_at = 100")
+        self.conn.commit()
+        entries = [(url, 200) for url in SITE]  # lastmod だけ進んだ（中身は同じ）
+        self.assertEqual(len(ingest.select_changed(entries, load_fetched_at(self.conn))), 3)
+        validators = load_validators(self.conn)
+        n = self._crawl(validators=validators, initial=list(validators), extract_workers=0, crawl_id=2)
+        self.assertEqual(n, 0)
+        # 304 / hash 一致で確認した時刻が残るので、次の sitemap 差分では対象にならない
+        self.assertEqual(ingest.select_changed(entries, load_fetched_at(self.conn)), [])
+
+    def test_stats_count_failures(self):
+        def extract(url, raw):
+            if url.endswith("/config"):
+                raise ValueError("broken")
+            return ingest.extract_record(url, raw)
+
+        stats = {}
+        self.assertEqual(self._crawl(stats=stats, extract=extract, extract_workers=0), 2)
+        # /config のリンク（/missing）は辿れない
+        self.assertEqual(stats, {"fetches": 3, "errors": 0, "extract_errors": 1})
+        self.assertEqual(ingest.crawl_failure(stats), "抽出失敗 1 件")
+        stats = {}
+        self._crawl(stats=stats, extract_workers=0)
+        # /missing の 404 は失敗に数えない
+        self.assertEqual(stats, {"fetches": 4, "errors": 0, "extract_errors": 0})
+        self.assertIsNone(ingest.crawl_failure(stats))
+
+    def test_crawl_failure_fraction(self):
+        cfg = dataclasses.replace(CFG, crawl_max_error_fraction=0.05)
+        with mock.patch.object(ingest, "CFG", cfg):
+            self.assertIsNone(ingest.crawl_failure({"fetches": 100, "errors": 5, "extract_errors": 0}))
+            self.assertIn("6 / 100", ingest.crawl_failure({"fetches": 100, "errors": 6, "extract_errors": 0}))
+
+    def test_resume_from_checkpoint(self):
+        # max_pages で打ち切った run を中断とみなす
+        n = self._crawl(checkpoint=CrawlCheckpoint(self.conn), extract_workers=0, concurrency=1, max_pages=1)
+        self.assertEqual(n, 1)
+        frontier, visited, written = CrawlCheckpoint(self.conn).load()
+        self.assertEqual(visited, {f"{BASE}/introduction"})
+        self.assertEqual(written, 1)
+        self.assertEqual(frontier, {f"{BASE}/install": 1, f"{BASE}/config": 1})
+
+        REQUESTED.clear()
+        checkpoint = CrawlCheckpoint(self.conn)
+        n = self._crawl(checkpoint=checkpoint, extract_workers=0, checkpoint_every=1)
+        self.assertEqual(n, 3)
+        self.assertNotIn(f"{BASE}/introduction", REQUESTED)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0], 3)
+        self.assertGreaterEqual(checkpoint.saves, 3)
+        frontier, visited, written = CrawlCheckpoint(self.conn).load()
+        self.assertEqual(frontier, {})
+        self.assertEqual(written, 3)
+        self.assertIn(f"{BASE}/missing", visited)
+
+
+class TestCrawlWindow(unittest.TestCase):
+    """スライディングウィンドウの in-flight 数と、浅い経路が後から見つかったときの再展開"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+        self.requested: list[str] = []
+        self.active = 0
+        self.peak = 0
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _crawl(self, site: dict[str, str], delays: dict[str, float], **overrides) -> int:
+        """site を返す MockTransport（delays の URL は指定秒だけ遅らせる）でクロール"""
+        cfg = dataclasses.replace(CFG, extract_workers=0, adaptive_concurrency=False, **overrides)
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            url = str(request.url)
+            self.requested.append(url)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            try:
+                await asyncio.sleep(delays.get(url, 0))
+            finally:
+                self.active -= 1
+            if url not in site:
+                return httpx.Response(404)
+            return httpx.Response(200, text=site[url], headers={"content-type": "text/html"})
+
+        async def run():
+            writer = BulkWriter(self.conn, batch_size=2)
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                n = await ingest.crawl(client, writer, [f"{BASE}/a"])
+            writer.close()
+            return n
+
+        with mock.patch.object(ingest, "CFG", cfg), contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(run())
+
+    def test_shallower_path_reexpands_links(self):
+        # a → slow, f。f → g → t（depth 3 = max_depth なので t のリンクは展開しない）。
+        # t を書いた後に slow（depth 1）から t へ depth 2 で到達し、t のリンク u を取得する
+        site = {
+            f"{BASE}/a": _page("a", [f"{BASE}/slow", f"{BASE}/f"]),
+            f"{BASE}/slow": _page("slow", [f"{BASE}/t"]),
+            f"{BASE}/f": _page("f", [f"{BASE}/g"]),
+            f"{BASE}/g": _page("g", [f"{BASE}/t"]),
+            f"{BASE}/t": _page("t", [f"{BASE}/u"]),
+            f"{BASE}/u": _page("u", []),
+        }
+        n = self._crawl(site, {f"{BASE}/slow": 0.3}, concurrency=2, max_depth=3)
+        self.assertEqual(n, 6)
+        # t は深い経路で先に取得済み。再取得はせずリンクだけ展開し直す
+        self.assertLess(self.requested.index(f"{BASE}/t"), self.requested.index(f"{BASE}/u"))
+        self.assertEqual(self.requested.count(f"{BASE}/t"), 1)
+        self.assertIn(f"{BASE}/u", self.requested)
+
+    def test_deep_path_only_does_not_expand(self):
+        # 浅い経路が無ければ depth 3 の t のリンクは辿らない（上のテストとの対照）
+        site = {
+            f"{BASE}/a": _page("a", [f"{BASE}/f"]),
+            f"{BASE}/f": _page("f", [f"{BASE}/g"]),
+            f"{BASE}/g": _page("g", [f"{BASE}/t"]),
+            f"{BASE}/t": _page("t", [f"{BASE}/u"]),
+        }
+        self.assertEqual(self._crawl(site, {}, concurrency=2, max_depth=3), 4)
+        self.assertNotIn(f"{BASE}/u", self.requested)
+
+    def test_window_limits_inflight(self):
+        pages = [f"{BASE}/p{i}" for i in range(8)]
+        site = {f"{BASE}/a": _page("a", pages), **{u: _page(u, []) for u in pages}}
+        n = self._crawl(site, {u: 0.05 for u in pages}, concurrency=3)
+        self.assertEqual(n, 9)
+        # 常に concurrency 件まで埋め、それを超えない
+        self.assertEqual(self.peak, 3)
+        self.assertEqual(self.active, 0)
+
+
+_SITEMAP_INDEX = """<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap><loc>https://enterprise-docs.dify.ai/sitemap-1.xml</loc></sitemap>
+  <sitemap><loc>https://enterprise-docs.dify.ai/sitemap-2.xml</loc></sitemap>
+</sitemapindex>"""
+
+
+def _urlset(entries: list[tuple[str, str | None]]) -> str:
+    body = "".join(
+        f"<url><loc>{u}</loc>" + (f"<lastmod>{m}</lastmod>" if m else "") + "</url>"
+        for u, m in entries
+    )
+    return f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{body}</urlset>'
+
+
+class TestSitemapDelta(unittest.TestCase):
+    """sitemap の lastmod による差分対象の選定"""
+
+    def test_parse_lastmod(self):
+        self.assertEqual(ingest.parse_lastmod("2024-01-02"), 1704153600)
+        self.assertEqual(ingest.parse_lastmod("2024-01-02T00:00:00Z"), 1704153600)
+        self.assertEqual(ingest.parse_lastmod("2024-01-02T09:00:00+09:00"), 1704153600)
+        self.assertIsNone(ingest.parse_lastmod(""))
+        self.assertIsNone(ingest.parse_lastmod("yesterday"))
+
+    def test_select_changed(self):
+        entries = [
+            (f"{BASE}/a", 200),  # fetched_at より新しい
+            (f"{BASE}/b", 50),  # 古い
+            (f"{BASE}/c", None),  # lastmod なし
+            (f"{BASE}/d", 10),  # 未取得
+            (f"{BASE}/a", 200),
+        ]
+        fetched = {f"{BASE}/a": 100, f"{BASE}/b": 100, f"{BASE}/c": 100}
+        self.assertEqual(
+            ingest.select_changed(entries, fetched), [f"{BASE}/a", f"{BASE}/c", f"{BASE}/d"]
+        )
+
+    def test_fetch_sitemap_index(self):
+        docs = {
+            "https://enterprise-docs.dify.ai/sitemap.xml": _SITEMAP_INDEX,
+            "https://enterprise-docs.dify.ai/sitemap-1.xml": _urlset(
+                [(f"{BASE}/introduction", "2024-01-02"), ("https://example.com/x", None)]
+            ),
+            "https://enterprise-docs.dify.ai/sitemap-2.xml": _urlset([(f"{BASE}/install", None)]),
+        }
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            body = docs.get(str(request.url))
+            if body is None:
+                return httpx.Response(404)
+            return httpx.Response(200, text=body, headers={"content-type": "application/xml"})
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                return await ingest.fetch_sitemap_entries(client)
+
+        entries = asyncio.run(run())
+        self.assertEqual(
+            sorted(entries, key=lambda e: e[0]),
+            [(f"{BASE}/install", None), (f"{BASE}/introduction", 1704153600)],
+        )
+
+
+HELM = "https://langgenius.github.io/dify-helm"
+HELM_SITE = {
+    f"{HELM}/_sidebar.md": "* [v3.7.5](/pages/3_7_5.md)\n* [v3.7.4](/pages/3_7_4.md)\n* [v3.7.5](/pages/3_7_5.md)\n",
+    f"{HELM}/pages/3_7_5.md": "# v3.7.5\n\n## Fixes\n\nUpgrade the helm chart to fix plugin daemon.\n",
+    f"{HELM}/pages/3_7_4.md": "# v3.7.4\n\n## Features\n\nAdd enterprise gateway options.\n",
+    f"{HELM}/README.md": "# dify-helm\n\nRelease notes.\n",
+}
+
+
+def _helm_handler(request: httpx.Request) -> httpx.Response:
+    body = HELM_SITE.get(str(request.url))
+    if body is None:
+        return httpx.Response(404)
+    return httpx.Response(200, text=body, headers={"content-type": "text/markdown"})
+
+
+class TestHelmReleaseNotes(unittest.TestCase):
+    """release notes も crawl と同じパイプラインで並行取得・バッチ書き込み"""
+
+    def test_ingest_helm(self):
+        conn = sqlite3.connect(":memory:")
+        apply_schema(conn)
+        cfg = dataclasses.replace(CFG, extract_workers=0, concurrency=3)
+
+        async def run():
+            writer = BulkWriter(conn, batch_size=2)
+            async with httpx.AsyncClient(transport=httpx.MockTransport(_helm_handler)) as client:
+                n = await ingest.ingest_helm_release_notes(client, writer)
+            writer.close()
+            return n, writer.batches
+
+        with mock.patch.object(ingest, "CFG", cfg):
+            n, batches = asyncio.run(run())
+        self.assertEqual(n, 3)
+        self.assertEqual(batches, 2)
+        rows = dict(conn.execute("SELECT url, lang FROM pages"))
+        self.assertEqual(set(rows), {f"{HELM}/pages/3_7_5.md", f"{HELM}/pages/3_7_4.md", f"{HELM}/README.md"})
+        self.assertEqual(set(rows.values()), {"en-us"})
+        title = conn.execute("SELECT title FROM pages WHERE url = ?", (f"{HELM}/pages/3_7_5.md",)).fetchone()[0]
+        self.assertEqual(title, "v3.7.5")
+        conn.close()
+
+
+class TestMain(unittest.TestCase):
+    """ingest.main（archive の replay でネットワークなし）"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.cfg = dataclasses.replace(
+            CFG, db_path=os.path.join(self.dir, "index.db"), seed_urls=(f"{BASE}/introduction",),
+            extract_workers=0,
+        )
+
+    def _archive(self, site: dict[str, str]) -> str:
+        """site を記録済みのアーカイブを作る。site に無い URL は記録時の 404 として入れる"""
+        archive = ResponseArchive(os.path.join(self.dir, "archive"))
+        for url, body in {**site, **HELM_SITE}.items():
+            ctype = "text/markdown" if url.endswith(".md") else "text/html"
+            archive.put(url, 200, [("content-type", ctype), ("etag", f'"{len(body)}"')], body.encode())
+        for url in (f"{BASE}/missing", f"https://{CFG.host}/llms.txt"):
+            archive.put(url, 404, [], b"")
+        archive.close()
+        return str(archive.root)
+
+    def _run(self, archive_dir: str, **kwargs) -> int | None:
+        """replay で main を実行し、meta.complete_crawl を返す"""
+        with mock.patch.object(ingest, "CFG", self.cfg), contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(ingest.main(archive_mode="replay", archive_dir=archive_dir, gc=True, **kwargs))
+        conn = sqlite3.connect(self.cfg.db_path)
+        row = conn.execute("SELECT value FROM meta WHERE key = 'complete_crawl'").fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def test_incremental_bfs_marks_complete(self):
+        archive_dir = self._archive(SITE)
+        self.assertEqual(self._run(archive_dir), 1)
+        # 2 回目は全ページ 304（release notes も 0 件書き込み）でも完走
+        self.assertEqual(self._run(archive_dir, incremental=True), 2)
+
+    def test_refuses_published_snapshot_without_publish(self):
+        archive_dir = self._archive(SITE)
+        self._run(archive_dir, publish=True)
+        published = os.path.realpath(self.cfg.db_path)
+        mtime = os.path.getmtime(published)
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            self._run(archive_dir)
+        self.assertIn("--publish", err.getvalue())
+        self.assertEqual(os.path.getmtime(published), mtime)
+        self.assertFalse(os.path.exists(published + "-wal"))
+
+    def test_mostly_failed_crawl_is_not_complete(self):
+        self.assertEqual(self._run(self._archive(SITE)), 1)
+        # /install が 403 になった（4 fetch 中 1 件が失敗）。失敗したページのリンク先は見えていないので完走にしない
+        archive = ResponseArchive(os.path.join(self.dir, "archive"))
+        archive.put(f"{BASE}/install", 403, [], b"")
+        archive.close()
+        self.assertEqual(self._run(str(archive.root)), 1)
+
+    def test_replay_miss_is_not_a_deletion(self):
+        self.assertEqual(self._run(self._archive(SITE)), 1)
+        # 記録し直したアーカイブに /config が無い（削除されたのではなく記録していない）
+        shutil.rmtree(os.path.join(self.dir, "archive"))
+        archive_dir = self._archive({u: b for u, b in SITE.items() if not u.endswith("/config")})
+        self.assertEqual(self._run(archive_dir), 1)
+        conn = sqlite3.connect(self.cfg.db_path)
+        urls = {r[0] for r in conn.execute("SELECT url FROM pages")}
+        conn.close()
+        self.assertIn(f"{BASE}/config", urls)
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    """AIMD の同時数制御と 429 / 5xx の再試行"""
+
+    def setUp(self):
+        cfg = dataclasses.replace(
+            CFG, concurrency=4, min_concurrency=1, max_concurrency=8,
+            latency_target=1.0, retry_backoff=0.001, fetch_retries=2,
+        )
+        patcher = mock.patch.object(ingest, "CFG", cfg)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_additive_increase_multiplicative_decrease(self):
+        async def run():
+            lim = ingest.HostLimiter("example.com")
+            for _ in range(8):
+                await lim.acquire()
+                lim.release(200, 0.1)
+            grown = lim.limit
+            await lim.acquire()
+            lim.release(429, 0.1)
+            halved = lim.limit
+            # 同じ RTT 内の失敗では続けて下げない
+            await lim.acquire()
+            lim.release(503, 0.1)
+            return grown, halved, lim.limit
+
+        grown, halved, after = asyncio.run(run())
+        self.assertGreater(grown, 5.0)
+        self.assertLessEqual(grown, 8.0)
+        self.assertAlmostEqual(halved, grown / 2)
+        self.assertAlmostEqual(after, halved)
+
+    def test_slow_responses_do_not_increase(self):
+        async def run():
+            lim = ingest.HostLimiter("example.com")
+            for _ in range(8):
+                await lim.acquire()
+                lim.release(200, 5.0)
+            return lim.limit
+
+        self.assertEqual(asyncio.run(run()), 4.0)
+
+    def test_acquire_respects_limit(self):
+        async def run():
+            lim = ingest.HostLimiter("example.com")
+            for _ in range(4):
+                await lim.acquire()
+            waiter = asyncio.ensure_future(lim.acquire())
+            await asyncio.sleep(0.01)
+            blocked = not waiter.done()
+            lim.release(200, 5.0)
+            await asyncio.wait_for(waiter, 1)
+            return blocked, lim.active
+
+        self.assertEqual(asyncio.run(run()), (True, 4))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(ingest.parse_retry_after("3"), 3.0)
+        self.assertEqual(ingest.parse_retry_after("99999"), CFG.max_retry_after)
+        self.assertEqual(ingest.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+        self.assertIsNone(ingest.parse_retry_after("soon"))
+        self.assertIsNone(ingest.parse_retry_after(None))
+
+    def test_fetch_retries_throttled(self):
+        calls = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(str(request.url))
+            if len(calls) < 3:
+                return httpx.Response(429 if len(calls) == 1 else 503, headers={"retry-after": "0"})
+            return httpx.Response(200, text="<html>ok</html>", headers={"content-type": "text/html"})
+
+        async def run():
+            limiter = ingest.AdaptiveLimiter()
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                res = await ingest.fetch_page(client, f"{BASE}/a", limiter=limiter)
+            return res, limiter.for_url(f"{BASE}/a")
+
+        (status, text, _, _), host = asyncio.run(run())
+        self.assertEqual((status, text), (200, "<html>ok</html>"))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual((host.throttled, host.retries), (2, 2))
+        self.assertLess(host.limit, 4.0)
+
+    def test_fetch_gives_up_after_retries(self):
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(503)
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                return await ingest.fetch_page(client, f"{BASE}/a", limiter=ingest.AdaptiveLimiter())
+
+        self.assertEqual(asyncio.run(run()), (503, None, None, None))
+
+    def test_crawl_inflight_counts_only_held_slots(self):
+        conn = sqlite3.connect(":memory:")
+        apply_schema(conn)
+        children = [f"{BASE}/p{i}" for i in range(12)]
+        site = {f"{BASE}/introduction": _page("root", children), **{u: _page(u, []) for u in children}}
+        active = peak = 0
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.02)
+            active -= 1
+            return httpx.Response(200, text=site[str(request.url)], headers={"content-type": "text/html"})
+
+        async def run():
+            writer = BulkWriter(conn)
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                n = await ingest.crawl(client, writer, [f"{BASE}/introduction"])
+            writer.close()
+            return n
+
+        # 応答が latency_target より遅いので limit は 2 のまま。ワーカーは max_concurrency=8 本
+        cfg = dataclasses.replace(ingest.CFG, extract_workers=0, concurrency=2, latency_target=0.001)
+        out = io.StringIO()
+        with mock.patch.object(ingest, "CFG", cfg), contextlib.redirect_stdout(out):
+            self.assertEqual(asyncio.run(run()), 13)
+        conn.close()
+        self.assertEqual(peak, 2)
+        line = [ln for ln in out.getvalue().splitlines() if ln.startswith("crawl:")][-1]
+        avg, slots, ratio = re.search(r"in-flight avg ([\d.]+)/([\d.]+) \((\d+)%\)", line).groups()
+        self.assertLessEqual(float(avg), 2.0)
+        self.assertEqual(float(slots), 2.0)
+        self.assertGreater(int(ratio), 50)
+        self.assertLessEqual(int(ratio), 100)
+
+    def test_crawl_recovers_from_throttling(self):
+        conn = sqlite3.connect(":memory:")
+        apply_schema(conn)
+        throttled = set()
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            url = str(request.url)
+            if url not in throttled:
+                throttled.add(url)
+                return httpx.Response(429)
+            return _handler(request)
+
+        async def run():
+            writer = BulkWriter(conn)
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                n = await ingest.crawl(client, writer, [f"{BASE}/introduction"])
+            writer.close()
+            return n
+
+        with mock.patch.object(ingest, "CFG", dataclasses.replace(ingest.CFG, extract_workers=0)):
+            self.assertEqual(asyncio.run(run()), 3)
+        conn.close()
@@ -0,0 +1,300 @@
+"""server モジュールのユニットテスト（/ask の取得は httpx.MockTransport）"""
+import asyncio
+import dataclasses
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import httpx
+from fastapi.testclient import TestClient
+
+from docbot import server
+from docbot.ingest import extract_record
+from docbot.storage import BulkWriter, build_db_path, open_db, publish_index, upsert_page
+from tests.test_extract import BASE, MINTLIFY_HTML
+
+
+class TestAsk(unittest.TestCase):
+    def test_search_runs_off_event_loop(self):
+        threads = []
+
+        def fake_search(req):
+            threads.append(threading.current_thread())
+            return [], {}
+
+        with mock.patch.object(server, "_ask_search", fake_search):
+            res = asyncio.run(server.ask(server.AskReq(question="helm")))
+        self.assertEqual(res["citations"], [])
+        # プールの接続待ちでループを止めないよう、検索はワーカースレッドで行う
+        self.assertIsNot(threads[0], threading.main_thread())
+
+
+class TestLifespan(unittest.TestCase):
+    def test_published_snapshot_opened_read_only(self):
+        with tempfile.TemporaryDirectory() as d:
+            live = os.path.join(d, "index.db")
+            conn = open_db(build_db_path(live))
+            upsert_page(conn, "https://example.com/en-us/a", "en-us", "Helm upgrade", "", "", "", "", "", 0)
+            published = publish_index(conn, live)
+            conn.close()
+            with mock.patch.object(server, "DB_PATH", live), TestClient(server.app) as client:
+                self.assertEqual(len(client.post("/search", json={"query": "helm"}).json()["hits"]), 1)
+            # 起動時に open_db（WAL 化・SCHEMA）を流さない
+            self.assertFalse(os.path.exists(published + "-wal"))
+            snap = sqlite3.connect(published)
+            self.assertEqual(snap.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+            snap.close()
+
+
+class TestSearchEndpoints(unittest.TestCase):
+    """/search の fields・snippet と /search/batch"""
+
+    BASE = "https://example.com/en-us"
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "index.db")
+        conn = open_db(path)
+        for name in ("a", "b", "c"):
+            upsert_page(
+                conn, f"{self.BASE}/{name}", "en-us", f"Helm upgrade {name}", "Upgrade > Helm", f"Lead {name}",
+                "Prerequisites", f"Back up the database, then run helm upgrade for {name}.", "", 0,
+            )
+        upsert_page(conn, f"{self.BASE}/compose", "en-us", "Docker Compose", "", "", "", "docker compose up", "", 0)
+        conn.close()
+        for patcher in (
+            mock.patch.object(server, "DB_PATH", path),
+            mock.patch.object(server, "_cache", server.SearchCache()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = TestClient(server.app)
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+
+    def test_fields_projection(self):
+        hits = self.client.post("/search", json={"query": "helm upgrade", "fields": ["title"]}).json()["hits"]
+        self.assertEqual(len(hits), 3)
+        # url と score は常に返す
+        self.assertTrue(all(set(h) == {"url", "title", "score"} for h in hits))
+        full = self.client.post("/search", json={"query": "helm upgrade"}).json()["hits"]
+        self.assertEqual([h["url"] for h in hits], [h["url"] for h in full])
+        self.assertEqual(full[0]["body_prefix"][:10], "Back up th")
+        self.assertEqual(full[0]["headings"], "Prerequisites")
+
+    def test_snippet(self):
+        r = self.client.post("/search", json={"query": "database", "fields": ["title"], "snippet": True})
+        hits = r.json()["hits"]
+        self.assertEqual(len(hits), 3)
+        self.assertTrue(all(set(h) == {"url", "title", "snippet", "score"} for h in hits))
+        self.assertTrue(all("database" in h["snippet"] for h in hits))
+
+    def test_unknown_field_rejected(self):
+        self.assertEqual(self.client.post("/search", json={"query": "helm", "fields": ["norm"]}).status_code, 422)
+
+    def test_batch_matches_single_searches(self):
+        queries = [
+            {"query": "helm upgrade", "fields": ["title"]},
+            {"query": "docker compose", "lang": "en-us"},
+            {"query": "helm upgrade", "limit": 1, "snippet": True},
+        ]
+        r = self.client.post("/search/batch", json={"queries": queries})
+        self.assertEqual(r.status_code, 200)
+        results = r.json()["results"]
+        # 入力と同じ順で、それぞれ /search と同じ結果
+        self.assertEqual(len(results), 3)
+        for q, res in zip(queries, results):
+            self.assertEqual(res, self.client.post("/search", json=q).json())
+        self.assertEqual(results[1]["hits"][0]["url"], f"{self.BASE}/compose")
+
+    def test_batch_too_many_queries(self):
+        cfg = dataclasses.replace(server.CFG, search_batch_max=2)
+        with mock.patch.object(server, "CFG", cfg):
+            r = self.client.post("/search/batch", json={"queries": [{"query": "helm"}] * 3})
+            self.assertEqual(r.status_code, 400)
+            self.assertEqual(r.json()["type"], "ValueError")
+            self.assertIn("max 2", r.json()["error"])
+            self.assertEqual(self.client.post("/search/batch", json={"queries": [{"query": "helm"}] * 2}).status_code, 200)
+
+
+def _html(title: str, text: str) -> str:
+    return f"<html><head><title>{title}</title></head><body><main><h1>{title}</h1><p>{text}</p></main></body></html>"
+
+
+class TestLiveFetch(unittest.TestCase):
+    """live_fallback の取得（PageCache と deadline・キャンセル）"""
+
+    SLOW = "https://example.com/slow"
+    FAST = "https://example.com/fast"
+    GONE = "https://example.com/gone"
+
+    def setUp(self):
+        self.requested: list[str] = []
+        self.cancelled: list[str] = []
+        patcher = mock.patch.object(server, "_pages", server.PageCache(maxsize=8, ttl=60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def _handler(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        self.requested.append(url)
+        if url == self.GONE:
+            return httpx.Response(404)
+        if url == self.SLOW:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                self.cancelled.append(url)
+                raise
+        return httpx.Response(200, text=_html("Upgrade", "Run helm upgrade."), headers={"content-type": "text/html"})
+
+    def _run(self, coro_fn):
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(self._handler)) as client:
+                with mock.patch.object(server, "_http", client):
+                    return await coro_fn()
+
+        return asyncio.run(run())
+
+    def test_sections_match_ingest(self):
+        url = f"{BASE}/live"
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, text=MINTLIFY_HTML, headers={"content-type": "text/html"})
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                with mock.patch.object(server, "_http", client):
+                    return await server.fetch_sections(url)
+
+        # live_fallback の引用と ingest で保存するセクション（Mintlify の高速経路）が同じ
+        _, _, stored, (via, _) = extract_record(url, MINTLIFY_HTML)
+        self.assertEqual(via, "mintlify")
+        self.assertEqual(asyncio.run(run()), stored)
+
+    def test_page_cache_lru_and_ttl(self):
+        cache = server.PageCache(maxsize=2, ttl=60)
+        cache.put("a", [{"heading": "A"}])
+        cache.put("b", [{"heading": "B"}])
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("c", [{"heading": "C"}])
+        # 最近使っていない b が追い出される
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), [{"heading": "A"}])
+        expired = server.PageCache(maxsize=2, ttl=-1)
+        expired.put("a", [{"heading": "A"}])
+        self.assertIsNone(expired.get("a"))
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def test_deadline_drops_slow_page(self):
+        t0 = time.perf_counter()
+        got = self._run(lambda: server.fetch_sections_many([self.SLOW, self.FAST, self.GONE], deadline=0.3))
+        self.assertLess(time.perf_counter() - t0, 2)
+        self.assertEqual(list(got), [self.FAST])
+        self.assertEqual(got[self.FAST][0]["heading"], "Upgrade")
+        self.assertEqual(self.cancelled, [self.SLOW])
+
+    def test_cached_page_not_refetched(self):
+        self._run(lambda: server.fetch_sections_many([self.FAST], deadline=1))
+        got = self._run(lambda: server.fetch_sections_many([self.FAST], deadline=1))
+        self.assertIn(self.FAST, got)
+        self.assertEqual(self.requested, [self.FAST])
+        self.assertEqual(server._pages.hits, 1)
+
+    def test_caller_stop_cancels_rest(self):
+        async def first_only():
+            gen = server.iter_fetched_sections([self.SLOW, self.FAST], deadline=5)
+            async for url, _ in gen:
+                await gen.aclose()
+                return url
+
+        self.assertEqual(self._run(first_only), self.FAST)
+        self.assertEqual(self.cancelled, [self.SLOW])
+
+
+class TestAskStream(unittest.TestCase):
+    """/ask/stream のイベント順と打ち切り（保存済みセクション + live_fallback）"""
+
+    BASE = "https://example.com/en-us"
+    LIVE = "https://example.com/en-us/live"
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "index.db")
+        conn = open_db(path)
+        with BulkWriter(conn) as w:
+            for name in ("a", "b"):
+                w.add(
+                    f"{self.BASE}/{name}", "en-us", f"Helm upgrade {name}", "", "", "", "", "", 0,
+                    sections=[{"heading": f"Upgrade {name}", "text": f"Run helm upgrade for {name}. " + "x" * 120}],
+                )
+            # sections の無いページは live_fallback で取得する
+            w.add(self.LIVE, "en-us", "Helm upgrade live", "", "", "", "", "", 0)
+        conn.close()
+        self.requested: list[str] = []
+        self.live_delay = 0.0
+        for patcher in (
+            mock.patch.object(server, "DB_PATH", path),
+            mock.patch.object(server, "_pages", server.PageCache()),
+            mock.patch.object(server, "_cache", server.SearchCache()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def _handler(self, request: httpx.Request) -> httpx.Response:
+        self.requested.append(str(request.url))
+        await asyncio.sleep(self.live_delay)
+        return httpx.Response(
+            200, text=_html("Live", "Run helm upgrade on the live page."), headers={"content-type": "text/html"}
+        )
+
+    def _stream(self, **body) -> tuple[list[dict], float]:
+        with TestClient(server.app) as client:
+            started = server._http
+            server._http = httpx.AsyncClient(transport=httpx.MockTransport(self._handler))
+            try:
+                t0 = time.perf_counter()
+                r = client.post("/ask/stream", json={"question": "helm upgrade", "lang": "en-us", **body})
+                elapsed = time.perf_counter() - t0
+            finally:
+                asyncio.run(server._http.aclose())
+                server._http = started
+        self.assertEqual(r.headers["content-type"], "application/x-ndjson")
+        return [json.loads(line) for line in r.text.splitlines()], elapsed
+
+    def test_event_order(self):
+        events, _ = self._stream(live_fallback=True)
+        types = [e["type"] for e in events]
+        self.assertEqual(types[0], "hits")
+        self.assertEqual(types[-1], "done")
+        self.assertEqual(set(types[1:-1]), {"citation"})
+        urls = [e["url"] for e in events if e["type"] == "citation"]
+        # 保存済みのページを先に、live のページは取得できてから
+        self.assertEqual(sorted(urls[:2]), [f"{self.BASE}/a", f"{self.BASE}/b"])
+        self.assertEqual(urls[2:], [self.LIVE])
+        self.assertEqual(events[-1]["citations"], 3)
+
+    def test_stops_at_max_citations(self):
+        self.live_delay = 3
+        with mock.patch.object(server, "MAX_CITATIONS", 1):
+            events, elapsed = self._stream(live_fallback=True)
+        self.assertEqual([e["type"] for e in events], ["hits", "citation", "done"])
+        # 上限に達したら live の取得を待たない（始めもしない）
+        self.assertLess(elapsed, 2)
+        self.assertEqual(self.requested, [])
+
+    def test_stops_when_budget_spent(self):
+        self.live_delay = 3
+        events, elapsed = self._stream(live_fallback=True, budget=150)
+        citations = [e for e in events if e["type"] == "citation"]
+        self.assertEqual(len(citations), 1)
+        self.assertLessEqual(len(citations[0]["quote"]), 150)
+        self.assertEqual(events[-1], {"type": "done", "answer": server.ASK_ANSWER, "citations": 1})
+        self.assertLess(elapsed, 2)
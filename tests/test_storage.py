@@ -1,14 +1,53 @@
 """storage モジュールのユニットテスト（zh-cn n-gram 検索含む）"""
+import dataclasses
+import json
+import os
 import sqlite3
+import subprocess
+import sys
+import tempfile
 import unittest
+import zlib
+from unittest import mock
 
+from docbot import storage
+from docbot.config import CFG
 from docbot.storage import (
     _query_to_ngrams_cjk,
     _normalize_cjk,
+    _query_to_trigram_or,
+    _rescore_ja,
+    _search_index,
+    compare_cjk_index,
+    compile_query,
+    normalize_fields,
     open_db,
     upsert_page,
     search_index,
-    SCHEMA,
+    search_many,
+    apply_schema,
+    ReadPool,
+    BulkWriter,
+    get_generation,
+    upsert_pages,
+    SearchCache,
+    begin_crawl,
+    CrawlCheckpoint,
+    complete_crawl,
+    gc_stale_pages,
+    index_stats,
+    optimize_index,
+    optimize_into,
+    publish_index,
+    seed_build_db,
+    build_db_path,
+    ReloadingPool,
+    load_sections,
+    load_validators,
+    rank_sections,
+    estimate_tokens,
+    section_terms,
+    decode_sections,
 )
 
 
@@ -38,12 +77,20 @@ class TestQueryToNgramsCjk(unittest.TestCase):
         self.assertIn(" OR ", result)
 
 
+def _pin_ngram_mode(test: unittest.TestCase) -> None:
+    """ja-jp / zh-cn を ngrams 列で索引する設定（trigram_langs=()）に固定する"""
+    patcher = mock.patch.object(storage, "CFG", dataclasses.replace(CFG, trigram_langs=()))
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
 class TestZhCnSearch(unittest.TestCase):
-    """zh-cn 検索の E2E テスト（インメモリ DB）"""
+    """zh-cn 検索の E2E テスト（インメモリ DB、ngram モード）"""
 
     def setUp(self):
+        _pin_ngram_mode(self)
         self.conn = sqlite3.connect(":memory:")
-        self.conn.executescript(SCHEMA)
+        apply_schema(self.conn)
 
     def tearDown(self):
         self.conn.close()
@@ -72,11 +119,12 @@ class TestZhCnSearch(unittest.TestCase):
 
 
 class TestJaJpEnUsUnchanged(unittest.TestCase):
-    """ja-jp / en-us の既存挙動が変わっていないことを確認"""
+    """ja-jp / en-us の既存挙動が変わっていないことを確認（ngram モード）"""
 
     def setUp(self):
+        _pin_ngram_mode(self)
         self.conn = sqlite3.connect(":memory:")
-        self.conn.executescript(SCHEMA)
+        apply_schema(self.conn)
 
     def tearDown(self):
         self.conn.close()
@@ -91,6 +139,7 @@ class TestJaJpEnUsUnchanged(unittest.TestCase):
         hits = search_index(self.conn, "はじめに", lang="ja-jp", limit=5)
         self.assertEqual(len(hits), 1)
         self.assertEqual(hits[0]["title"], "はじめに")
+        self.assertFalse(storage.has_pages_tri(self.conn))
 
     def test_en_us_search_still_works(self):
         """en-us は従来どおり BM25 検索"""
@@ -99,3 +148,690 @@ class TestJaJpEnUsUnchanged(unittest.TestCase):
         hits = search_index(self.conn, "Introduction", lang="en-us", limit=5)
         self.assertEqual(len(hits), 1)
         self.assertEqual(hits[0]["title"], "Introduction")
+
+
+class TestTrigramUnsupported(unittest.TestCase):
+    """trigram に未対応の SQLite（3.34 未満）では trigram_langs があっても pages_tri を作らず ngram で動く"""
+
+    def setUp(self):
+        patcher = mock.patch.object(storage, "TRIGRAM_SUPPORTED", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "index.db")
+
+    def test_open_db_and_search_with_ngrams(self):
+        self.assertEqual(storage.cjk_index_mode("ja-jp"), "ngram")
+        conn = open_db(self.path)
+        self.assertFalse(storage.has_pages_tri(conn))
+        upsert_page(conn, "https://example.com/ja-jp/sso", "ja-jp", "SSO 設定", "", "", "", "", "設定 SSO", 0)
+        with BulkWriter(conn, bulk_build=True) as w:
+            w.add("https://example.com/zh-cn/p", "zh-cn", "插件管理", "", "", "", "", "插件 件管 管理", 0)
+        self.assertEqual([h["title"] for h in search_index(conn, "設定", lang="ja-jp")], ["SSO 設定"])
+        self.assertEqual([h["title"] for h in search_index(conn, "插件", lang="zh-cn")], ["插件管理"])
+        self.assertEqual(list(index_stats(conn)["segments"]), ["pages_fts"])
+        optimize_index(conn, vacuum=False)
+        conn.close()
+
+
+class TestReadPool(unittest.TestCase):
+    """読み取り専用接続プール"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "index.db")
+        conn = open_db(self.path)
+        upsert_page(conn, "https://example.com/en-us/a", "en-us", "Alpha", "", "", "", "", "", 0)
+        conn.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reuses_connection(self):
+        pool = ReadPool(self.path, size=2, timeout=0.1)
+        with pool.connection() as c1:
+            hits = search_index(c1, "Alpha", lang="en-us")
+        with pool.connection() as c2:
+            pass
+        self.assertIs(c1, c2)
+        self.assertEqual(len(hits), 1)
+        pool.close()
+
+    def test_readonly(self):
+        pool = ReadPool(self.path, size=1, timeout=0.1)
+        with pool.connection() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM pages")
+        pool.close()
+
+    def test_timeout_when_exhausted(self):
+        pool = ReadPool(self.path, size=1, timeout=0.05)
+        conn = pool.acquire()
+        with self.assertRaises(TimeoutError):
+            pool.acquire()
+        pool.release(conn)
+        pool.close()
+
+
+class TestSearchCache(unittest.TestCase):
+    """search_index の結果キャッシュ"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+        upsert_page(self.conn, "https://example.com/en-us/a", "en-us", "Helm upgrade", "", "", "", "", "", 0)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_hit_after_miss(self):
+        cache = SearchCache(maxsize=8, ttl=60)
+        first = search_index(self.conn, "helm  upgrade", lang="en-us", limit=5, cache=cache)
+        second = search_index(self.conn, "helm upgrade", lang="en-us", limit=5, cache=cache)
+        self.assertEqual(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_invalidated_by_upsert(self):
+        cache = SearchCache(maxsize=8, ttl=60)
+        self.assertEqual(len(search_index(self.conn, "helm", lang="en-us", cache=cache)), 1)
+        upsert_page(self.conn, "https://example.com/en-us/b", "en-us", "Helm chart", "", "", "", "", "", 0)
+        self.assertEqual(len(search_index(self.conn, "helm", lang="en-us", cache=cache)), 2)
+        self.assertEqual(cache.hits, 0)
+
+    def test_ttl_expiry_and_lru(self):
+        cache = SearchCache(maxsize=1, ttl=0)
+        search_index(self.conn, "helm", lang="en-us", cache=cache)
+        search_index(self.conn, "helm", lang="en-us", cache=cache)
+        self.assertEqual(cache.hits, 0)
+        cache = SearchCache(maxsize=1, ttl=60)
+        search_index(self.conn, "helm", lang="en-us", cache=cache)
+        search_index(self.conn, "upgrade", lang="en-us", cache=cache)
+        self.assertEqual(cache.stats()["size"], 1)
+
+
+class TestPrecomputedNorm(unittest.TestCase):
+    """ingest 時に保存した norm で再スコアする"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_upsert_stores_norm_for_ja(self):
+        upsert_page(
+            self.conn, "https://example.com/ja-jp/p", "ja-jp", "パフォーマンス 設定", "概要",
+            "リード。", "チューニング", "本文", "", 0,
+        )
+        norm = self.conn.execute("SELECT norm FROM pages").fetchone()[0]
+        self.assertEqual(norm, normalize_fields("パフォーマンス 設定", "チューニング", "概要", "リード。", "本文"))
+
+    def test_upsert_skips_norm_for_en(self):
+        upsert_page(self.conn, "https://example.com/en-us/p", "en-us", "Intro", "", "", "", "", "", 0)
+        self.assertIsNone(self.conn.execute("SELECT norm FROM pages").fetchone()[0])
+
+    def test_rescore_same_with_and_without_norm(self):
+        row = ("u", "ja-jp", "SSO 設定", "管理 | SSO", "SSO を設定します", "SAML 設定", "本文 SSO 設定")
+        norm = normalize_fields(row[2], row[5], row[3], row[4], row[6])
+        plan = compile_query("SSO 設定")
+        self.assertEqual(_rescore_ja(row, "SSO 設定"), _rescore_ja(row + (norm,), plan))
+
+    def test_migrate_adds_norm_column(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "old.db")
+            old = sqlite3.connect(path)
+            old.execute(
+                "CREATE TABLE pages (url TEXT PRIMARY KEY, lang TEXT NOT NULL, title TEXT, hpath TEXT, "
+                "lead TEXT, headings TEXT, body_prefix TEXT, ngrams TEXT, fetched_at INTEGER NOT NULL)"
+            )
+            old.close()
+            conn = open_db(path)
+            cols = {r[1] for r in conn.execute("PRAGMA table_info(pages)")}
+            conn.close()
+            self.assertIn("norm", cols)
+
+
+class TestTrigramIndex(unittest.TestCase):
+    """CJK trigram インデックス（pages_tri）"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+        upsert_page(
+            self.conn, "https://example.com/ja-jp/perf", "ja-jp", "パフォーマンスチューニング", "",
+            "リソース割り当てを調整します", "", "", "", 0,
+        )
+        upsert_page(
+            self.conn, "https://example.com/ja-jp/sso", "ja-jp", "SSO 設定", "", "", "", "", "", 0,
+        )
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_trigram_or_query(self):
+        self.assertEqual(_query_to_trigram_or("パフォ"), '"パフォ"')
+        self.assertIsNone(_query_to_trigram_or("設定"))
+
+    def test_trigram_match_without_ngrams_column(self):
+        hits = _search_index(self.conn, "パフォーマンス", "ja-jp", 5, cjk_mode="trigram")
+        self.assertEqual([h["url"] for h in hits], ["https://example.com/ja-jp/perf"])
+        # ngrams 列が空なので ngram モードではヒットしない
+        self.assertEqual(_search_index(self.conn, "パフォーマンス", "ja-jp", 5, cjk_mode="ngram"), [])
+
+    def test_short_query_like_fallback(self):
+        hits = _search_index(self.conn, "設定", "ja-jp", 5, cjk_mode="trigram")
+        self.assertEqual([h["title"] for h in hits], ["SSO 設定"])
+
+    def test_like_fallback_ranks_before_limit(self):
+        for i in range(200):
+            upsert_page(
+                self.conn, f"https://example.com/ja-jp/p{i}", "ja-jp", f"ページ{i}", "", "", "", "本文で設定に触れる", "", 0,
+            )
+        upsert_page(self.conn, "https://example.com/ja-jp/zz", "ja-jp", "設定", "", "", "", "", "", 0)
+        hits = _search_index(self.conn, "設定", "ja-jp", 3, cjk_mode="trigram")
+        # タイトル一致の 2 件（SSO 設定 / 設定）が本文だけの 200 件より前
+        self.assertEqual({h["url"] for h in hits[:2]}, {"https://example.com/ja-jp/sso", "https://example.com/ja-jp/zz"})
+
+    def test_short_word_alongside_long_word(self):
+        upsert_page(self.conn, "https://example.com/ja-jp/auth", "ja-jp", "認証の設定", "", "", "", "", "", 0)
+        hits = _search_index(self.conn, "SSO 設定", "ja-jp", 5, cjk_mode="trigram")
+        self.assertEqual(hits[0]["url"], "https://example.com/ja-jp/sso")
+        self.assertIn("https://example.com/ja-jp/auth", [h["url"] for h in hits])
+
+    def test_no_lang_finds_trigram_pages(self):
+        upsert_page(self.conn, "https://example.com/en-us/sso", "en-us", "SSO", "", "", "", "", "", 0)
+        for q in ("設定", "SSO 設定", "パフォーマンス"):
+            urls = [h["url"] for h in search_index(self.conn, q, limit=5)]
+            self.assertIn("https://example.com/ja-jp/sso" if "設定" in q else "https://example.com/ja-jp/perf", urls)
+        urls = [h["url"] for h in search_index(self.conn, "SSO 設定", limit=5)]
+        self.assertEqual(urls[0], "https://example.com/ja-jp/sso")
+
+    def test_update_and_other_lang_not_indexed(self):
+        upsert_page(
+            self.conn, "https://example.com/ja-jp/perf", "ja-jp", "監視", "", "", "", "", "", 0,
+        )
+        self.assertEqual(_search_index(self.conn, "パフォーマンス", "ja-jp", 5, cjk_mode="trigram"), [])
+        upsert_page(self.conn, "https://example.com/en-us/x", "en-us", "Performance", "", "", "", "", "", 0)
+        n = self.conn.execute("SELECT COUNT(*) FROM pages_tri WHERE pages_tri MATCH 'performance'").fetchone()[0]
+        self.assertEqual(n, 0)
+
+    def test_compare_cjk_index(self):
+        res = compare_cjk_index(self.conn, ["パフォーマンス"], "ja-jp", repeat=1)
+        self.assertGreater(res["sizes"]["pages_tri_bytes"], 0)
+        self.assertEqual(res["queries"][0]["trigram_hits"], 1)
+        # ngrams 列が空の DB でも比較用の複製で ngram 側を作る
+        self.assertEqual(res["queries"][0]["ngram_hits"], 1)
+        self.assertGreater(res["sizes"]["ngrams_column_bytes"], 0)
+
+    def test_migrate_backfills_existing_rows(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "old.db")
+            conn = open_db(path)
+            upsert_page(conn, "https://example.com/ja-jp/a", "ja-jp", "アップグレード", "", "", "", "", "", 0)
+            # pages_tri 追加前の DB を再現
+            conn.execute("DELETE FROM meta WHERE key = 'tri_built'")
+            conn.execute("INSERT INTO pages_tri(pages_tri) VALUES('delete-all')")
+            conn.commit()
+            conn.close()
+            conn = open_db(path)
+            hits = _search_index(conn, "アップグレード", "ja-jp", 5, cjk_mode="trigram")
+            conn.close()
+            self.assertEqual(len(hits), 1)
+
+
+class TestBulkWriter(unittest.TestCase):
+    """バッチ書き込みと bulk build"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _rows(self, n, lang="en-us"):
+        return [(f"https://example.com/{lang}/p{i}", lang, f"Page {i} helm", "", "", "", "", "", 0) for i in range(n)]
+
+    def test_batches(self):
+        n = upsert_pages(self.conn, self._rows(5), batch_size=2)
+        self.assertEqual(n, 5)
+        self.assertEqual(get_generation(self.conn), 3)
+        self.assertEqual(len(search_index(self.conn, "helm", lang="en-us", limit=10)), 5)
+
+    def test_bulk_build_rebuilds_fts_and_restores_triggers(self):
+        with BulkWriter(self.conn, batch_size=2, bulk_build=True) as w:
+            for row in self._rows(3) + self._rows(2, "ja-jp"):
+                w.add(*row)
+            # 書き込み中は FTS に反映されない
+            w.flush()
+            self.assertEqual(search_index(self.conn, "helm", lang="en-us"), [])
+        self.assertEqual(len(search_index(self.conn, "helm", lang="en-us", limit=10)), 3)
+        self.assertEqual(len(_search_index(self.conn, "Page", "ja-jp", 10, cjk_mode="trigram")), 2)
+        self.assertIsNone(self.conn.execute("SELECT 1 FROM meta WHERE key = 'fts_dirty'").fetchone())
+        # トリガーが戻っているので通常の upsert も反映される
+        upsert_page(self.conn, "https://example.com/en-us/new", "en-us", "helm new", "", "", "", "", "", 0)
+        self.assertEqual(len(search_index(self.conn, "helm", lang="en-us", limit=10)), 4)
+
+    def test_interrupted_bulk_build_repaired_on_open(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "index.db")
+            conn = open_db(path)
+            w = BulkWriter(conn, bulk_build=True)
+            for row in self._rows(3):
+                w.add(*row)
+            w.flush()
+            # close() を呼ばずにプロセスが落ちた状態（fts_dirty の pid がもう居ない）
+            dead = subprocess.Popen([sys.executable, "-c", ""])
+            dead.wait()
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'fts_dirty'", (dead.pid,))
+            conn.commit()
+            conn.close()
+            conn = open_db(path)
+            hits = search_index(conn, "helm", lang="en-us", limit=10)
+            conn.close()
+            self.assertEqual(len(hits), 3)
+
+    def test_open_during_bulk_build_leaves_it_alone(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "index.db")
+            conn = open_db(path)
+            w = BulkWriter(conn, bulk_build=True)
+            for row in self._rows(3):
+                w.add(*row)
+            w.flush()
+            # 実行中の build（持ち主のプロセスが生きている）には open_db が FTS rebuild もトリガー復元もしない
+            other = open_db(path)
+            triggers = {r[0] for r in other.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+            self.assertNotIn("pages_ai", triggers)
+            self.assertIsNotNone(other.execute("SELECT 1 FROM meta WHERE key = 'fts_dirty'").fetchone())
+            self.assertEqual(search_index(other, "helm", lang="en-us"), [])
+            other.close()
+            w.close()
+            self.assertEqual(len(search_index(conn, "helm", lang="en-us", limit=10)), 3)
+            conn.close()
+
+    def test_sections(self):
+        rows = self._rows(3)
+        sections = [{"heading": "Install", "text": "helm install dify ./chart\n日本語の本文"}]
+        with BulkWriter(self.conn, batch_size=2) as w:
+            for row in rows[:2]:
+                w.add(*row, etag='"e"', content_hash="h", sections=sections)
+            w.add(*rows[2], etag='"e"', content_hash="h")
+        urls = [r[0] for r in rows]
+        loaded = load_sections(self.conn, urls)
+        self.assertEqual(list(loaded), urls[:2])
+        self.assertEqual([(x["heading"], x["text"]) for x in loaded[urls[0]]], [(sections[0]["heading"], sections[0]["text"])])
+        # BM25 用の統計も保存される（見出しの語は 2 倍）
+        self.assertEqual(loaded[urls[0]][0]["tf"]["install"], 3)
+        self.assertEqual(loaded[urls[0]][0]["tf"]["日本"], 1)
+        # セクションの無いページは差分クロールで取り直す
+        validators = load_validators(self.conn)
+        self.assertEqual(validators[urls[0]], ('"e"', None, "h"))
+        self.assertEqual(validators[urls[2]], (None, None, None))
+        self.conn.execute("DELETE FROM pages WHERE url = ?", (urls[0],))
+        self.assertEqual(list(load_sections(self.conn, urls)), [urls[1]])
+
+
+class TestStaleGC(unittest.TestCase):
+    """クロール世代で見えなかったページの削除"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _crawl(self, written, touched=()):
+        crawl_id = begin_crawl(self.conn)
+        with BulkWriter(self.conn, crawl_id=crawl_id) as w:
+            for i in written:
+                w.add(f"https://example.com/en-us/p{i}", "en-us", f"Page {i} helm", "", "", "", "", "", 0)
+            for i in touched:
+                w.touch(f"https://example.com/en-us/p{i}")
+        complete_crawl(self.conn, crawl_id)
+        return crawl_id
+
+    def test_no_complete_crawl(self):
+        upsert_page(self.conn, "https://example.com/en-us/a", "en-us", "A", "", "", "", "", "", 0)
+        self.assertEqual(gc_stale_pages(self.conn)["status"], "no_complete_crawl")
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0], 1)
+
+    def test_touched_pages_are_not_stale(self):
+        self._crawl(range(10))
+        # 2 回目: 0〜7 は書き換え or 304（touch）、8・9 は見えなかった
+        self._crawl(range(4), touched=range(4, 8))
+        rep = gc_stale_pages(self.conn, dry_run=True)
+        self.assertEqual(rep["status"], "dry_run")
+        self.assertEqual(rep["stale"], 2)
+        self.assertEqual(rep["by_lang"], {"en-us": 2})
+        self.assertEqual(rep["examples"], ["https://example.com/en-us/p8", "https://example.com/en-us/p9"])
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0], 10)
+
+    def test_delete_and_fts_consistent(self):
+        self._crawl(range(10))
+        self._crawl(range(9))
+        generation = get_generation(self.conn)
+        rep = gc_stale_pages(self.conn)
+        self.assertEqual((rep["status"], rep["stale"]), ("deleted", 1))
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0], 9)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM page_seen").fetchone()[0], 9)
+        self.assertGreater(get_generation(self.conn), generation)
+        urls = {h["url"] for h in search_index(self.conn, "helm", lang="en-us", limit=20)}
+        self.assertEqual(len(urls), 9)
+        self.assertNotIn("https://example.com/en-us/p9", urls)
+        self.assertEqual(gc_stale_pages(self.conn)["status"], "clean")
+
+    def test_threshold(self):
+        self._crawl(range(10))
+        self._crawl(range(5))
+        self.assertEqual(gc_stale_pages(self.conn, max_fraction=0.2)["status"], "aborted")
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0], 10)
+        rep = gc_stale_pages(self.conn, max_fraction=0.2, force=True)
+        self.assertEqual((rep["status"], rep["stale"]), ("deleted", 5))
+
+    def test_resume_keeps_crawl_id(self):
+        first = begin_crawl(self.conn)
+        checkpoint = CrawlCheckpoint(self.conn, first)
+        checkpoint.mark("https://example.com/en-us/p0", 0, CrawlCheckpoint.PENDING)
+        checkpoint.save()
+        self.assertEqual(begin_crawl(self.conn, resume=True), first)
+        self.assertEqual(begin_crawl(self.conn), first + 1)
+
+    def test_resume_without_checkpoint_starts_new_crawl(self):
+        # 完走した世代（checkpoint は消えている）や BFS 以外の実行の世代は引き継がない
+        first = self._crawl(range(3))
+        self.assertEqual(begin_crawl(self.conn, resume=True), first + 1)
+        # 中断したが checkpoint を 1 度も保存していない世代も同じ
+        self.assertEqual(begin_crawl(self.conn, resume=True), first + 2)
+
+    def test_resume_drops_checkpoint_of_other_crawl(self):
+        first = begin_crawl(self.conn)
+        checkpoint = CrawlCheckpoint(self.conn, first)
+        checkpoint.mark("https://example.com/en-us/p0", 0, CrawlCheckpoint.VISITED)
+        checkpoint.save()
+        # checkpoint の後に別の世代が払い出された（--resume なしの run が checkpoint を保存せず落ちた等）
+        begin_crawl(self.conn)
+        self.assertEqual(begin_crawl(self.conn, resume=True), first + 2)
+        self.assertEqual(CrawlCheckpoint(self.conn).load(), ({}, set(), 0))
+
+
+class TestOptimize(unittest.TestCase):
+    """docbot optimize（FTS optimize / ANALYZE / VACUUM）と --into"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "index.db")
+        self.conn = open_db(self.path)
+        # 1 行ずつ commit して FTS の segment を増やす
+        for i in range(30):
+            lang = "ja-jp" if i % 2 else "en-us"
+            upsert_page(self.conn, f"https://example.com/{lang}/p{i}", lang, f"Helm 設定 {i}", "", "", "", "本文", "", 0)
+        self.addCleanup(self.conn.close)
+
+    def test_optimize_index(self):
+        before = index_stats(self.conn)
+        self.assertGreater(before["segments"]["pages_fts"], 1)
+        steps = optimize_index(self.conn)
+        self.assertEqual([name for name, _ in steps][:3], ["wal_checkpoint", "fts optimize", "analyze"])
+        after = index_stats(self.conn)
+        self.assertEqual(after["segments"], {"pages_fts": 1, "pages_tri": 1})
+        self.assertEqual(after["freelist_count"], 0)
+        self.assertEqual(len(search_index(self.conn, "helm", lang="en-us", limit=50)), 15)
+
+    def test_optimize_into_leaves_source(self):
+        before = index_stats(self.conn)
+        dest = os.path.join(self.tmp.name, "serve.db")
+        optimize_into(self.conn, dest)
+        self.assertEqual(index_stats(self.conn)["segments"], before["segments"])
+        out = sqlite3.connect(dest)
+        try:
+            self.assertEqual(index_stats(out)["segments"], {"pages_fts": 1, "pages_tri": 1})
+            self.assertEqual(out.execute("SELECT COUNT(*) FROM pages").fetchone()[0], 30)
+            self.assertEqual(len(search_index(out, "helm", lang="en-us", limit=50)), 15)
+        finally:
+            out.close()
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ["index.db", "index.db-shm", "index.db-wal", "serve.db"])
+
+    def test_optimize_into_refuses_source(self):
+        with self.assertRaises(ValueError):
+            optimize_into(self.conn, self.path)
+
+
+class TestPublish(unittest.TestCase):
+    """作業用 DB からの公開と、サーバー側プールの切り替え"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.live = os.path.join(self.tmp.name, "index.db")
+        conn = open_db(self.live)
+        upsert_page(conn, "https://example.com/en-us/a", "en-us", "Alpha", "", "", "", "", "", 0)
+        conn.close()
+
+    def _build(self) -> sqlite3.Connection:
+        build = build_db_path(self.live)
+        self.assertEqual(build, os.path.join(self.tmp.name, "index.build.db"))
+        seed_build_db(build, self.live)
+        conn = open_db(build)
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_publish_swaps_pool_without_dropping_inflight(self):
+        pool = ReloadingPool(self.live, size=2, timeout=0.1, check_interval=0)
+        self.addCleanup(pool.close)
+        inflight = pool.connection()
+        old = inflight.__enter__()
+
+        conn = self._build()
+        upsert_page(conn, "https://example.com/en-us/b", "en-us", "Alpha beta", "", "", "", "", "", 0)
+        published = publish_index(conn, self.live)
+        self.assertTrue(os.path.islink(self.live))
+        self.assertEqual(os.path.realpath(self.live), published)
+
+        with pool.connection() as new:
+            self.assertEqual(len(search_index(new, "alpha", lang="en-us")), 2)
+        self.assertEqual((pool.swaps, pool.current), (1, published))
+        # 切替前に借りた接続は古いファイルのまま使い切れる
+        self.assertEqual(len(search_index(old, "alpha", lang="en-us")), 1)
+        inflight.__exit__(None, None, None)
+        # 次の公開で、置き換え前のファイル名の WAL は片付ける
+        upsert_page(conn, "https://example.com/en-us/c", "en-us", "Alpha gamma", "", "", "", "", "", 0)
+        publish_index(conn, self.live)
+        self.assertFalse(os.path.exists(self.live + "-wal"))
+
+    def test_published_snapshot_is_not_written(self):
+        conn = self._build()
+        published = publish_index(conn, self.live)
+        self.assertTrue(storage.is_published(self.live))
+        self.assertTrue(storage.is_published(published))
+        self.assertFalse(storage.is_published(build_db_path(self.live)))
+        # --publish なしの ingest / gc が公開中のファイルに書かない（WAL にもしない）
+        with self.assertRaises(ValueError):
+            open_db(self.live)
+        self.assertFalse(os.path.exists(published + "-wal"))
+
+    def test_cache_keyed_by_file(self):
+        # 作業用 DB と公開スナップショットは generation が同じでも中身が違いうる
+        conn = self._build()
+        other = os.path.join(self.tmp.name, "other.db")
+        oc = open_db(other)
+        upsert_page(oc, "https://example.com/en-us/x", "en-us", "Alpha x", "", "", "", "", "", 0)
+        upsert_page(oc, "https://example.com/en-us/y", "en-us", "Alpha y", "", "", "", "", "", 0)
+        self.addCleanup(oc.close)
+        with oc:
+            oc.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (get_generation(conn),))
+        cache = SearchCache(maxsize=8, ttl=60)
+        self.assertEqual(len(search_index(conn, "alpha", lang="en-us", cache=cache)), 1)
+        self.assertEqual(len(search_index(oc, "alpha", lang="en-us", cache=cache)), 2)
+        self.assertEqual(cache.hits, 0)
+
+    def test_unchanged_generation_and_prune(self):
+        conn = self._build()
+        first = publish_index(conn, self.live, keep=2)
+        self.assertIsNotNone(first)
+        self.assertIsNone(publish_index(conn, self.live, keep=2))
+        for i in range(3):
+            upsert_page(conn, f"https://example.com/en-us/p{i}", "en-us", "Gamma", "", "", "", "", "", 0)
+            latest = publish_index(conn, self.live, keep=2)
+        versions = sorted(n for n in os.listdir(self.tmp.name) if ".g" in n)
+        self.assertEqual(len(versions), 2)
+        self.assertEqual(os.path.join(self.tmp.name, versions[-1]), latest)
+
+
+class TestRankSections(unittest.TestCase):
+    """/ask の引用選び（BM25 + budget）"""
+
+    PAGES = [
+        ("https://example.com/a", [
+            {"heading": "Overview", "text": "Dify Enterprise overview. " * 60},
+            {"heading": "Upgrade", "text": "Run helm upgrade with the new values.yaml to upgrade."},
+        ]),
+        ("https://example.com/b", [
+            {"heading": "プラグイン", "text": "プラグインデーモンの設定を変更します。"},
+            {"heading": "Helm upgrade notes", "text": "Before helm upgrade, back up the database."},
+        ]),
+    ]
+
+    def test_relevant_sections_across_pages(self):
+        ranked = rank_sections("helm upgrade", self.PAGES)
+        self.assertEqual([r["heading"] for r in ranked], ["Helm upgrade notes", "Upgrade"])
+        self.assertGreater(ranked[0]["score"], ranked[1]["score"])
+        ranked = rank_sections("プラグインの設定", self.PAGES)
+        self.assertEqual(ranked[0]["url"], "https://example.com/b")
+        self.assertEqual(ranked[0]["heading"], "プラグイン")
+
+    def test_budget(self):
+        ranked = rank_sections("dify overview helm", self.PAGES, budget=500)
+        self.assertLessEqual(sum(len(r["quote"]) for r in ranked), 500)
+        self.assertEqual(ranked[0]["heading"], "Overview")
+        ranked = rank_sections("dify overview helm", self.PAGES, budget=100, unit="tokens")
+        self.assertLessEqual(sum(estimate_tokens(r["quote"]) for r in ranked), 100)
+        self.assertEqual(estimate_tokens("プラグイン abcdefgh"), 5 + 3)
+
+    def test_token_budget_with_cjk_prefix(self):
+        pages = [("https://example.com/ja", [{"heading": "設定", "text": "設定の手順" * 60 + " values.yaml" * 60}])]
+        (r,) = rank_sections("設定", pages, budget=150, unit="tokens")
+        self.assertLessEqual(estimate_tokens(r["quote"]), 150)
+        self.assertEqual(len(r["quote"]), 150)
+
+    def test_token_budget_skips_cjk_quote_that_does_not_fit(self):
+        # 60 トークンに入る CJK の先頭は 120 文字未満なので飛ばし、後ろの英数字の quote（50 トークン）を入れる
+        pages = [
+            ("https://example.com/ja", [{"heading": "helm 設定", "text": "helm の設定手順です。" * 30}]),
+            ("https://example.com/en", [{"heading": "Notes", "text": "Run helm upgrade again. " * 9}]),
+        ]
+        ranked = rank_sections("helm 設定", pages, budget=60, unit="tokens")
+        self.assertEqual([r["url"] for r in ranked], ["https://example.com/en"])
+        self.assertLessEqual(estimate_tokens(ranked[0]["quote"]), 60)
+
+    def test_terms_share_rescore_ngrams(self):
+        # CJK の語は再スコア（compile_query）と同じ正規化・3-gram + 2-gram
+        for text in ("プラグインの設定", "SSO 設定の手順"):
+            cjk = _normalize_cjk(text)
+            self.assertLessEqual(set(compile_query(cjk).toks), set(section_terms(text)))
+        self.assertEqual(section_terms("Helm upgrade, helm.")["helm"], 2)
+
+    def test_old_stats_recomputed(self):
+        # section_terms 変更前の統計（2-gram のみ、版なし）は読み出し時に計算し直す
+        data = zlib.compress(json.dumps([["設定", "設定の手順", 3, {"設定": 2, "の手": 1}]]).encode())
+        (sec,) = decode_sections(data)
+        self.assertIn("設定の", sec["tf"])
+
+    def test_no_match_keeps_search_order(self):
+        ranked = rank_sections("kubernetes", self.PAGES, max_per_page=1)
+        self.assertEqual([(r["url"], r["heading"]) for r in ranked], [
+            ("https://example.com/a", "Overview"), ("https://example.com/b", "プラグイン"),
+        ])
+
+
+class TestSearchProjection(unittest.TestCase):
+    """fields による列の絞り込みと snippet"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+        self.addCleanup(self.conn.close)
+        body = "Intro text. " * 30 + "Run helm upgrade after editing values.yaml. " + "Tail text. " * 30
+        upsert_page(self.conn, "https://example.com/en-us/a", "en-us", "Upgrade guide", "", "lead", "h2", body, "", 0)
+        upsert_page(
+            self.conn, "https://example.com/ja-jp/a", "ja-jp", "アップグレード", "", "概要", "手順",
+            "前置き。" * 40 + "helm upgrade でアップグレードします。" + "後書き。" * 40, "", 0,
+        )
+
+    def test_fields(self):
+        (hit,) = search_index(self.conn, "helm upgrade", lang="en-us", fields=["title"])
+        self.assertEqual(set(hit), {"url", "title", "score"})
+        (hit,) = search_index(self.conn, "helm upgrade", lang="en-us")
+        self.assertEqual(set(hit), {"url", "lang", "title", "hpath", "lead", "headings", "body_prefix", "score"})
+        self.assertIn("values.yaml", hit["body_prefix"])
+        with self.assertRaises(ValueError):
+            search_index(self.conn, "helm", fields=["norm"])
+
+    def test_snippet(self):
+        (hit,) = search_index(self.conn, "helm upgrade", lang="en-us", fields=[], snippet=True)
+        self.assertIn("**helm**", hit["snippet"].lower())
+        self.assertLess(len(hit["snippet"]), 300)
+        (hit,) = search_index(self.conn, "アップグレード", lang="ja-jp", fields=["title"], snippet=True)
+        self.assertIn("**", hit["snippet"])
+        self.assertIn("アップグレード", hit["snippet"])
+        self.assertLess(len(hit["snippet"]), 300)
+
+    def test_snippet_without_body_prefix(self):
+        # enterprise の en-us 行は body_prefix が空
+        upsert_page(self.conn, "https://example.com/en-us/b", "en-us", "Gateway", "", "Configure the gateway", "", "", "", 0)
+        (hit,) = search_index(self.conn, "gateway", lang="en-us", fields=["title"], snippet=True)
+        self.assertIn("**gateway**", hit["snippet"])
+
+    def test_cache_key_includes_projection(self):
+        cache = SearchCache(maxsize=8, ttl=60)
+        lean = search_index(self.conn, "helm", lang="en-us", cache=cache, fields=["title"])
+        full = search_index(self.conn, "helm", lang="en-us", cache=cache)
+        self.assertNotIn("body_prefix", lean[0])
+        self.assertIn("body_prefix", full[0])
+
+
+class TestSearchMany(unittest.TestCase):
+    """search_many: 入力順・search_index と同じ結果・キャッシュ共有"""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        apply_schema(self.conn)
+        self.addCleanup(self.conn.close)
+        for i, (lang, title, body) in enumerate([
+            ("en-us", "Upgrade guide", "Run helm upgrade after editing values.yaml."),
+            ("en-us", "Install", "Install the chart with helm install."),
+            ("ja-jp", "アップグレード", "helm upgrade でアップグレードします。"),
+            ("ja-jp", "インストール", "helm install でインストールします。"),
+        ]):
+            upsert_page(self.conn, f"https://example.com/{lang}/{i}", lang, title, "", "lead", "h2", body, "", 0)
+
+    def test_same_as_search_index(self):
+        queries = [
+            {"query": "helm install", "lang": "en-us"},
+            {"query": "アップグレード", "lang": "ja-jp", "fields": ["title"], "snippet": True},
+            {"query": "helm", "lang": "en-us", "limit": 1},
+            {"query": "helm install", "lang": "en-us"},
+            {"query": "nothing-matches-this", "lang": "en-us"},
+        ]
+        got = search_many(self.conn, queries)
+        want = [search_index(self.conn, **q) for q in queries]
+        self.assertEqual(got, want)
+        self.assertEqual(len(got[2]), 1)
+        self.assertEqual(got[4], [])
+        self.assertIsNot(got[0], got[3])
+        self.assertFalse(self.conn.in_transaction)
+        self.assertEqual(search_many(self.conn, []), [])
+
+    def test_cache(self):
+        cache = SearchCache(maxsize=8, ttl=60)
+        queries = [{"query": "helm", "lang": "en-us"}, {"query": "helm", "lang": "en-us", "fields": ["title"]}]
+        first = search_many(self.conn, queries, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(search_index(self.conn, "helm", lang="en-us", cache=cache, fields=["title"]), first[1])
+        self.assertEqual(search_many(self.conn, queries, cache=cache), first)
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+